@@ -0,0 +1,236 @@
+"""
+CPNPP Database
+
+JSON endpoints used by the forms.
+
+The typeahead endpoints let a select field search species, accessions
+and entities on the server as the user types, instead of the page
+rendering an <option> for every row in the table.
+
+The read endpoints under /api/rows let other tools page through whole
+tables without opening the database file themselves,
+/api/accessions/batch creates many accessions at once and
+/api/accessions/export downloads them all as the accession export.
+"""
+from flask import Blueprint, Response, jsonify, request, stream_with_context
+from sqlalchemy import Date, DateTime, and_, func, not_, select
+
+from models import db, Accession, Availability, Entity, Shipment, Species, Testing
+
+api = Blueprint('api', __name__, url_prefix='/api')
+
+# Results per page of a typeahead search, and the most a client may ask for
+PER_PAGE = 20
+MAX_PER_PAGE = 100
+
+# The model and label column searched by each typeahead
+LOOKUPS = {
+    'species': (Species, Species.name_full),
+    'accessions': (Accession, Accession.acc_num),
+    'entities': (Entity, Entity.name),
+}
+
+# Rows per page of a read endpoint, and the most a client may ask for
+ROWS_PER_PAGE = 100
+MAX_ROWS_PER_PAGE = 1000
+
+# The model read by each read endpoint, and columns it never returns
+RESOURCES = {
+    'accessions': (Accession, ('import_hash',)),
+    'species': (Species, ()),
+    'tests': (Testing, ()),
+    'availability': (Availability, ()),
+    'shipments': (Shipment, ()),
+}
+
+
+@api.route('/species')
+def species():
+    return typeahead('species')
+
+
+@api.route('/accessions')
+def accessions():
+    return typeahead('accessions')
+
+
+@api.route('/accessions/batch', methods=('POST',))
+def accessions_batch():
+    """
+    Creates the accessions in a CSV file or JSON array, posted as the
+    request body or as a file upload named file. Responds with
+    {"created": n, "failed": n, "rows": [...]}, where each row has either
+    the id of its accession or its errors, as returned by import_batch.
+    """
+    # Imported here, as batches needs pandas
+    from batches import BatchError, import_batch, read_batch
+
+    upload = request.files.get('file')
+    if upload is not None:
+        data = upload.read()
+        format = 'json' if upload.filename.lower().endswith('.json') else 'csv'
+    else:
+        data = request.get_data()
+        format = 'json' if request.is_json else 'csv'
+    try:
+        report = import_batch(read_batch(data, format))
+    except BatchError as e:
+        return jsonify(error=str(e)), 400
+    created = sum(1 for row in report if 'id' in row)
+    return jsonify(created=created, failed=len(report) - created, rows=report)
+
+
+@api.route('/accessions/export')
+def accessions_export():
+    """
+    Streams the accession export, as CSV or with format=xlsx as XLSX.
+    """
+    # Imported here, as exports needs openpyxl
+    import exports
+
+    format = request.args.get('format', 'csv')
+    if format not in exports.FORMATS:
+        return jsonify(error='Unknown format {}'.format(format)), 400
+    return Response(stream_with_context(exports.export(format)), mimetype=exports.MIMETYPES[format],
+                    headers={'Content-Disposition': 'attachment; filename=accessions.{}'.format(format)})
+
+
+@api.route('/entities')
+def entities():
+    return typeahead('entities')
+
+
+@api.route('/rows/<resource>')
+def rows(resource):
+    """
+    Responds with {"columns": [...], "rows": [[...]], "next": cursor} for
+    the fields, after and limit query parameters. fields is a comma
+    separated list of columns, defaulting to all of them. Pass next as
+    after to get the following page; it is null on the last page.
+    """
+    if resource not in RESOURCES:
+        return jsonify(error='Unknown resource {}'.format(resource)), 404
+    fields = request.args.get('fields')
+    fields = [field.strip() for field in fields.split(',')] if fields else None
+    after = request.args.get('after', type=int)
+    limit = min(max(request.args.get('limit', ROWS_PER_PAGE, type=int), 1), MAX_ROWS_PER_PAGE)
+    try:
+        columns, page, cursor = read_page(resource, fields, after, limit)
+    except KeyError as e:
+        return jsonify(error='Unknown field {}'.format(e.args[0])), 400
+    return jsonify(columns=columns, rows=page, next=cursor)
+
+
+def read_page(resource, fields=None, after=None, limit=ROWS_PER_PAGE):
+    """
+    :param resource: One of the keys of RESOURCES.
+    :param fields: The names of the columns to return, or None for all of
+    them. Raises KeyError for a name that is not one of them.
+    :param after: The id the previous page ended on, or None for the
+    first page.
+    :param limit: Number of rows per page.
+    :return: A tuple of the column names, a list of rows, each a list of
+    JSON serializable values, and the cursor of the next page, which is
+    None on the last page.
+
+    Pages are found by seeking the primary key past after rather than with
+    OFFSET, so any page costs the same as the first one. The id is always
+    selected, and returned first, since it is the cursor.
+    """
+    model, hidden = RESOURCES[resource]
+    table = model.__table__
+    names = [name for name in table.columns.keys() if name not in hidden]
+    if fields is not None:
+        for field in fields:
+            if field not in names:
+                raise KeyError(field)
+        names = ['id'] + [field for field in fields if field != 'id']
+    columns = [table.c[name] for name in names]
+
+    statement = select(*columns).order_by(table.c.id).limit(limit + 1)
+    if after is not None:
+        statement = statement.where(table.c.id > after)
+    result = db.session.execute(statement).all()
+
+    # Only date and time values need converting for JSON
+    dates = [i for i, column in enumerate(columns) if isinstance(column.type, (Date, DateTime))]
+    page = []
+    for row in result[:limit]:
+        row = list(row)
+        for i in dates:
+            if row[i] is not None:
+                row[i] = row[i].isoformat()
+        page.append(row)
+    cursor = page[-1][0] if len(result) > limit else None
+    return names, page, cursor
+
+
+def typeahead(lookup):
+    """
+    Responds with {"results": [{"id": ..., "text": ...}], "more": bool}
+    for the q, page and per_page query parameters, the format expected
+    by the Select2 widgets in layout.html.
+    """
+    q = request.args.get('q', '')
+    page = max(request.args.get('page', 1, type=int), 1)
+    per_page = min(max(request.args.get('per_page', PER_PAGE, type=int), 1), MAX_PER_PAGE)
+    results, more = search(lookup, q, page, per_page)
+    return jsonify(results=[{'id': row_id, 'text': label} for row_id, label in results], more=more)
+
+
+def search(lookup, q, page=1, per_page=PER_PAGE):
+    """
+    :param lookup: One of the keys of LOOKUPS.
+    :param q: The text to search for, matched case insensitively.
+    :param page: The page of results to return, starting from 1.
+    :param per_page: Number of results per page.
+    :return: A tuple of a list of (id, label) tuples and whether there is
+    another page.
+
+    Labels starting with q are listed first, in order. They are found
+    with a range scan of the lower(label) index. Labels that only
+    contain q follow them. That search scans the whole table, so it only
+    runs once the prefix matches do not fill the page.
+    """
+    model, label = LOOKUPS[lookup]
+    key = func.lower(label)
+    q = q.strip().lower()
+    start = (page - 1) * per_page
+    query = db.session.query(model.id, label)
+
+    if not q:
+        rows = query.filter(label.isnot(None)).order_by(key).offset(start).limit(per_page + 1).all()
+        return [tuple(row) for row in rows[:per_page]], len(rows) > per_page
+
+    prefix = and_(key >= q, key < prefix_upper_bound(q))
+    rows = query.filter(prefix).order_by(key).offset(start).limit(per_page + 1).all()
+    if len(rows) <= per_page:
+        # The prefix matches end on this page, so fill the rest of it with
+        # the substring matches that come after them
+        prefix_count = start + len(rows) if rows else query.filter(prefix).count()
+        rows += query.filter(key.contains(q, autoescape=True), not_(prefix)).order_by(key).offset(
+            max(start - prefix_count, 0)).limit(per_page + 1 - len(rows)).all()
+    return [tuple(row) for row in rows[:per_page]], len(rows) > per_page
+
+
+def prefix_upper_bound(prefix):
+    """
+    :return: The smallest string greater than every string starting with
+    prefix, so that key >= prefix and key < bound selects the strings that
+    start with it.
+    """
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+def selected_choices(lookup, value):
+    """
+    :param lookup: One of the keys of LOOKUPS.
+    :param value: The id submitted for a typeahead select field, if any.
+    :return: The field's choices, which is just the (id, label) of the
+    submitted row if it exists. This keeps it selected when the form is
+    shown again and lets the field validate without loading the table.
+    """
+    if value is None:
+        return []
+    model, label = LOOKUPS[lookup]
+    return [tuple(row) for row in db.session.query(model.id, label).filter(model.id == value)]
@@ -1,24 +1,70 @@
-from flask import Flask, redirect, render_template, flash
+"""
+CPNPP Database
 
+The web app. create_app builds it from settings.cfg, for wsgi.py, the
+command line and the tests, and registers the form views below along
+with the JSON API.
+
+Modules that are slow to import and only used by a few endpoints, such
+as pandas for the batch endpoint, are imported by those endpoints rather
+than here, so that a worker starts quickly. For the same reason compiled
+templates are kept in TEMPLATE_CACHE_DIR, so that only the first worker
+to render a template after it changes compiles it.
+"""
+import os
+
+from flask import Blueprint, Flask, redirect, render_template, flash
+from jinja2 import FileSystemBytecodeCache
+
+import api
+import choices
 import forms
+import instrumentation
+import metrics
 import models
 
-app = Flask(__name__)
-app.config.from_pyfile('settings.cfg')
-app.app_context().push()
+views = Blueprint('views', __name__)
+
+# Where compiled templates are kept, relative to this file. Set
+# TEMPLATE_CACHE_DIR to None in settings.cfg to compile them in memory
+# only.
+TEMPLATE_CACHE_DIR = '.template_cache'
+
 
+def create_app(config=None):
+    """
+    :param config: Dict of settings overriding those in settings.cfg.
+    :return: The Flask app. The database tables are not created; see
+    manage.py init-db.
+    """
+    app = Flask(__name__)
+    app.config['TEMPLATE_CACHE_DIR'] = TEMPLATE_CACHE_DIR
+    app.config.from_pyfile('settings.cfg')
+    if config:
+        app.config.update(config)
 
-@app.route('/')
+    cache_dir = app.config['TEMPLATE_CACHE_DIR']
+    if cache_dir:
+        cache_dir = os.path.join(app.root_path, cache_dir)
+        os.makedirs(cache_dir, exist_ok=True)
+        app.jinja_options = dict(app.jinja_options, bytecode_cache=FileSystemBytecodeCache(cache_dir))
+
+    models.db.init_app(app)
+    app.register_blueprint(views)
+    app.register_blueprint(api.api)
+    instrumentation.init_app(app)
+    metrics.init_app(app)
+    return app
+
+
+@views.route('/')
 def index():
     return render_template('landing.html')
 
 
-@app.route('/accessions')
+@views.route('/accessions')
 def accessions():
     form = forms.AccessionForm()
-    form.species.choices = [
-        (species.id, species.name_full) for species in
-        models.db.session.query(models.Species).distinct(models.Species.name_full).group_by(models.Species.name_full)]
     if form.validate_on_submit():
         species = models.Species.query.get(form.species.data)
         # Need to create the LocationDescription object first
@@ -43,7 +89,7 @@ def accessions():
         if unit == 'm':
             altitude_m = altitude
         else:
-            altitude_m = int(altitude * 0.3048)
+            altitude_m = int(models.compute_ft_to_m(altitude))
         loc = models.GeoLocation(
             phytoregion=form.phytoregion.data,
             phytoregion_full=form.phytoregion_full.data,
@@ -104,21 +150,18 @@ def accessions():
         models.db.session.commit()
         flash('Yay, Accession created!', 'success')
         return redirect('/success')
+    form.species.choices = api.selected_choices('species', form.species.data)
     return render_template('accessions.html', form=form)
 
 
-@app.route('/additions')
+@views.route('/additions')
 def add():
     return render_template('additions.html')
 
 
-@app.route('/availability', methods=('GET', 'POST'))
+@views.route('/availability', methods=('GET', 'POST'))
 def availability():
     form = forms.AvailabilityForm()
-    form.accession.choices = [
-        (acc.id, acc.acc_num) for acc in models.Accession.query.order_by('acc_num')]
-    form.misc_inst_id.choices = [
-        (inst.id, inst.name) for inst in models.Entity.query.order_by('name')]
     if form.validate_on_submit():
         acc = models.Accession.query.get(form.accession.data)
         misc_inst = models.Entity.query.get(form.misc_inst_id.data)
@@ -138,16 +181,18 @@ def availability():
             ephraim_avail=ephraim,
             nau_avail=nau,
             accession=acc,
-            misc_avail_inst=misc_inst,
+            misc_avail_ent=misc_inst,
         )
         models.db.session.add(avail)
         models.db.session.commit()
         flash('Yay, availability added for {}'.format(acc.species.name_full), 'success')
         return redirect('/success')
+    form.accession.choices = api.selected_choices('accessions', form.accession.data)
+    form.misc_inst_id.choices = choices.get_choices('entity')
     return render_template('availability.html', form=form)
 
 
-@app.route('/institutions', methods=('GET', 'POST'))
+@views.route('/institutions', methods=('GET', 'POST'))
 def institutions():
     form = forms.InstitutionForm()
     if form.validate_on_submit():
@@ -168,14 +213,9 @@ def institutions():
     return render_template('institutions.html', form=form)
 
 
-@app.route('/releases', methods=('GET', 'POST'))
+@views.route('/releases', methods=('GET', 'POST'))
 def releases():
     form = forms.ReleaseForm()
-    form.species.choices = [
-        (species.id, species.name_full) for species in
-        models.db.session.query(models.Species).distinct(models.Species.name_full).group_by(models.Species.name_full)]
-    form.accession.choices = [
-        (acc.id, acc.acc_num) for acc in models.Accession.query.order_by('acc_num')]
     if form.validate_on_submit():
         species = models.Species.query.get(form.species.data)
         acc = models.Accession.query.get(form.accession.data)
@@ -210,18 +250,14 @@ def releases():
         models.db.session.commit()
         flash('Yay, release for {} created!'.format(species.name_full), 'success')
         return redirect('/success')
+    form.species.choices = api.selected_choices('species', form.species.data)
+    form.accession.choices = api.selected_choices('accessions', form.accession.data)
     return render_template('releases.html', form=form)
 
 
-@app.route('/shipments', methods=('GET', 'POST'))
+@views.route('/shipments', methods=('GET', 'POST'))
 def shipments():
     form = forms.ShipmentForm()
-    form.origin_institute_id.choices = [
-        (inst.id, inst.name) for inst in models.Entity.query.order_by('name')]
-    form.destination_institute_id.choices = [
-        (inst.id, inst.name) for inst in models.Entity.query.order_by('name')]
-    form.accession.choices = [
-        (acc.id, acc.acc_num) for acc in models.Accession.query.order_by('acc_num')]
     if form.validate_on_submit():
         origin_institute = models.Entity.query.get(form.origin_institute_id.data)
         destination_institute = models.Entity.query.get(form.destination_institute_id.data)
@@ -240,10 +276,14 @@ def shipments():
         models.db.session.commit()
         flash('Yay, Shipment created!', 'success')
         return redirect('/success')
+    entities = choices.get_choices('entity')
+    form.origin_institute_id.choices = entities
+    form.destination_institute_id.choices = entities
+    form.accession.choices = api.selected_choices('accessions', form.accession.data)
     return render_template('shipments.html', form=form)
 
 
-@app.route('/species', methods=('GET', 'POST'))
+@views.route('/species', methods=('GET', 'POST'))
 def species():
     form = forms.SpeciesForm()
     if form.validate_on_submit():
@@ -266,22 +306,14 @@ def species():
     return render_template('species.html', form=form)
 
 
-@app.route('/success', methods=('GET', 'POST'))
+@views.route('/success', methods=('GET', 'POST'))
 def success():
     return 'Success!'
 
 
-@app.route('/synonyms', methods=('GET', 'POST'))
+@views.route('/synonyms', methods=('GET', 'POST'))
 def synonyms():
     form = forms.SynonymsForm()
-    form.species.choices = [
-        (species.id, species.name_full) for species in
-        models.db.session.query(models.Species).distinct(models.Species.name_full).group_by(models.Species.name_full)
-    ]
-    form.synonym.choices = [
-        (species.id, species.name_full) for species in
-        models.db.session.query(models.Species).distinct(models.Species.name_full).group_by(models.Species.name_full)
-    ]
     if form.validate_on_submit():
         plant = models.Species.query.get(form.species.data)
         synonym = models.Species.query.get(form.synonym.data)
@@ -289,25 +321,23 @@ def synonyms():
         models.db.session.commit()
         flash('Yay, {} successfully added as a synonym of {}'.format(synonym.name_full, plant.name_full), 'success')
         return redirect('/success')
+    form.species.choices = api.selected_choices('species', form.species.data)
+    form.synonym.choices = api.selected_choices('species', form.synonym.data)
     return render_template('synonyms.html', form=form)
 
 
-@app.route('/testing', methods=('GET', 'POST'))
+@views.route('/testing', methods=('GET', 'POST'))
 def testing():
     form = forms.TestingForm()
-    form.accession.choices = [
-        (acc.id, acc.acc_num) for acc in models.Accession.query.order_by('acc_num')]
-    form.entity.choices = [
-        (ent.id, ent.name) for ent in models.Entity.query.order_by('name')]
     if form.validate_on_submit():
         accession = models.Accession.query.get(form.accession.data)
-        entity = models.Entity.query.get(form.en)
+        entity = models.Entity.query.get(form.entity.data)
         test = models.Testing(
             amt_rcvd_lbs=form.amt_rcvd_lbs.data,
             clean_wt_lbs=form.clean_wt_lbs.data,
             est_seed_lb=form.est_seed_lb.data,
             est_pls_lb=form.est_pls_lb.data,
-            est_pls_collected=form.est_pls_collected,
+            est_pls_collected=form.est_pls_collected.data,
             test_type=form.test_type.data,
             test_date=form.test_date.data,
             purity=form.purity.data,
@@ -320,14 +350,14 @@ def testing():
         models.db.session.commit()
         flash('Yay, test added for {}'.format(form.accession.data))
         return redirect('/success')
+    form.accession.choices = api.selected_choices('accessions', form.accession.data)
+    form.entity.choices = choices.get_choices('entity')
     return render_template('testing.html', form=form)
 
 
-@app.route('/uses', methods=('GET', 'POST'))
+@views.route('/uses', methods=('GET', 'POST'))
 def uses():
     form = forms.UseForm()
-    form.accession.choices = [
-        (acc.id, acc.acc_num) for acc in models.Accession.query.order_by('acc_num')]
     if form.validate_on_submit():
         accession = models.Accession.query.get(form.accession.data)
         species = accession.species
@@ -345,11 +375,13 @@ def uses():
         models.db.session.commit()
         flash('Yay, AmountUsed created for {}.'.format(species.name_full), 'success')
         return redirect('/success')
+    form.accession.choices = api.selected_choices('accessions', form.accession.data)
     return render_template('use.html', form=form)
 
 
 if __name__ == '__main__':
-    models.db.init_app(app)
-    models.db.create_all()
+    app = create_app()
+    with app.app_context():
+        models.migrate()
 
     app.run()
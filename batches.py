@@ -0,0 +1,240 @@
+"""
+CPNPP Database
+
+Creates accessions in batches from the rows of a CSV file or a JSON array
+of objects, as posted to /api/accessions/batch.
+
+Fields are named after the columns they are stored in, as in the
+accession form, except that species is the species' full name. Every row
+is validated in one pass over the columns of a DataFrame and the species
+are resolved with a single query. The valid rows are then written in one
+transaction, one executemany per table, and the rest are reported back
+with their errors.
+"""
+import io
+import json
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import Boolean, DateTime, Float, Integer, String, func, insert
+
+from models import compute_ft_to_m, convert_dd_dms_columns, db, Accession, GeoLocation, Species, Visit, Zone
+
+# Data source of the accessions created from a batch, as for the form
+DATA_SOURCE = 'CPNPP Web Entry'
+
+# The fields of a batch row stored in each table, besides the species
+ACCESSION_FIELDS = ('acc_num', 'plant_habit', 'coll_date', 'collected_with', 'collection_misc', 'occupancy',
+                    'seed_source', 'description', 'notes')
+GEO_LOCATION_FIELDS = ('land_owner', 'geology', 'soil_type', 'phytoregion', 'phytoregion_full', 'locality',
+                       'geog_area', 'directions', 'latitude_decimal', 'longitude_decimal', 'georef_source',
+                       'gps_datum', 'altitude', 'altitude_unit', 'fo_name', 'district_name', 'state', 'county')
+VISIT_FIELDS = ('associated_taxa_full', 'mod', 'mod2', 'slope', 'aspect', 'habitat', 'population_size')
+ZONE_FIELDS = ('ptz', 'us_l4_code', 'us_l4_name', 'us_l3_code', 'us_l3_name', 'achy_sz_gridcode', 'achy_sz_zone',
+               'cp_buff', 'cp_strict', 'avail_buff', 'avail_strict', 'usgs_zone')
+
+# Field name to the column it is validated against and stored in
+FIELDS = {name: model.__table__.c[name]
+          for model, names in ((Accession, ACCESSION_FIELDS), (GeoLocation, GEO_LOCATION_FIELDS),
+                               (Visit, VISIT_FIELDS), (Zone, ZONE_FIELDS))
+          for name in names}
+
+# Fields every row must have, as in the accession form
+REQUIRED = ('species', 'acc_num', 'coll_date', 'collected_with')
+
+ALTITUDE_UNITS = ('ft', 'm')
+
+BOOLEANS = {'true': True, 'yes': True, '1': True, 'false': False, 'no': False, '0': False}
+
+
+class BatchError(Exception):
+    """
+    Raised for a batch that cannot be read at all, as opposed to one with
+    invalid rows.
+    """
+
+
+def read_batch(data, format):
+    """
+    :param data: The batch as bytes.
+    :param format: 'csv' for a CSV file with a header row, or 'json' for
+    an array of objects.
+    :return: A DataFrame with a column for 'species' and every field in
+    FIELDS, and missing values as None.
+    """
+    if format == 'csv':
+        try:
+            frame = pd.read_csv(io.BytesIO(data), dtype=str, keep_default_na=False)
+        except (ValueError, pd.errors.ParserError) as e:
+            raise BatchError('Invalid CSV: {}'.format(e))
+    elif format == 'json':
+        try:
+            records = json.loads(data)
+        except ValueError as e:
+            raise BatchError('Invalid JSON: {}'.format(e))
+        if not isinstance(records, list) or not all(isinstance(record, dict) for record in records):
+            raise BatchError('Expected a JSON array of objects')
+        frame = pd.DataFrame.from_records(records)
+    else:
+        raise BatchError('Unsupported format {}'.format(format))
+
+    unknown = sorted(set(frame.columns) - set(FIELDS) - {'species'})
+    if unknown:
+        raise BatchError('Unknown fields: {}'.format(', '.join(unknown)))
+    frame = frame.reindex(columns=['species'] + list(FIELDS)).astype(object)
+    # Blank cells are missing values
+    blank = frame.apply(lambda values: values.map(lambda value: isinstance(value, str) and not value.strip()))
+    return frame.mask(blank | frame.isnull(), None)
+
+
+def validate_batch(frame):
+    """
+    :param frame: A DataFrame as returned by read_batch.
+    :return: A tuple of the frame with each field converted to its
+    column's type and species replaced by species_id, and a list with a
+    dict of field name to error messages for each row, empty for the rows
+    that are valid.
+    """
+    errors = [{} for _ in range(len(frame))]
+
+    def reject(mask, field, message):
+        for position in np.flatnonzero(np.asarray(mask, dtype=bool)):
+            errors[position].setdefault(field, []).append(message)
+
+    values = pd.DataFrame(index=frame.index)
+    for name, column in FIELDS.items():
+        values[name], invalid = convert(frame[name], column.type)
+        reject(invalid, name, 'Not a valid {}.'.format(type(column.type).__name__.lower()))
+        if isinstance(column.type, String) and column.type.length:
+            too_long = values[name].str.len().gt(column.type.length).fillna(False)
+            reject(too_long, name, 'Longer than {} characters.'.format(column.type.length))
+
+    for name in REQUIRED:
+        reject(frame[name].isnull(), name, 'This field is required.')
+
+    reject(values['altitude_unit'].notnull() & ~values['altitude_unit'].isin(ALTITUDE_UNITS), 'altitude_unit',
+           'Must be one of {}.'.format(', '.join(ALTITUDE_UNITS)))
+
+    acc_nums = values['acc_num']
+    existing = set(acc_num for acc_num, in db.session.query(Accession.acc_num).filter(
+        Accession.acc_num.in_(acc_nums.dropna().unique().tolist())))
+    reject(acc_nums.isin(existing), 'acc_num', 'Already in the database.')
+    reject(acc_nums.notnull() & acc_nums.duplicated(), 'acc_num', 'Repeated in the batch.')
+
+    # Matched case insensitively, which the lower(name_full) index covers
+    names = frame['species'].map(lambda name: str(name).strip().lower(), na_action='ignore')
+    species_ids = dict(db.session.query(func.lower(Species.name_full), Species.id).filter(
+        func.lower(Species.name_full).in_(names.dropna().unique().tolist())))
+    values['species_id'] = names.map(species_ids).astype('Int64')
+    reject(names.notnull() & values['species_id'].isnull(), 'species', 'Unknown species.')
+
+    return values, errors
+
+
+def convert(values, column_type):
+    """
+    :param values: A Series of values as read, with missing values as None.
+    :param column_type: The type of the column they are stored in.
+    :return: A tuple of the converted Series and a boolean Series marking
+    the values that could not be converted.
+    """
+    present = values.notnull()
+    if isinstance(column_type, Boolean):
+        converted = values.map(lambda value: BOOLEANS.get(str(value).strip().lower()), na_action='ignore')
+    elif isinstance(column_type, Integer):
+        converted = pd.to_numeric(values, errors='coerce')
+        converted = converted.where(converted == np.trunc(converted))
+    elif isinstance(column_type, Float):
+        converted = pd.to_numeric(values, errors='coerce')
+    elif isinstance(column_type, DateTime):
+        converted = pd.to_datetime(values, errors='coerce', format='ISO8601')
+    else:
+        converted = values.map(lambda value: str(value).strip(), na_action='ignore')
+    invalid = present & converted.isnull()
+    if isinstance(column_type, Integer):
+        converted = converted.astype('Int64')
+    return converted, invalid
+
+
+def create_accessions(values):
+    """
+    :param values: The valid rows of a frame returned by validate_batch.
+    :return: A list of the ids of the accessions created, in row order.
+
+    Splits each acc_num into acc_num1, acc_num2 and acc_num3 and converts
+    altitudes in feet to altitude_in_m, as the accession form does, but a
+    column at a time. Each row gets a geo location, zone and visit as in
+    the accession export import. The caller commits.
+    """
+    if values.empty:
+        return []
+
+    locations = values[list(GEO_LOCATION_FIELDS)].copy()
+    locations['degrees_n'], locations['minutes_n'], locations['seconds_n'] = convert_dd_dms_columns(
+        locations['latitude_decimal'])
+    locations['degrees_w'], locations['minutes_w'], locations['seconds_w'] = convert_dd_dms_columns(
+        locations['longitude_decimal'])
+    # Altitudes without a unit are in feet, the form's default
+    altitude = locations['altitude']
+    unit = locations['altitude_unit'].where(altitude.isnull() | locations['altitude_unit'].notnull(), 'ft')
+    locations['altitude_unit'] = unit
+    locations['altitude_in_m'] = altitude.where(unit == 'm', np.trunc(compute_ft_to_m(altitude.astype(float))))
+    locations['altitude_in_m'] = locations['altitude_in_m'].astype('Int64')
+    location_ids = insert_rows(GeoLocation, locations)
+
+    accessions = values[list(ACCESSION_FIELDS)].copy()
+    split = accessions['acc_num'].str.split('-', expand=True).reindex(columns=range(3))
+    accessions['acc_num1'], accessions['acc_num2'], accessions['acc_num3'] = split[0], split[1], split[2]
+    accessions = accessions.assign(data_source=DATA_SOURCE, increase=False, species_id=values['species_id'],
+                                   geo_location_id=location_ids)
+    accession_ids = insert_rows(Accession, accessions)
+
+    insert_rows(Zone, values[list(ZONE_FIELDS)].assign(geo_location_id=location_ids))
+    insert_rows(Visit, values[list(VISIT_FIELDS)].assign(
+        date=values['coll_date'], geo_location_id=location_ids, accession_id=accession_ids,
+        species_id=values['species_id']))
+    return accession_ids.tolist()
+
+
+def insert_rows(model, frame):
+    """
+    Inserts every row of frame, keyed by the model's column names, with a
+    single executemany that returns the new ids.
+
+    :return: A Series of the ids, with the index of frame.
+    """
+    table = model.__table__
+    records = frame.astype(object).where(frame.notnull(), None).to_dict('records')
+    statement = insert(table).returning(table.c.id, sort_by_parameter_order=True)
+    ids = db.session.execute(statement, records).scalars().all()
+    return pd.Series(ids, index=frame.index)
+
+
+def import_batch(frame):
+    """
+    :param frame: A DataFrame as returned by read_batch.
+    :return: A list with a dict for each row, in order. Each has the row's
+    1-based number and acc_num, and either the id of the accession
+    created or the errors that kept it from being created.
+
+    The valid rows are committed together. If that fails, nothing from
+    the batch is written and the exception is raised.
+    """
+    values, errors = validate_batch(frame)
+    valid = [not row_errors for row_errors in errors]
+    try:
+        ids = iter(create_accessions(values[valid]))
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+    report = []
+    for number, (acc_num, row_errors) in enumerate(zip(frame['acc_num'], errors), 1):
+        result = {'row': number, 'acc_num': acc_num}
+        if row_errors:
+            result['errors'] = row_errors
+        else:
+            result['id'] = next(ids)
+        report.append(result)
+    return report
@@ -0,0 +1,152 @@
+"""
+CPNPP Database
+
+Compares the speed of the accession import paths on a synthetic export:
+
+    orm          One ORM object per record, built with the model
+                 constructors, including Availability's totals.
+    mappings     parse_excel, which inserts plain dicts through the ORM
+                 bulk API.
+    core         bulk_import, which transforms whole chunks column-wise
+                 and inserts them with Core executemany.
+
+Each path loads the same rows into an empty database. Run with e.g.
+
+    python bench_import.py --rows 20000
+"""
+import argparse
+import contextlib
+import datetime
+import inspect
+import io
+import os
+import tempfile
+import time
+
+import pandas as pd
+
+from app import create_app
+from models import db, Accession, Availability, GeoLocation, Species, Testing, Visit, Zone
+from populate_db import AVAILABILITY_COLUMNS, BATCH_SIZE, SpeciesIndex, bulk_import, get_acc_records, parse_excel
+from workbooks import CHUNK_SIZE
+
+SPECIES_NAME = 'Achnatherum hymenoides'
+
+SAMPLE_ROW = {
+    'DATA_SOURCE': 'UP', 'Habit_rev': 'Graminoid', 'COLL_DT': datetime.datetime(2004, 8, 24), 'ACC_NUM': None,
+    'ACC_NUM_1': 'UP', 'ACC_NUM_2': None, 'ACC_NUM_3': None, 'COLLECTED_WITH': 'GVR, CH, SP',
+    'COLLECTION_MISC': None, 'OCCUPANCY': 300, 'SEED_SOURCE': 'P', 'DESCRIPTION': 'Height: 0.15-0.45 m',
+    'notes': None, 'NAME': SPECIES_NAME, 'LAND_OWNER': 'BLM', 'GEOLOGY': None, 'SOIL_TYPE': 'brown-tan sand',
+    'PHYTOREGION': '25E', 'PHYTOREGION_FULL': 'Western High Plains (Omernik)', 'SUB_CNT3': None, 'GEOG_AREA': None,
+    'LOCALITY': 'North of the reservoir', 'LATITUDE_DECIMAL': 38.33786, 'LONGITUDE_DECIMAL': -107.8999,
+    'GEOREF_SOURCE': 'GPS', 'GPS_DATUM': 'NAD83', 'ALTITUDE': 7100, 'ALTITUDE_UNIT': 'ft', 'ALTITUDE_IN_M': 2164,
+    'ADMU_NAME': 'UNCOMPAHGRE FIELD OFFICE', 'PARENT_NAM': 'SOUTHWEST DISTRICT OFFICE', 'ADMIN_ST': 'CO',
+    'SUB_CNT2': 'Montrose', 'ASSOCIATED_TAXA_FULL': None, 'USER2': 'grazed', 'USER1': None, 'SLOPE': '5-25 degrees',
+    'ASPECT': 'varied', 'HABITAT': None, 'POPULATION_SIZE': 200, 'AMOUNT_RECVD__LBS_': 0.78,
+    'CLEAN_WEIGHT__LBS_': 0.52, 'SEED_LB': 351627.0, 'EST_PLS_LB': 297054.49, 'EST_PLS_COLLECTED': 5346.98,
+    'TEST_TYPE': 'XPC', 'TEST_DATE': datetime.datetime(2003, 3, 12), 'PURITY_': 98, 'TZ_': 60, 'FILL_': 90,
+    'Pot_STZ': '10 - 15 Deg. F./6 - 12', 'US_L4CODE': '20c', 'US_L4NAME': 'Semiarid Benchlands and Canyonlands',
+    'US_L3CODE': '20', 'US_L3NAME': 'Colorado Plateaus', 'ACHY_SZ_GRIDCODE': 11, 'ACHY_SZ_ZONE': 'L1L2H3',
+    'CPBuff': 1, 'CPStrict': 1, 'AVAIL_BUFF': 1, 'AVAIL_STRICT': 0, 'USGS_ZONE': 0,
+    'GRIN_AVAIL': 10.0, 'BEND_AVAIL': 0.0, 'CBG_AVAIL': 25.5, 'MEEKER_AVAIL': 0.0, 'MISC_AVAIL': 0.0,
+    'EPHRAIM_AVAIL': 3.2, 'NAU_AVAIL': 0.0,
+}
+
+
+def synthetic_rows(count):
+    rows = []
+    for i in range(count):
+        row = dict(SAMPLE_ROW, ACC_NUM='UP-{}'.format(i), ACC_NUM_2=str(i))
+        row['LATITUDE_DECIMAL'] += i * 1e-5
+        rows.append(row)
+    return rows
+
+
+def construct(model, values, **relations):
+    """
+    Calls the model's constructor with values and relations, passing None
+    for any other parameter it requires.
+    """
+    parameters = inspect.signature(model.__init__).parameters
+    kwargs = {name: None for name, parameter in parameters.items()
+              if name != 'self' and parameter.default is inspect.Parameter.empty}
+    kwargs.update(values)
+    kwargs.update(relations)
+    return model(**kwargs)
+
+
+def orm_import(rows, chunks):
+    index = SpeciesIndex.load()
+    for start in range(0, len(rows), BATCH_SIZE):
+        for row in rows[start:start + BATCH_SIZE]:
+            record = get_acc_records(row)
+            species = db.session.get(Species, index.get_by_name(record.species_name))
+            zone = construct(Zone, record.zone)
+            location = construct(GeoLocation, record.geo_location, zone=zone)
+            accession_values = dict(record.accession)
+            accession_values.pop('import_hash')
+            accession = construct(Accession, accession_values, species=species, geo_location=location)
+            visit = construct(Visit, record.visit, geo_location=location, species=species, accession=accession)
+            test = construct(Testing, record.test, accession=accession)
+            availability = construct(Availability, {column: row[source]
+                                                    for column, source in AVAILABILITY_COLUMNS.items()},
+                                     accession=accession)
+            db.session.add_all([zone, location, accession, visit, test, availability])
+        db.session.commit()
+
+
+def mappings_import(rows, chunks):
+    parse_excel(rows, workers=1)
+
+
+def core_import(rows, chunks):
+    bulk_import(chunks)
+
+
+PATHS = (('orm', orm_import), ('mappings', mappings_import), ('core', core_import))
+
+
+def reset_database():
+    db.session.remove()
+    db.drop_all()
+    db.create_all()
+    db.session.add(Species(symbol='ACHY', name_full=SPECIES_NAME, common='Indian ricegrass', family='Poaceae',
+                           genus='Achnatherum', species='hymenoides', var_ssp1=None, var_ssp2=None, plant_type=None,
+                           plant_duration=None, priority_species=0, gsg_val=0, poll_val=0, research_val=0))
+    db.session.commit()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the accession import paths.')
+    parser.add_argument('--rows', type=int, default=10000, help='Number of export rows (default: %(default)s).')
+    parser.add_argument('--paths', nargs='+', choices=[name for name, _ in PATHS], default=[name for name, _ in PATHS])
+    args = parser.parse_args(argv)
+
+    db_file = os.path.join(tempfile.mkdtemp(), 'bench.db')
+    create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + db_file}).app_context().push()
+
+    # Each path is given the export in the form it reads it, as from
+    # iter_rows or iter_chunks
+    rows = synthetic_rows(args.rows)
+    frame = pd.DataFrame.from_records(rows)
+    chunks = [frame.iloc[start:start + CHUNK_SIZE] for start in range(0, len(frame), CHUNK_SIZE)]
+    timings = {}
+    for name, run in PATHS:
+        if name not in args.paths:
+            continue
+        reset_database()
+        started = time.time()
+        with contextlib.redirect_stdout(io.StringIO()):
+            run(rows, chunks)
+        timings[name] = time.time() - started
+        assert Accession.query.count() == args.rows, name
+
+    # Speedups are relative to the first path that was run
+    baseline = next(iter(timings.values()))
+    print('{:<10} {:>9} {:>12} {:>9}'.format('path', 'seconds', 'rows/sec', 'speedup'))
+    for name, seconds in timings.items():
+        print('{:<10} {:>9.2f} {:>12.0f} {:>8.1f}x'.format(name, seconds, args.rows / seconds, baseline / seconds))
+
+
+if __name__ == '__main__':
+    main()
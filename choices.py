@@ -0,0 +1,113 @@
+"""
+CPNPP Database
+
+A per-process cache of the (id, label) choice lists used by the forms'
+entity select fields. Species and accessions are too many to list, and
+those fields search the api.py typeahead endpoints instead.
+
+Each list is stored along with the version of its table in the
+data_version table. Reading a list costs a single primary key lookup of
+that version, and the list itself is only queried again after the
+version changes.
+
+Versions are bumped by SQLAlchemy session events in the same transaction
+as the write, so every process, not just the one that wrote, sees a
+write as soon as it is committed. Writes that bypass the session events,
+such as bulk_insert_mappings or DBAPI executemany, must call invalidate
+themselves.
+"""
+from sqlalchemy import event
+
+import fragments
+from models import db, DataVersion, Entity
+
+# The model and label column of each cached choice list, keyed by table
+CHOICES = {
+    Entity.__tablename__: (Entity, Entity.name),
+}
+
+# Table name to a (version, choices) tuple
+_cache = {}
+
+
+class ChoiceList(list):
+    """
+    A list of choices that also has the name and version to cache its
+    rendered options under, see fragments.CachedSelect.
+    """
+    def __init__(self, choices, table_name, version):
+        super(ChoiceList, self).__init__(choices)
+        self.cache_key = ('choices:' + table_name, version)
+
+
+def get_version(table_name):
+    """
+    :return: The data version of the table, which changes whenever it is
+    written to.
+    """
+    return db.session.query(DataVersion.version).filter(DataVersion.table_name == table_name).scalar() or 0
+
+
+def get_choices(table_name):
+    """
+    :param table_name: One of the keys of CHOICES.
+    :return: A ChoiceList of (id, label) tuples for every row of the
+    table, ordered by label.
+    """
+    version = get_version(table_name)
+    cached = _cache.get(table_name)
+    if cached is None or cached[0] != version:
+        model, label = CHOICES[table_name]
+        cached = (version, [tuple(row) for row in db.session.query(model.id, label).order_by(label)])
+        _cache[table_name] = cached
+    return ChoiceList(cached[1], table_name, version)
+
+
+def clear_cache():
+    """
+    Empties this process's cache, e.g. after the tables were dropped and
+    their versions started over.
+    """
+    _cache.clear()
+    fragments.clear_cache()
+
+
+def invalidate(session, *table_names):
+    """
+    Bumps the version of each table in table_names that has a cached
+    choice list, as part of session's current transaction.
+    """
+    connection = session.connection()
+    table = DataVersion.__table__
+    for table_name in set(table_names) & set(CHOICES):
+        result = connection.execute(
+            table.update().where(table.c.table_name == table_name).values(version=table.c.version + 1))
+        if result.rowcount == 0:
+            connection.execute(table.insert().values(table_name=table_name, version=1))
+
+
+@event.listens_for(db.session, 'after_flush')
+def _invalidate_flushed(session, flush_context):
+    changed = list(session.new) + list(session.deleted) + [
+        instance for instance in session.dirty if session.is_modified(instance)]
+    table_names = set(getattr(instance, '__tablename__', None) for instance in changed)
+    if table_names & set(CHOICES):
+        invalidate(session, *table_names)
+
+
+@event.listens_for(db.session, 'do_orm_execute')
+def _invalidate_executed(orm_execute_state):
+    # Insert, update and delete statements run through the session,
+    # whether ORM enabled or on a Table
+    if orm_execute_state.is_insert or orm_execute_state.is_update or orm_execute_state.is_delete:
+        table = getattr(orm_execute_state.statement, 'table', None)
+        if table is not None and table.name in CHOICES:
+            invalidate(orm_execute_state.session, table.name)
+
+
+@event.listens_for(db.session, 'after_soft_rollback')
+def _discard_cache(session, previous_transaction):
+    # A list loaded inside a transaction that was rolled back may hold
+    # rows that were never committed, under a version another process can
+    # reach with different rows
+    clear_cache()
@@ -1,20 +1,61 @@
 #!/usr/bin/python
 # coding=utf-8
 
+import csv
 import datetime
+import io
+import json
+import os
+import subprocess
+import sys
+import tempfile
 import unittest
+from contextlib import contextmanager
+from unittest import mock
 
-from app import app
-from models import (db, Accession, Address, AmountUsed, Availability, Contact, Entity, GeoLocation, Release, SeedUse,
-                    Shipment, Species, Testing, Visit, Zone)
+from app import create_app
+from openpyxl import Workbook
+import pandas as pd
+from sqlalchemy import event, func, select
+from sqlalchemy.orm import Session
 
+from api import read_page, search
+from choices import clear_cache, get_choices
+from exports import export_query, iter_batches, write_xlsx
+import instrumentation
+import manage
+import metrics
+from forms import ReleaseForm, SynonymsForm
 
-def create_app():
-    app.config['TESTING'] = True
-    app.config['WTF_CSRF_ENABLED'] = False
-    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///test.db'
-    db.init_app(app)
-    return app
+from pls import update_est_pls_avail
+from populate_db import (Journal, Progress, SpeciesIndex, add_synonyms, bulk_import, get_plants, normalize_name,
+                         parse_excel)
+import workbooks
+from workbooks import iter_chunks, iter_rows, row_count
+from models import (db, recompute_availability, ACCESSION_PROFILES, Accession, Address, AmountUsed, Availability,
+                    Contact, DataVersion, Entity, GeoLocation, Release, SeedUse, Shipment, Species, Testing, Visit,
+                    Zone, migrate)
+
+
+app = create_app({'TESTING': True, 'WTF_CSRF_ENABLED': False, 'SQLALCHEMY_DATABASE_URI': 'sqlite:///test.db'})
+
+
+@contextmanager
+def count_queries():
+    """
+    :return: A context manager giving a list of the statements the
+    database runs inside it.
+    """
+    statements = []
+
+    def count(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(db.engine, 'before_cursor_execute', count)
+    try:
+        yield statements
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', count)
 
 
 class AccessionTests(unittest.TestCase):
@@ -211,6 +252,38 @@ class AccessionTests(unittest.TestCase):
         self.assertIn(self.accession1, accessions)
         self.assertIn(self.accession2, accessions)
 
+    def test_shipment_manifests(self):
+        db.session.add_all([self.entity1, self.entity2, self.plant1, self.synonym1, self.geo_location1, self.zone1,
+                            self.visit1, self.accession1])
+        spring = Shipment(order_date=datetime.datetime(2017, 3, 1), ship_date=datetime.datetime(2017, 3, 2, 15),
+                          tracking_num='40012345678', shipper='FedEx', origin_entity=self.entity1,
+                          destination_entity=self.entity2, amounts_sent=[
+                              AmountUsed(amount_gr=3.0, species=self.plant1, accession=self.accession1),
+                              AmountUsed(amount_gr=1.5, species=self.plant1, accession=self.accession1),
+                              AmountUsed(amount_gr=2.0, species=self.synonym1, accession=self.accession2)])
+        fall = Shipment(order_date=datetime.datetime(2017, 9, 1), ship_date=datetime.datetime(2017, 9, 30, 23),
+                        tracking_num='40012345679', shipper='UPS', origin_entity=self.entity2,
+                        destination_entity=self.entity1, amounts_sent=[
+                            AmountUsed(amount_gr=5.0, species=self.synonym1, accession=self.accession2)])
+        db.session.add_all([spring, fall])
+        db.session.commit()
+
+        with count_queries() as statements:
+            manifests = Shipment.manifests()
+        self.assertEqual(len(statements), 1)
+        self.assertEqual([(line.acc_num, line.name_full, line.amount_gr) for line in manifests[spring.id]],
+                         [(self.accession1.acc_num, 'Abutilon abutiloides', 4.5),
+                          (self.accession2.acc_num, 'Abutilon americanum', 2.0)])
+        self.assertAlmostEqual(manifests[spring.id][0].amount_lb, 4.5 * 0.00220462)
+        self.assertEqual([line.accession_id for line in fall.get_manifest()], [self.accession2.id])
+        self.assertEqual(spring.get_accessions(), [self.accession1, self.accession2])
+
+        self.assertEqual(list(Shipment.manifests_between(datetime.date(2017, 3, 2), datetime.date(2017, 9, 30))),
+                         [spring.id, fall.id])
+        self.assertEqual(list(Shipment.manifests_between(datetime.date(2017, 3, 3), datetime.date(2017, 9, 29))),
+                         [])
+        self.assertEqual(list(Shipment.manifests(Shipment.origin_entity == self.entity2)), [fall.id])
+
     def test_shipment_institute_relationship(self):
         db.session.add(self.entity1)
         db.session.add(self.entity2)
@@ -309,6 +382,30 @@ class AccessionTests(unittest.TestCase):
         self.assertEqual(self.accession1, avail.accession)
         self.assertEqual(avail, self.accession1.availability)
 
+    def test_availability_totals_follow_updates(self):
+        db.session.add_all([self.plant1, self.visit1, self.zone1, self.geo_location1, self.accession1])
+        avail = Availability(grin_avail=1.0, bend_avail=0, cbg_avail=None, meeker_avail=0, misc_avail=0,
+                             ephraim_avail=0, nau_avail=0, accession=self.accession1, misc_avail_ent=None)
+        db.session.add(avail)
+        db.session.commit()
+        self.assertFalse(avail.avail_no_grin)
+
+        avail.bend_avail = 4.0
+        db.session.commit()
+        self.assertEqual((avail.gr_avail, avail.sum_gr_no_grin), (5.0, 4.0))
+        self.assertTrue(avail.avail_no_grin)
+        self.assertAlmostEqual(avail.sum_lb_no_grin, 4.0 * 0.00220462)
+
+        # Written around the flush events, then fixed in bulk
+        db.session.execute(Availability.__table__.update().values(grin_avail=0, bend_avail=0))
+        db.session.commit()
+        self.assertEqual(avail.gr_avail, 5.0)
+        self.assertEqual(recompute_availability(), 1)
+        db.session.commit()
+        self.assertEqual((avail.gr_avail, avail.lb_avail, avail.sum_gr_no_grin), (0, 0, 0))
+        self.assertFalse(avail.avail_any)
+        self.assertFalse(avail.avail_no_grin)
+
     def test_availability_institution_relationship(self):
         db.session.add(self.plant1)
         db.session.add(self.visit1)
@@ -405,6 +502,965 @@ class AccessionTests(unittest.TestCase):
         self.assertEqual(self.plant1, rel.species)
         self.assertEqual(self.accession1, rel.accession)
 
+    def test_accession_profiles_load_in_constant_queries(self):
+        db.session.add(self.plant1)
+        db.session.commit()
+        rows = [export_row('UP-{}'.format(number), NAME=self.plant1.name_full) for number in range(1, 21)]
+        bulk_import([pd.DataFrame.from_records(rows)])
+        ids = [accession_id for accession_id, in db.session.query(Accession.id).order_by(Accession.id.desc())]
+
+        def load(ids, profile):
+            db.session.expunge_all()
+            with count_queries() as statements:
+                accessions = Accession.load(ids, profile)
+                for accession in accessions:
+                    for path in ACCESSION_PROFILES[profile]:
+                        value = accession
+                        for name in path.split('.'):
+                            value = getattr(value, name)
+            return accessions, len(statements)
+
+        for profile, queries in (('summary', 1), ('full', 4), ('shipping', 3)):
+            with self.subTest(profile):
+                accessions, few = load(ids[:2], profile)
+                self.assertEqual([accession.id for accession in accessions], ids[:2])
+                accessions, many = load(ids, profile)
+                self.assertEqual([accession.id for accession in accessions], ids)
+                self.assertEqual((few, many), (queries, queries))
+        self.assertEqual(accessions[0].tests[0].purity, 98)
+        self.assertEqual(accessions[0].species.name_full, 'Abutilon abutiloides')
+        self.assertEqual(Accession.load([]), [])
+
+
+class SpeciesIndexTests(unittest.TestCase):
+    def setUp(self):
+        db.create_all()
+        self.plant1 = Species(symbol='ABLAA', name_full='Abies lasiocarpa var. arizonica', common='corkbark fir',
+                              family='Pinaceae', genus='Abies', species='lasiocarpa', var_ssp1='var.',
+                              var_ssp2='arizonica', plant_type=None, plant_duration=None, priority_species=0,
+                              gsg_val=0, poll_val=0, research_val=0)
+        db.session.add(self.plant1)
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.plant1 = None
+
+    def test_normalize_name(self):
+        self.assertEqual(normalize_name('Abies lasiocarpa (Hook.) Nutt. var. arizonica (Merriam) Lemmon'),
+                         'abies lasiocarpa var. arizonica')
+        self.assertEqual(normalize_name('Abutilon  abutiloides (Jacq.) Garcke ex Hochr.'), 'abutilon abutiloides')
+
+    def test_index_lookups(self):
+        index = SpeciesIndex.load()
+        self.assertEqual(index.get_by_symbol('ABLAA'), self.plant1.id)
+        self.assertEqual(index.get_by_name('Abies lasiocarpa var. arizonica'), self.plant1.id)
+        self.assertEqual(index.get_by_name('Abies lasiocarpa (Hook.) Nutt. var. arizonica (Merriam) Lemmon'),
+                         self.plant1.id)
+        self.assertIsNone(index.get_by_name('Abies concolor'))
+        index.add(1000, 'ABCO', 'Abies concolor')
+        self.assertEqual(index.get_by_name('Abies concolor'), 1000)
+
+    def test_add_synonyms(self):
+        synonym = Species(symbol='ABAR', name_full='Abies arizonica', common=None, family='Pinaceae', genus='Abies',
+                          species='arizonica', var_ssp1=None, var_ssp2=None, plant_type=None, plant_duration=None,
+                          priority_species=0, gsg_val=0, poll_val=0, research_val=0)
+        other = Species(symbol='ABBI', name_full='Abies bifolia', common=None, family='Pinaceae', genus='Abies',
+                        species='bifolia', var_ssp1=None, var_ssp2=None, plant_type=None, plant_duration=None,
+                        priority_species=0, gsg_val=0, poll_val=0, research_val=0)
+        db.session.add(synonym)
+        db.session.add(other)
+        db.session.commit()
+        checklist = pd.DataFrame({'Symbol': ['ABLAA', 'ABLAA', 'ABBI', 'ABCO'],
+                                  'Synonym Symbol': [None, 'ABAR', None, 'ABXX']})
+        report = add_synonyms([checklist[:2], checklist[2:]])
+        self.assertEqual(report.linked, 1)
+        self.assertEqual(report.unresolved, [('ABXX', 'ABCO')])
+        self.assertEqual(report.conflicts, {})
+        self.assertEqual(synonym.usda_name, self.plant1)
+        self.assertIsNone(other.usda_name)
+
+        checklist = pd.DataFrame({'Symbol': ['ABLAA', 'ABAR'], 'Synonym Symbol': ['ABBI', 'ABBI']})
+        report = add_synonyms([checklist])
+        self.assertEqual(report.conflicts, {'ABBI': ['ABAR', 'ABLAA']})
+        self.assertIsNone(other.usda_name)
+
+    def test_get_plants(self):
+        def checklist(rows):
+            return pd.DataFrame.from_records(rows, columns=['Symbol', 'Synonym Symbol', 'Scientific Name with Author',
+                                                            'Common Name', 'Family'])
+
+        family_by_symbol = {}
+        first = get_plants(checklist([
+            ('ABIES', None, 'Abies Mill.', 'fir', 'Pinaceae'),
+            ('ABLA', None, 'Abies lasiocarpa (Hook.) Nutt.', 'subalpine fir', 'Pinaceae'),
+        ]), family_by_symbol)
+        self.assertEqual(first['symbol'].tolist(), ['ABLA'])
+        self.assertEqual(family_by_symbol, {'ABLA': 'Pinaceae'})
+
+        plants = get_plants(checklist([
+            ('ABLA', 'ABLAA', 'Abies lasiocarpa var. arizonica (Merriam) Lemmon', None, None),
+            ('ACMI2', None, 'Achillea millefolium var. occidentalis ssp. lanulosa (Nutt.) Piper', 'yarrow',
+             'Asteraceae'),
+            ('ABCO', None, 'Abies concolor var.', 'white fir', 'Pinaceae'),
+        ]), family_by_symbol)
+        plants = plants.set_index('symbol')
+
+        # The synonym takes its family from its accepted name in the
+        # earlier chunk
+        self.assertEqual(plants.loc['ABLAA', 'family'], 'Pinaceae')
+        self.assertEqual(plants.loc['ABLAA', 'name_full'], 'Abies lasiocarpa var. arizonica')
+        self.assertEqual(plants.loc['ACMI2', ['var_ssp1', 'var_ssp2', 'name_full']].tolist(),
+                         ['ssp.', 'lanulosa', 'Achillea millefolium ssp. lanulosa'])
+        # A trailing var. without a name is left out of the name
+        self.assertTrue(pd.isnull(plants.loc['ABCO', 'var_ssp2']))
+        self.assertEqual(plants.loc['ABCO', 'name_full'], 'Abies concolor')
+
+
+class ApiTests(unittest.TestCase):
+    def setUp(self):
+        app.config['WTF_CSRF_ENABLED'] = False
+        self.app = app.test_client()
+        db.create_all()
+        names = ['Abies lasiocarpa', 'Abies concolor', 'Abies bifolia', 'Pinus abiesii', 'Picea abies',
+                 'Achnatherum hymenoides']
+        for i, name in enumerate(names):
+            db.session.add(Species(symbol='SP{}'.format(i), name_full=name, common=None, family=None,
+                                   genus=name.split()[0], species=name.split()[1], var_ssp1=None, var_ssp2=None,
+                                   plant_type=None, plant_duration=None, priority_species=0, gsg_val=0, poll_val=0,
+                                   research_val=0))
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        app.config['WTF_CSRF_ENABLED'] = True
+
+    def test_prefix_matches_come_first(self):
+        results, more = search('species', 'ABIES')
+        self.assertEqual([label for _, label in results],
+                         ['Abies bifolia', 'Abies concolor', 'Abies lasiocarpa', 'Picea abies', 'Pinus abiesii'])
+        self.assertFalse(more)
+
+    def test_pagination_across_prefix_and_substring_matches(self):
+        pages = [search('species', 'abies', page, per_page=2) for page in (1, 2, 3)]
+        self.assertEqual([[label for _, label in results] for results, _ in pages],
+                         [['Abies bifolia', 'Abies concolor'], ['Abies lasiocarpa', 'Picea abies'],
+                          ['Pinus abiesii']])
+        self.assertEqual([more for _, more in pages], [True, True, False])
+
+    def test_typeahead_endpoint(self):
+        response = self.app.get('/api/species?q=ach')
+        self.assertEqual(response.status_code, 200)
+        species = Species.query.filter_by(name_full='Achnatherum hymenoides').one()
+        self.assertEqual(response.get_json(), {'results': [{'id': species.id, 'text': species.name_full}],
+                                               'more': False})
+        self.assertEqual(self.app.get('/api/species?q=100%').get_json()['results'], [])
+
+    def test_synonym_form_uses_submitted_species_only(self):
+        response = self.app.get('/synonyms')
+        self.assertNotIn(b'Abies concolor', response.data)
+        self.assertIn(b'data-typeahead="species"', response.data)
+
+        plant = Species.query.filter_by(name_full='Abies concolor').one()
+        synonym = Species.query.filter_by(name_full='Abies bifolia').one()
+        response = self.app.post('/synonyms', data={'species': plant.id, 'synonym': synonym.id})
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(synonym.usda_name, plant)
+
+    def test_lookup_fields_validate_with_one_query_each(self):
+        plant = Species.query.filter_by(name_full='Abies concolor').one()
+        synonym = Species.query.filter_by(name_full='Abies bifolia').one()
+        with count_queries() as statements, app.test_request_context(
+                method='POST', data={'species': plant.id, 'synonym': synonym.id}):
+            self.assertTrue(SynonymsForm().validate())
+        self.assertEqual(len(statements), 2)
+
+    def test_lookup_fields_reject_missing_rows(self):
+        plant = Species.query.filter_by(name_full='Abies concolor').one()
+        with app.test_request_context(method='POST', data={'species': plant.id, 'synonym': 12345}):
+            form = SynonymsForm()
+            self.assertFalse(form.validate())
+            self.assertEqual(list(form.errors), ['synonym'])
+        with app.test_request_context(method='POST', data={'species': plant.id, 'accession': ''}):
+            form = ReleaseForm()
+            form.validate()
+            self.assertNotIn('species', form.errors)
+            self.assertNotIn('accession', form.errors)
+            self.assertIsNone(form.accession.data)
+
+    def test_read_pages_follow_the_cursor(self):
+        ids = [species.id for species in Species.query.order_by(Species.id)]
+        names, first, cursor = read_page('species', ['name_full'], limit=4)
+        self.assertEqual(names, ['id', 'name_full'])
+        self.assertEqual([row[0] for row in first], ids[:4])
+        self.assertEqual(cursor, ids[3])
+        _, last, cursor = read_page('species', ['name_full'], after=cursor, limit=4)
+        self.assertEqual([row[0] for row in last], ids[4:])
+        self.assertIsNone(cursor)
+
+    def test_read_endpoint(self):
+        db.session.add(Shipment(datetime.datetime(2017, 5, 1), None, '1Z999', 'UPS', None, None, []))
+        db.session.commit()
+        response = self.app.get('/api/rows/shipments?fields=order_date,shipper,ship_date')
+        self.assertEqual(response.get_json(), {'columns': ['id', 'order_date', 'shipper', 'ship_date'],
+                                               'rows': [[1, '2017-05-01T00:00:00', 'UPS', None]], 'next': None})
+        self.assertEqual(self.app.get('/api/rows/accessions?fields=import_hash').status_code, 400)
+        self.assertEqual(self.app.get('/api/rows/contacts').status_code, 404)
+
+    def test_batch_reports_each_row(self):
+        rows = [
+            {'species': 'abies CONCOLOR', 'acc_num': 'UP-12-3', 'coll_date': '2017-06-01', 'collected_with': 'AU',
+             'altitude': 7100},
+            {'species': 'Abies nonesuch', 'acc_num': 'UP-13', 'coll_date': 'June', 'collected_with': 'AU'},
+            {'species': 'Abies concolor', 'acc_num': 'UP-12-3', 'coll_date': '2017-06-02', 'collected_with': ''},
+        ]
+        response = self.app.post('/api/accessions/batch', json=rows)
+        self.assertEqual(response.status_code, 200)
+        report = response.get_json()
+        self.assertEqual((report['created'], report['failed']), (1, 2))
+        self.assertEqual(report['rows'][1]['errors'], {'coll_date': ['Not a valid datetime.'],
+                                                       'species': ['Unknown species.']})
+        self.assertEqual(report['rows'][2]['errors'], {'acc_num': ['Repeated in the batch.'],
+                                                       'collected_with': ['This field is required.']})
+
+        accession = db.session.get(Accession, report['rows'][0]['id'])
+        self.assertEqual((accession.acc_num1, accession.acc_num2, accession.acc_num3), ('UP', '12', '3'))
+        self.assertEqual(accession.species.name_full, 'Abies concolor')
+        self.assertEqual(accession.coll_date, datetime.datetime(2017, 6, 1))
+        location = accession.geo_location
+        self.assertEqual((location.altitude_unit, location.altitude_in_m), ('ft', 2164))
+        self.assertEqual(location.visits[0].accession_id, accession.id)
+
+    def test_batch_reports_species_that_are_not_names(self):
+        rows = [{'species': 5, 'acc_num': 'UP-14', 'coll_date': '2017-06-01', 'collected_with': 'AU'}]
+        response = self.app.post('/api/accessions/batch', json=rows)
+        self.assertEqual(response.status_code, 200)
+        report = response.get_json()
+        self.assertEqual((report['created'], report['failed']), (0, 1))
+        self.assertEqual(report['rows'][0]['errors'], {'species': ['Unknown species.']})
+
+    def test_batch_csv(self):
+        data = (b'species,acc_num,coll_date,collected_with,altitude,altitude_unit,latitude_decimal,cp_buff\n'
+                b'Picea abies,UP-1,2017-06-01,AU,2100,m,38.5,1\n'
+                b'Picea abies,UP-2,2017-06-01,AU,,,,\n')
+        report = self.app.post('/api/accessions/batch', data=data, content_type='text/csv').get_json()
+        self.assertEqual(report['created'], 2)
+        first, second = [db.session.get(Accession, row['id']) for row in report['rows']]
+        self.assertEqual((first.geo_location.altitude_in_m, first.geo_location.degrees_n,
+                          first.geo_location.minutes_n), (2100, 38, 30))
+        self.assertTrue(first.geo_location.zone.cp_buff)
+        self.assertIsNone(second.geo_location.altitude_unit)
+        self.assertIsNone(second.acc_num3)
+
+        report = self.app.post('/api/accessions/batch', data=data, content_type='text/csv').get_json()
+        self.assertEqual(report['created'], 0)
+        self.assertEqual(report['rows'][0]['errors'], {'acc_num': ['Already in the database.']})
+        response = self.app.post('/api/accessions/batch', data=b'species,colour\nPicea abies,red\n',
+                                 content_type='text/csv')
+        self.assertEqual(response.status_code, 400)
+
+
+class InstrumentationTests(unittest.TestCase):
+    def setUp(self):
+        app.config['SQL_INSTRUMENTATION'] = True
+        self.app = app.test_client()
+        db.create_all()
+        for i in range(4):
+            db.session.add(Entity(name='Entity {}'.format(i), entity_phone=None, entity_phone_ext=None,
+                                  entity_email=None, request_costs=False, cost=None, address=None))
+        db.session.commit()
+        db.session.remove()
+
+    def tearDown(self):
+        app.config['SQL_INSTRUMENTATION'] = False
+        db.session.remove()
+        db.drop_all()
+
+    def test_response_headers(self):
+        response = self.app.get('/api/entities?q=ent')
+        # The prefix matches, then the substring matches that fill the page
+        self.assertEqual(response.headers['X-SQL-Queries'], '2')
+        self.assertGreater(float(response.headers['X-SQL-Time']), 0)
+        self.assertEqual(response.headers['X-SQL-Repeated'], '0')
+        self.assertIn('db;dur=', response.headers['Server-Timing'])
+
+        app.config['SQL_INSTRUMENTATION'] = False
+        self.assertNotIn('X-SQL-Queries', self.app.get('/api/entities?q=ent').headers)
+
+    def test_repeated_statements_are_logged(self):
+        with app.test_request_context('/entities'):
+            instrumentation.start_request()
+            for entity_id in range(1, 5):
+                db.session.get(Entity, entity_id)
+            with self.assertLogs(instrumentation.logger) as logs:
+                response = instrumentation.finish_request(app.response_class())
+        self.assertEqual(response.headers['X-SQL-Queries'], '4')
+        self.assertEqual(response.headers['X-SQL-Repeated'], '1')
+        line = json.loads(logs.records[0].getMessage())
+        self.assertEqual((line['path'], line['queries']), ('/entities', 4))
+        self.assertEqual(line['repeated'][0]['count'], 4)
+        self.assertIn('FROM entity', line['repeated'][0]['statement'])
+        self.assertEqual(len(line['slowest']), instrumentation.SLOWEST)
+
+
+@unittest.skipIf(metrics.prometheus_client is None, 'prometheus_client is not installed')
+class MetricsTests(unittest.TestCase):
+    def setUp(self):
+        self.app = app.test_client()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+
+    def sample(self, name, **labels):
+        return metrics.prometheus_client.REGISTRY.get_sample_value(name, labels) or 0
+
+    def test_request_metrics(self):
+        before = self.sample('cpnpp_http_requests_total', method='GET', route='/api/rows/<resource>', status='200')
+        self.app.get('/api/rows/species')
+        self.app.get('/api/rows/accessions')
+        self.assertEqual(self.sample('cpnpp_http_requests_total', method='GET', route='/api/rows/<resource>',
+                                     status='200'), before + 2)
+        self.assertGreater(self.sample('cpnpp_http_request_duration_seconds_count', method='GET',
+                                       route='/api/rows/<resource>'), 0)
+        self.assertGreater(self.sample('cpnpp_db_pool_checkout_seconds_count'), 0)
+
+        response = self.app.get('/metrics')
+        self.assertTrue(response.content_type.startswith('text/plain'))
+        self.assertIn(b'cpnpp_http_requests_total{method="GET",route="/api/rows/<resource>",status="200"}',
+                      response.data)
+
+    def test_import_throughput(self):
+        before = self.sample('cpnpp_import_rows_total', stage='species')
+        progress = Progress('species', interval=60)
+        progress.update(500)
+        progress.update(250)
+        self.assertEqual(self.sample('cpnpp_import_rows_total', stage='species'), before + 750)
+
+
+class StartupTests(unittest.TestCase):
+    def test_worker_does_not_import_lazy_modules(self):
+        script = 'import sys, wsgi; print(" ".join(name for name in {} if name in sys.modules))'.format(
+            manage.LAZY_MODULES)
+        output = subprocess.run([sys.executable, '-c', script], check=True, capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout
+        self.assertEqual(output.split(), [])
+
+    def test_missing_metrics_are_logged(self):
+        with mock.patch.object(metrics, 'prometheus_client', None), self.assertLogs(app.logger, 'WARNING') as logs:
+            uninstrumented = create_app({'TESTING': True})
+        self.assertIn('prometheus_client is not installed', logs.output[0])
+        self.assertNotIn('metrics', uninstrumented.view_functions)
+
+
+class ChoicesTests(unittest.TestCase):
+    def setUp(self):
+        self.app = app.test_client()
+        db.create_all()
+        clear_cache()
+        db.session.add(Entity(name='Bend', entity_phone=None, entity_phone_ext=None, entity_email=None,
+                              request_costs=False, cost=None, address=None))
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+
+    def insert_entity_unseen(self, name):
+        # Like a write that skips the session events, or one from another
+        # process before its version bump
+        db.session.connection().exec_driver_sql("INSERT INTO entity (name) VALUES ('{}')".format(name))
+        db.session.commit()
+
+    def test_choices_are_cached(self):
+        self.assertEqual([label for _, label in get_choices('entity')], ['Bend'])
+        self.insert_entity_unseen('Ephraim')
+        self.assertEqual([label for _, label in get_choices('entity')], ['Bend'])
+
+    def test_session_writes_invalidate(self):
+        self.assertEqual([label for _, label in get_choices('entity')], ['Bend'])
+        entity = Entity(name='Meeker', entity_phone=None, entity_phone_ext=None, entity_email=None,
+                        request_costs=False, cost=None, address=None)
+        db.session.add(entity)
+        db.session.commit()
+        self.assertEqual([label for _, label in get_choices('entity')], ['Bend', 'Meeker'])
+
+        entity.name = 'Chicago Botanic Garden'
+        db.session.commit()
+        self.assertEqual([label for _, label in get_choices('entity')], ['Bend', 'Chicago Botanic Garden'])
+
+        Entity.query.filter_by(name='Bend').delete()
+        db.session.commit()
+        self.assertEqual([label for _, label in get_choices('entity')], ['Chicago Botanic Garden'])
+
+    def test_version_bump_from_another_process(self):
+        self.assertEqual([label for _, label in get_choices('entity')], ['Bend'])
+        self.insert_entity_unseen('Ephraim')
+        db.session.merge(DataVersion(table_name='entity', version=100))
+        db.session.commit()
+        self.assertEqual([label for _, label in get_choices('entity')], ['Bend', 'Ephraim'])
+
+    def test_rolled_back_writes_are_not_cached(self):
+        db.session.add(Entity(name='Meeker', entity_phone=None, entity_phone_ext=None, entity_email=None,
+                              request_costs=False, cost=None, address=None))
+        db.session.flush()
+        self.assertEqual([label for _, label in get_choices('entity')], ['Bend', 'Meeker'])
+        db.session.rollback()
+        self.assertEqual([label for _, label in get_choices('entity')], ['Bend'])
+
+    def test_rendered_options_are_cached(self):
+        data = self.app.get('/availability').data
+        self.assertIn(b'>Bend</option>', data)
+        self.assertRegex(data, rb'<select [^>]*id="misc_inst_id"[^>]*>(<option[^>]*>[^<]*</option>)*</select>')
+        self.insert_entity_unseen('Ephraim')
+        # Every page listing entities shares the cached options
+        for page in ('/availability', '/shipments', '/testing'):
+            self.assertNotIn(b'>Ephraim</option>', self.app.get(page).data)
+
+        db.session.add(Entity(name='Meeker', entity_phone=None, entity_phone_ext=None, entity_email=None,
+                              request_costs=False, cost=None, address=None))
+        db.session.commit()
+        data = self.app.get('/shipments').data
+        self.assertEqual(data.count(b'>Ephraim</option>'), 2)
+        self.assertEqual(data.count(b'>Meeker</option>'), 2)
+
+    def test_cached_options_mark_the_selection(self):
+        app.config['WTF_CSRF_ENABLED'] = False
+        self.app.get('/testing')
+        entity = Entity.query.filter_by(name='Bend').one()
+        data = self.app.post('/testing', data={'entity': entity.id}).data
+        self.assertIn('<option selected value="{}">Bend</option></select>'.format(entity.id).encode(), data)
+        self.assertNotIn(b'selected', self.app.get('/testing').data)
+
+    def test_forms_list_entities_and_search_accessions(self):
+        entity = Entity.query.filter_by(name='Bend').one()
+        for page in ('/availability', '/shipments', '/testing'):
+            with self.subTest(page):
+                data = self.app.get(page).data
+                self.assertRegex(data, rb'<select [^>]*data-typeahead="accessions"[^>]*id="accession"[^>]*></select>')
+                self.assertIn('<option value="{}">Bend</option>'.format(entity.id).encode(), data)
+                self.assertNotIn(b'data-typeahead="entities"', data)
+
+    def test_compiled_templates_are_kept(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cached_app = create_app({'TESTING': True, 'TEMPLATE_CACHE_DIR': cache_dir})
+            with cached_app.app_context():
+                cached_app.test_client().get('/')
+            self.assertTrue(os.listdir(cache_dir))
+
+
+def export_row(acc_num, **values):
+    """
+    Builds a row of the accession export for acc_num, with any column
+    overridden by values.
+    """
+    row = {
+        'DATA_SOURCE': 'UP', 'Habit_rev': 'Forb/herb', 'COLL_DT': datetime.datetime(2004, 8, 24), 'ACC_NUM': acc_num,
+        'ACC_NUM_1': acc_num.split('-')[0], 'ACC_NUM_2': acc_num.split('-')[1], 'ACC_NUM_3': None,
+        'COLLECTED_WITH': 'GVR, CH, SP', 'COLLECTION_MISC': None, 'OCCUPANCY': 300, 'SEED_SOURCE': 'P',
+        'DESCRIPTION': 'Height: 0.15-0.45 m', 'notes': None, 'NAME': 'Abies lasiocarpa var. arizonica',
+        'LAND_OWNER': 'BLM', 'GEOLOGY': None, 'SOIL_TYPE': 'brown-tan sand', 'PHYTOREGION': '25E',
+        'PHYTOREGION_FULL': 'Western High Plains (Omernik)', 'SUB_CNT3': None, 'GEOG_AREA': None, 'LOCALITY': None,
+        'LATITUDE_DECIMAL': 38.33786, 'LONGITUDE_DECIMAL': -107.8999, 'GEOREF_SOURCE': 'GPS', 'GPS_DATUM': 'NAD83',
+        'ALTITUDE': 7100, 'ALTITUDE_UNIT': 'ft', 'ALTITUDE_IN_M': 2164, 'ADMU_NAME': 'UNCOMPAHGRE FIELD OFFICE',
+        'PARENT_NAM': 'SOUTHWEST DISTRICT OFFICE', 'ADMIN_ST': 'CO', 'SUB_CNT2': 'Montrose',
+        'ASSOCIATED_TAXA_FULL': None, 'USER2': 'grazed', 'USER1': None, 'SLOPE': '5-25 degrees', 'ASPECT': 'varied',
+        'HABITAT': None, 'POPULATION_SIZE': 200, 'AMOUNT_RECVD__LBS_': 0.78, 'CLEAN_WEIGHT__LBS_': 0.52,
+        'SEED_LB': 351627, 'EST_PLS_LB': 297054.49, 'EST_PLS_COLLECTED': 5346.98, 'TEST_TYPE': 'XPC',
+        'TEST_DATE': datetime.datetime(2003, 3, 12), 'PURITY_': 98, 'TZ_': 60, 'FILL_': 90,
+        'Pot_STZ': '10 - 15 Deg. F./6 - 12', 'US_L4CODE': '20c', 'US_L4NAME': 'Semiarid Benchlands and Canyonlands',
+        'US_L3CODE': '20', 'US_L3NAME': 'Colorado Plateaus', 'ACHY_SZ_GRIDCODE': 11, 'ACHY_SZ_ZONE': 'L1L2H3',
+        'CPBuff': 1, 'CPStrict': 1, 'AVAIL_BUFF': 1, 'AVAIL_STRICT': 0, 'USGS_ZONE': 0,
+    }
+    row.update(values)
+    return row
+
+
+def write_workbook(path, header, rows):
+    """
+    Saves a one sheet workbook with the header and rows at path.
+    """
+    workbook = Workbook()
+    worksheet = workbook.active
+    worksheet.append(header)
+    for row in rows:
+        worksheet.append(row)
+    workbook.save(path)
+
+
+class WorkbookTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'export.xlsx')
+        self.cache_dir = mock.patch.object(workbooks, 'CACHE_DIR', os.path.join(self.directory.name, 'cache'))
+        self.cache_dir.start()
+
+    def tearDown(self):
+        self.cache_dir.stop()
+        self.directory.cleanup()
+
+    def test_blank_rows_are_skipped(self):
+        write_workbook(self.path, ['ACC_NUM', 'OCCUPANCY'], [['UP-1', 10], [None, None], ['UP-2', None]])
+        self.assertEqual(list(iter_rows(self.path, use_cache=False)),
+                         [{'ACC_NUM': 'UP-1', 'OCCUPANCY': 10}, {'ACC_NUM': 'UP-2', 'OCCUPANCY': None}])
+        # The sheet's dimensions count the blank row, the cache doesn't
+        self.assertEqual(row_count(self.path), 3)
+        self.assertEqual([row['ACC_NUM'] for row in iter_rows(self.path)], ['UP-1', 'UP-2'])
+        self.assertEqual(row_count(self.path), 2)
+
+    def test_chunk_boundaries(self):
+        for rows, sizes in ((4, [4]), (5, [4, 1]), (8, [4, 4])):
+            with self.subTest(rows=rows):
+                write_workbook(self.path, ['ACC_NUM'], [['UP-{}'.format(i)] for i in range(rows)])
+                chunks = list(iter_chunks(self.path, chunk_size=4, use_cache=False))
+                self.assertEqual([len(chunk) for chunk in chunks], sizes)
+                self.assertEqual(pd.concat(chunks)['ACC_NUM'].tolist(), ['UP-{}'.format(i) for i in range(rows)])
+
+    def test_abandoned_generator_closes_the_workbook(self):
+        write_workbook(self.path, ['ACC_NUM'], [['UP-{}'.format(i)] for i in range(10)])
+        opened = []
+        load_workbook = workbooks.load_workbook
+
+        def load(*args, **kwargs):
+            opened.append(load_workbook(*args, **kwargs))
+            return opened[-1]
+
+        with mock.patch('workbooks.load_workbook', load):
+            for read in (lambda: iter_rows(self.path, use_cache=False),
+                         lambda: iter_chunks(self.path, chunk_size=4, use_cache=False),
+                         lambda: iter_chunks(self.path, chunk_size=4)):
+                rows = read()
+                next(rows)
+                rows.close()
+                # A closed read-only workbook has released its zip file
+                self.assertIsNone(opened[-1]._archive.fp)
+        self.assertEqual(len(opened), 3)
+
+    def test_cache_is_used_until_the_content_changes(self):
+        write_workbook(self.path, ['ACC_NUM'], [['UP-1'], ['UP-2']])
+        self.assertEqual([row['ACC_NUM'] for row in iter_rows(self.path)], ['UP-1', 'UP-2'])
+
+        with mock.patch('workbooks.load_workbook', side_effect=AssertionError('workbook parsed')):
+            # Unchanged, or touched without changing its content
+            self.assertEqual([row['ACC_NUM'] for row in iter_rows(self.path)], ['UP-1', 'UP-2'])
+            stat = os.stat(self.path)
+            os.utime(self.path, (stat.st_atime, stat.st_mtime + 10))
+            self.assertEqual([row['ACC_NUM'] for row in iter_rows(self.path)], ['UP-1', 'UP-2'])
+            self.assertEqual(workbooks._read_meta(self.path, None)['mtime'], stat.st_mtime + 10)
+
+        write_workbook(self.path, ['ACC_NUM'], [['UP-3']])
+        self.assertIsNone(workbooks.fresh_cache_file(self.path))
+        self.assertEqual([row['ACC_NUM'] for row in iter_rows(self.path)], ['UP-3'])
+
+    def test_cache_is_kept_per_sheet_and_workbook(self):
+        workbook = Workbook()
+        workbook.active.title = 'A'
+        workbook.active.append(['ACC_NUM'])
+        workbook.active.append(['UP-1'])
+        workbook.create_sheet('B').append(['ACC_NUM'])
+        workbook['B'].append(['UP-2'])
+        workbook.save(self.path)
+        for sheet, acc_num in (('A', 'UP-1'), ('B', 'UP-2'), ('A', 'UP-1'), ('B', 'UP-2')):
+            self.assertEqual([row['ACC_NUM'] for row in iter_rows(self.path, sheet=sheet)], [acc_num])
+
+        # A workbook of the same name in another folder
+        other = os.path.join(self.directory.name, 'other', 'export.xlsx')
+        os.makedirs(os.path.dirname(other))
+        write_workbook(other, ['ACC_NUM'], [['UP-3']])
+        write_workbook(self.path, ['ACC_NUM'], [['UP-4']])
+        for path, acc_num in ((other, 'UP-3'), (self.path, 'UP-4'), (other, 'UP-3')):
+            self.assertEqual([row['ACC_NUM'] for row in iter_rows(path)], [acc_num])
+            self.assertIsNotNone(workbooks.fresh_cache_file(path))
+
+    def test_cache_widens_types_of_later_chunks(self):
+        # AMT_RCVD_LBS holds whole numbers until the last chunk, and TZ is
+        # empty in the first
+        write_workbook(self.path, ['ACC_NUM', 'AMT_RCVD_LBS', 'TZ'],
+                       [['UP-1', 1, None], ['UP-2', 2, None], ['UP-3', 7100.5, 85]])
+        first = list(iter_chunks(self.path, chunk_size=2))
+        self.assertIsNotNone(workbooks.fresh_cache_file(self.path))
+        cached = list(iter_chunks(self.path, chunk_size=2))
+
+        for chunks in (first, cached):
+            frame = pd.concat(chunks)
+            self.assertEqual(frame['AMT_RCVD_LBS'].tolist(), [1, 2, 7100.5])
+            self.assertEqual(frame['TZ'].tolist()[2], 85)
+        self.assertEqual([chunk.dtypes.tolist() for chunk in first], [chunk.dtypes.tolist() for chunk in cached])
+        self.assertEqual(first[0]['AMT_RCVD_LBS'].dtype, float)
+
+
+class ImportTests(unittest.TestCase):
+    def setUp(self):
+        db.create_all()
+        self.plant1 = Species(symbol='ABLAA', name_full='Abies lasiocarpa var. arizonica', common='corkbark fir',
+                              family='Pinaceae', genus='Abies', species='lasiocarpa', var_ssp1='var.',
+                              var_ssp2='arizonica', plant_type=None, plant_duration=None, priority_species=0,
+                              gsg_val=0, poll_val=0, research_val=0)
+        db.session.add(self.plant1)
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.plant1 = None
+
+    def test_batch_rejects_duplicates(self):
+        rows = [export_row('UP-76'), export_row('UP-77'), export_row('UP-76'), export_row('UP-78')]
+        report = parse_excel(rows, batch_size=3, workers=1)
+        self.assertEqual(report.inserted, 3)
+        self.assertEqual(report.rejected, ['UP-76'])
+        accession = Accession.query.filter_by(acc_num='UP-77').one()
+        self.assertEqual(accession.species, self.plant1)
+        self.assertEqual(accession.geo_location.zone.us_l4_code, '20c')
+        self.assertEqual(accession.tests[0].purity, 98)
+
+    def test_import_does_not_depend_on_workers(self):
+        rows = [export_row('UP-{}'.format(i), PURITY_=i) for i in range(70, 77)] + [export_row('UP-72')]
+        imported = []
+        for workers in (1, 3):
+            db.session.remove()
+            db.drop_all()
+            self.setUp()
+            report = parse_excel(rows, batch_size=2, workers=workers)
+            self.assertEqual(report.rejected, ['UP-72'])
+            imported.append([(accession.id, accession.acc_num, accession.geo_location_id,
+                              [(test.id, test.purity) for test in accession.tests])
+                             for accession in Accession.query.order_by(Accession.id)])
+        self.assertEqual(imported[0], imported[1])
+        self.assertEqual([accession[1] for accession in imported[0]], ['UP-{}'.format(i) for i in range(70, 77)])
+
+    def test_incremental_import(self):
+        rows = [export_row('UP-76'), export_row('UP-77')]
+        parse_excel(rows, workers=1)
+        report = parse_excel(rows, workers=1, incremental=True)
+        self.assertEqual((report.inserted, report.updated, report.unchanged), (0, 0, 2))
+
+        rows = [export_row('UP-76', PURITY_=50, LAND_OWNER='USFS'), export_row('UP-77'), export_row('UP-78')]
+        report = parse_excel(rows, workers=1, incremental=True)
+        self.assertEqual((report.inserted, report.updated, report.unchanged), (1, 1, 1))
+        accession = Accession.query.filter_by(acc_num='UP-76').one()
+        self.assertEqual(accession.tests[0].purity, 50)
+        self.assertEqual(accession.geo_location.land_owner, 'USFS')
+        self.assertEqual(Accession.query.count(), 3)
+
+    def test_migrate_upgrades_an_older_database(self):
+        parse_excel([export_row('UP-76'), export_row('UP-77')], workers=1)
+        accession = Accession.query.filter_by(acc_num='UP-76').one()
+        db.session.add(Testing(amt_rcvd_lbs=None, clean_wt_lbs=None, est_seed_lb=None, est_pls_lb=None,
+                               est_pls_collected=None, test_type='Retest', test_date=None, purity=70, tz=None,
+                               fill=None, accession=accession, entity=None))
+        db.session.commit()
+        # As created by the models before these columns were added
+        connection = db.session.connection()
+        connection.exec_driver_sql('ALTER TABLE accession DROP COLUMN import_hash')
+        connection.exec_driver_sql('ALTER TABLE test DROP COLUMN imported')
+        db.session.commit()
+        db.session.remove()
+
+        migrate()
+        self.assertEqual(Accession.query.count(), 2)
+        self.assertEqual([(test.purity, test.imported) for test in Testing.query.order_by(Testing.id)],
+                         [(98, True), (98, True), (70, None)])
+        self.assertEqual(app.test_client().get('/api/rows/tests').status_code, 200)
+        migrate()
+
+    def test_incremental_import_only_overwrites_imported_rows(self):
+        parse_excel([export_row('UP-76'), export_row('UP-77')], workers=1)
+        accession = Accession.query.filter_by(acc_num='UP-76').one()
+        retest = Testing(amt_rcvd_lbs=None, clean_wt_lbs=None, est_seed_lb=None, est_pls_lb=None,
+                         est_pls_collected=None, test_type='Retest', test_date=None, purity=70, tz=None, fill=None,
+                         accession=accession, entity=None)
+        db.session.add(retest)
+        other = Accession.query.filter_by(acc_num='UP-77').one()
+        db.session.delete(other.tests[0])
+        db.session.delete(other.geo_location.zone)
+        Visit.query.filter_by(accession_id=other.id).delete()
+        db.session.commit()
+
+        report = parse_excel([export_row('UP-76', PURITY_=50), export_row('UP-77', PURITY_=60)], workers=1,
+                             incremental=True)
+        self.assertEqual(report.updated, 2)
+        self.assertEqual(sorted((test.test_type, test.purity) for test in accession.tests),
+                         [('Retest', 70), ('XPC', 50)])
+        self.assertEqual([test.purity for test in other.tests], [60])
+        self.assertTrue(other.tests[0].imported)
+        self.assertEqual(other.geo_location.zone.us_l4_code, '20c')
+        self.assertEqual(Visit.query.filter_by(accession_id=other.id).count(), 1)
+
+    def test_bulk_import(self):
+        parse_excel([export_row('UP-76')], workers=1)
+        availability = {'GRIN_AVAIL': 10.0, 'BEND_AVAIL': 5.0, 'CBG_AVAIL': None, 'MEEKER_AVAIL': 0.0,
+                        'MISC_AVAIL': 0.0, 'EPHRAIM_AVAIL': 2.5, 'NAU_AVAIL': 0.0}
+        rows = [export_row('UP-76', **availability), export_row('UP-77', **availability),
+                export_row('UP-77', **availability), export_row('UP-78', LATITUDE_DECIMAL=None, **availability)]
+        report = bulk_import([pd.DataFrame.from_records(rows)])
+        self.assertEqual((report.inserted, report.rejected), (2, ['UP-76', 'UP-77']))
+
+        accession = Accession.query.filter_by(acc_num='UP-77').one()
+        self.assertEqual(accession.species, self.plant1)
+        self.assertEqual(accession.coll_date, datetime.datetime(2004, 8, 24))
+        self.assertEqual(accession.geo_location.zone.us_l4_code, '20c')
+        self.assertEqual(accession.geo_location.visits[0].species, self.plant1)
+        self.assertEqual(accession.tests[0].purity, 98)
+        location = accession.geo_location
+        self.assertEqual((location.degrees_n, location.minutes_n, location.degrees_w, location.minutes_w),
+                         (38, 20, -107, -53))
+        self.assertAlmostEqual(location.seconds_n, 16.296, places=3)
+        self.assertEqual(accession.availability.gr_avail, 17.5)
+        self.assertEqual(accession.availability.sum_gr_no_grin, 7.5)
+        self.assertTrue(accession.availability.avail_no_grin)
+        self.assertAlmostEqual(accession.availability.lb_avail, 17.5 * 0.00220462)
+        self.assertIsNone(Accession.query.filter_by(acc_num='UP-78').one().geo_location.degrees_n)
+
+    def test_bulk_import_unknown_species(self):
+        report = bulk_import([pd.DataFrame.from_records([export_row('UP-76', NAME='Abies nonesuch')])])
+        self.assertEqual(report.inserted, 1)
+        self.assertIsNone(Accession.query.filter_by(acc_num='UP-76').one().species_id)
+
+    def test_est_pls_avail_from_latest_test(self):
+        availability = {'GRIN_AVAIL': 0.0, 'BEND_AVAIL': 453.592, 'CBG_AVAIL': None, 'MEEKER_AVAIL': 0.0,
+                        'MISC_AVAIL': 0.0, 'EPHRAIM_AVAIL': 0.0, 'NAU_AVAIL': 0.0}
+        rows = [export_row('UP-76', **availability), export_row('UP-77', EST_PLS_LB=None, **availability),
+                export_row('UP-78', EST_PLS_LB=None, SEED_LB=None, **availability), export_row('UP-79')]
+        bulk_import([pd.DataFrame.from_records(rows)])
+        # Already computed by the import
+        self.assertEqual(update_est_pls_avail(), (0, 4))
+
+        def est_pls_avail(acc_num):
+            return Accession.query.filter_by(acc_num=acc_num).one().availability.est_pls_avail
+
+        lb_avail = 453.592 * 0.00220462
+        self.assertAlmostEqual(est_pls_avail('UP-76'), lb_avail * 297054.49)
+        self.assertAlmostEqual(est_pls_avail('UP-77'), lb_avail * 351627 * 0.98 * 0.6)
+        self.assertIsNone(est_pls_avail('UP-78'))
+        self.assertEqual(est_pls_avail('UP-79'), 0)
+
+        accession = Accession.query.filter_by(acc_num='UP-78').one()
+        db.session.add_all([
+            Testing(amt_rcvd_lbs=None, clean_wt_lbs=None, est_seed_lb=None, est_pls_lb=1000.0, est_pls_collected=None,
+                    test_type='XPC', test_date=datetime.datetime(2005, 1, 1), purity=None, tz=None, fill=None,
+                    accession=accession, entity=None),
+            Testing(amt_rcvd_lbs=None, clean_wt_lbs=None, est_seed_lb=None, est_pls_lb=2000.0, est_pls_collected=None,
+                    test_type='XPC', test_date=None, purity=None, tz=None, fill=None, accession=accession,
+                    entity=None)])
+        db.session.commit()
+        self.assertAlmostEqual(est_pls_avail('UP-78'), lb_avail * 1000.0)
+        self.assertEqual(update_est_pls_avail([accession.id]), (0, 1))
+
+    def test_recompute_availability_command_updates_est_pls_avail(self):
+        availability = {'GRIN_AVAIL': 0.0, 'BEND_AVAIL': 453.592, 'CBG_AVAIL': 0.0, 'MEEKER_AVAIL': 0.0,
+                        'MISC_AVAIL': 0.0, 'EPHRAIM_AVAIL': 0.0, 'NAU_AVAIL': 0.0}
+        bulk_import([pd.DataFrame.from_records([export_row('UP-76', **availability)])])
+        # Written around the flush events
+        db.session.execute(Availability.__table__.update().values(bend_avail=907.184))
+        db.session.commit()
+        self.assertAlmostEqual(Availability.query.one().est_pls_avail, 453.592 * 0.00220462 * 297054.49)
+
+        manage.main(['recompute-availability'])
+        db.session.expire_all()
+        availability = Availability.query.one()
+        self.assertAlmostEqual(availability.lb_avail, 907.184 * 0.00220462)
+        self.assertAlmostEqual(availability.est_pls_avail, 907.184 * 0.00220462 * 297054.49)
+
+    def test_est_pls_avail_follows_changed_inputs(self):
+        availability = {'GRIN_AVAIL': 0.0, 'BEND_AVAIL': 453.592, 'CBG_AVAIL': 0.0, 'MEEKER_AVAIL': 0.0,
+                        'MISC_AVAIL': 0.0, 'EPHRAIM_AVAIL': 0.0, 'NAU_AVAIL': 0.0}
+        bulk_import([pd.DataFrame.from_records([export_row('UP-76', **availability), export_row('UP-77')])])
+        accession = Accession.query.filter_by(acc_num='UP-76').one()
+
+        with mock.patch('pls.update_est_pls_avail', wraps=update_est_pls_avail) as update:
+            accession.availability.bend_avail = 907.184
+            db.session.commit()
+            update.assert_called_once_with({accession.id}, db.session())
+            self.assertAlmostEqual(accession.availability.est_pls_avail, 907.184 * 0.00220462 * 297054.49)
+
+            update.reset_mock()
+            accession.tests[0].est_pls_lb = 1000.0
+            db.session.commit()
+            update.assert_called_once_with({accession.id}, db.session())
+            self.assertAlmostEqual(accession.availability.est_pls_avail, 907.184 * 0.00220462 * 1000.0)
+
+            # Neither is an input
+            update.reset_mock()
+            accession.tests[0].test_type = 'TZ'
+            accession.tests[0].clean_wt_lbs = 12.5
+            db.session.commit()
+            update.assert_not_called()
+
+            # Only db.session is tracked
+            with Session(db.engine) as session:
+                session.get(Testing, accession.tests[0].id).est_pls_lb = 2000.0
+                session.commit()
+            update.assert_not_called()
+
+    def test_testing_form_updates_est_pls_avail(self):
+        availability = {'GRIN_AVAIL': 0.0, 'BEND_AVAIL': 453.592, 'CBG_AVAIL': 0.0, 'MEEKER_AVAIL': 0.0,
+                        'MISC_AVAIL': 0.0, 'EPHRAIM_AVAIL': 0.0, 'NAU_AVAIL': 0.0}
+        bulk_import([pd.DataFrame.from_records([export_row('UP-76', **availability)])])
+        entity = Entity(name='Bend', entity_phone=None, entity_phone_ext=None, entity_email=None,
+                        request_costs=False, cost=None, address=None)
+        db.session.add(entity)
+        db.session.commit()
+        accession = Accession.query.filter_by(acc_num='UP-76').one()
+        app.config['WTF_CSRF_ENABLED'] = False
+        response = app.test_client().post('/testing', data={
+            'accession': accession.id, 'entity': entity.id, 'est_pls_lb': 1000, 'test_type': 'TZ',
+            'test_date': '2010-05-01', 'purity': 90, 'tz': 80, 'fill': 95})
+        self.assertEqual(response.status_code, 302)
+        self.assertAlmostEqual(Availability.query.one().est_pls_avail, 453.592 * 0.00220462 * 1000)
+
+    def test_resume_import(self):
+        with tempfile.TemporaryDirectory() as directory:
+            journal_file = os.path.join(directory, 'journal.json')
+            source = os.path.abspath(__file__)
+            journal = Journal(journal_file)
+            journal.start('accessions', source)
+            rows = [export_row('UP-76'), export_row('UP-77'), export_row('UP-78'), export_row('UP-79')]
+            parse_excel(rows[:2], batch_size=1, workers=1, journal=journal)
+            self.assertEqual(Journal(journal_file).offset('accessions'), 2)
+
+            # The same journal resumes after the rows that were committed
+            journal = Journal(journal_file)
+            self.assertEqual(journal.start('accessions', source), 2)
+            report = parse_excel(rows, batch_size=1, workers=1, journal=journal)
+            self.assertEqual((report.inserted, report.rejected), (2, []))
+            self.assertEqual(Accession.query.count(), 4)
+            self.assertEqual(journal.offset('accessions'), 4)
+
+    def test_export_round_trip(self):
+        availability = {'GRIN_AVAIL': 10.0, 'BEND_AVAIL': 5.0, 'CBG_AVAIL': None, 'MEEKER_AVAIL': 0.0,
+                        'MISC_AVAIL': 0.0, 'EPHRAIM_AVAIL': 2.5, 'NAU_AVAIL': 0.0}
+        rows = [export_row('UP-76', **availability), export_row('UP-77', **availability)]
+        bulk_import([pd.DataFrame.from_records(rows)])
+        self.assertEqual(sum(len(batch) for batch in iter_batches(batch_size=1)), 2)
+
+        file = io.BytesIO()
+        write_xlsx(file)
+        file.seek(0)
+        exported = pd.read_excel(file)
+        self.assertEqual(set(exported.columns), set(rows[0]))
+        self.assertEqual(list(exported['ACC_NUM']), ['UP-76', 'UP-77'])
+        self.assertEqual(exported['COLL_DT'][0], pd.Timestamp(2004, 8, 24))
+        self.assertEqual(list(exported['CPBuff']), [1, 1])
+
+        db.drop_all()
+        db.create_all()
+        db.session.add(Species(symbol='ABLAA', name_full='Abies lasiocarpa var. arizonica', common=None,
+                               family=None, genus='Abies', species='lasiocarpa', var_ssp1='var.', var_ssp2='arizonica',
+                               plant_type=None, plant_duration=None, priority_species=0, gsg_val=0, poll_val=0,
+                               research_val=0))
+        db.session.commit()
+        report = bulk_import([exported])
+        self.assertEqual(report.inserted, 2)
+        accession = Accession.query.filter_by(acc_num='UP-77').one()
+        self.assertEqual(accession.species.symbol, 'ABLAA')
+        self.assertEqual(accession.tests[0].purity, 98)
+        self.assertEqual(accession.availability.gr_avail, 17.5)
+
+    def test_export_round_trip_with_several_tests(self):
+        parse_excel([export_row('UP-76'), export_row('UP-77')], workers=1)
+        accession = Accession.query.filter_by(acc_num='UP-76').one()
+        db.session.add(Testing(amt_rcvd_lbs=None, clean_wt_lbs=None, est_seed_lb=None, est_pls_lb=None,
+                               est_pls_collected=None, test_type='Retest', test_date=datetime.datetime(2010, 1, 1),
+                               purity=70, tz=None, fill=None, accession=accession, entity=None))
+        db.session.add(Visit(date=datetime.datetime(2010, 1, 1), associated_taxa_full=None, mod='burned', mod2=None,
+                             slope=None, aspect=None, habitat=None, population_size=None, accession=accession,
+                             geo_location=accession.geo_location, species=accession.species))
+        other = Accession.query.filter_by(acc_num='UP-77').one()
+        other.tests[0].imported = False
+        for test_date, purity in ((datetime.datetime(2010, 1, 1), 60), (datetime.datetime(2001, 1, 1), 50)):
+            db.session.add(Testing(amt_rcvd_lbs=None, clean_wt_lbs=None, est_seed_lb=None, est_pls_lb=None,
+                                   est_pls_collected=None, test_type='Retest', test_date=test_date, purity=purity,
+                                   tz=None, fill=None, accession=other, entity=None))
+        db.session.commit()
+
+        file = io.BytesIO()
+        write_xlsx(file)
+        file.seek(0)
+        exported = pd.read_excel(file)
+        # The imported test and first visit of UP-76 and the latest test of UP-77
+        self.assertEqual(list(exported['ACC_NUM']), ['UP-76', 'UP-77'])
+        self.assertEqual(list(exported['PURITY_']), [98, 60])
+        self.assertEqual(list(exported['USER2']), ['grazed', 'grazed'])
+
+        db.session.remove()
+        db.drop_all()
+        self.setUp()
+        report = bulk_import([exported])
+        self.assertEqual((report.inserted, report.rejected), (2, []))
+        self.assertEqual([[test.purity for test in accession.tests] for accession in Accession.query.order_by(
+            Accession.acc_num)], [[98], [60]])
+
+    def test_export_endpoint_streams_csv(self):
+        parse_excel([export_row('UP-76')], workers=1)
+        response = app.test_client().get('/api/accessions/export')
+        self.assertTrue(response.is_streamed)
+        rows = list(csv.DictReader(io.StringIO(response.get_data(as_text=True))))
+        self.assertEqual([(row['ACC_NUM'], row['NAME'], row['US_L4CODE']) for row in rows],
+                         [('UP-76', 'Abies lasiocarpa var. arizonica', '20c')])
+
+
+# The queries the pages, API and imports run most, with the only tables
+# each may scan in full. Any other table must be searched through an index.
+HOT_QUERIES = {
+    'accession by acc_num': (select(Accession.id).where(Accession.acc_num == 'UP-76'), ()),
+    'accession typeahead': (select(Accession.id).where(func.lower(Accession.acc_num) >= 'up',
+                                                       func.lower(Accession.acc_num) < 'uq'), ()),
+    'species typeahead': (select(Species.id).where(func.lower(Species.name_full) >= 'ab',
+                                                   func.lower(Species.name_full) < 'ac'), ()),
+    'accessions of a species': (select(Accession.id).where(Accession.species_id == 1), ()),
+    'accession of a geo location': (select(Accession.id).where(Accession.geo_location_id == 1), ()),
+    'tests of an accession': (select(Testing.id).where(Testing.accession_id == 1), ()),
+    'amounts used of an accession': (select(AmountUsed.id).where(AmountUsed.accession_id == 1), ()),
+    'amounts sent in a shipment': (select(AmountUsed.id).where(AmountUsed.shipment_id == 1), ()),
+    'availability of an accession': (select(Availability.id).where(Availability.accession_id == 1), ()),
+    'visits of an accession': (select(Visit.id).where(Visit.accession_id == 1), ()),
+    'zone of a geo location': (select(Zone.id).where(Zone.geo_location_id == 1), ()),
+    'shipments from an entity': (select(Shipment.id).where(Shipment.origin_entity_id == 1), ()),
+    'shipments to an entity': (select(Shipment.id).where(Shipment.destination_entity_id == 1), ()),
+    'synonyms of a species': (select(Species.id).where(Species.parent_id == 1), ()),
+    'species of a genus': (select(Species.id).where(Species.genus == 'Abies'), ()),
+    'species of a family': (select(Species.id).where(Species.family == 'Pinaceae'), ()),
+    'geo locations in a state': (select(GeoLocation.id).where(GeoLocation.state == 'CO'), ()),
+    'geo locations in a county': (select(GeoLocation.id).where(GeoLocation.state == 'CO',
+                                                               GeoLocation.county == 'Montrose'), ()),
+    'zones of a level 4 ecoregion': (select(Zone.id).where(Zone.us_l4_code == '20c'), ()),
+    'accessions with grams available': (select(Availability.accession_id).where(Availability.gr_avail > 100), ()),
+    'accession page': (select(Accession.id).where(Accession.id > 100).order_by(Accession.id).limit(101), ()),
+    'accession export': (export_query(), ('accession',)),
+}
+
+
+class QueryPlanTests(unittest.TestCase):
+    """
+    Fails when a hot query's plan regresses to a full table scan, e.g.
+    because an index was dropped or a query stopped matching it.
+    """
+    def setUp(self):
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+
+    def query_plan(self, statement):
+        sql = str(statement.compile(db.engine, compile_kwargs={'literal_binds': True}))
+        return [row[-1] for row in db.session.connection().exec_driver_sql('EXPLAIN QUERY PLAN ' + sql)]
+
+    @unittest.skipUnless(app.config['SQLALCHEMY_DATABASE_URI'].startswith('sqlite'), 'SQLite query plans')
+    def test_hot_queries_use_indexes(self):
+        for name, (statement, scanned) in HOT_QUERIES.items():
+            with self.subTest(name):
+                plan = self.query_plan(statement)
+                # An automatic index is built from a full scan, every time
+                scans = [step for step in plan if 'AUTOMATIC' in step or
+                         step.startswith('SCAN ') and step.split()[1] not in scanned]
+                self.assertEqual(scans, [], '\n'.join(plan))
+
+
 if __name__ == '__main__':
-    create_app().app_context().push()
+    app.app_context().push()
     unittest.main()
@@ -0,0 +1,295 @@
+"""
+CPNPP Database
+
+Writes the accession export, the wide spreadsheet of accessions with
+their location, zone, visit, test and availability data that
+populate_db.py reads, from the database.
+
+The rows come from a single joined query, fetched BATCH_SIZE at a time
+from a server side cursor, so memory use does not grow with the number
+of accessions. CSV is written as the rows arrive. XLSX goes through
+openpyxl's write-only mode, which spools each row to disk, but the file
+can only be sent once the workbook is complete. Every accession is
+exported as one row, with its first visit and its imported test, or its
+latest test if none was imported, so the export can be read back in.
+Visits and tests added since the import are not exported.
+
+Run with e.g.
+
+    python exports.py accessions.xlsx
+"""
+import argparse
+import csv
+import io
+import os
+import sys
+import tempfile
+
+from openpyxl import Workbook
+from sqlalchemy import Boolean, select
+
+from app import create_app
+from models import db, Accession, Availability, GeoLocation, Species, Testing, Visit, Zone
+
+# Accession rows fetched from the database at a time
+BATCH_SIZE = 1000
+
+# Bytes per block when sending a finished XLSX file
+BLOCK_SIZE = 64 * 1024
+
+FORMATS = ('csv', 'xlsx')
+MIMETYPES = {
+    'csv': 'text/csv',
+    'xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+}
+
+# The export column holding the name of each accession's species
+SPECIES_COLUMN = 'NAME'
+
+# The export column each database column is read from and written to, per
+# table
+ACCESSION_COLUMNS = {
+    'data_source': 'DATA_SOURCE',
+    'plant_habit': 'Habit_rev',
+    'coll_date': 'COLL_DT',  # Sqlite expects YYYY-MM-DD format
+    'acc_num': 'ACC_NUM',
+    'acc_num1': 'ACC_NUM_1',
+    'acc_num2': 'ACC_NUM_2',
+    'acc_num3': 'ACC_NUM_3',
+    'collected_with': 'COLLECTED_WITH',
+    'collection_misc': 'COLLECTION_MISC',
+    'occupancy': 'OCCUPANCY',  # Number of plants collected from
+    'seed_source': 'SEED_SOURCE',
+    'description': 'DESCRIPTION',
+    'notes': 'notes',
+}
+TEST_COLUMNS = {
+    'amt_rcvd_lbs': 'AMOUNT_RECVD__LBS_',
+    'clean_wt_lbs': 'CLEAN_WEIGHT__LBS_',
+    'est_seed_lb': 'SEED_LB',  # Estimated seeds per pound
+    'est_pls_lb': 'EST_PLS_LB',  # Estimated Pure Live Seed per pound
+    'est_pls_collected': 'EST_PLS_COLLECTED',
+    'test_type': 'TEST_TYPE',
+    'test_date': 'TEST_DATE',
+    'purity': 'PURITY_',
+    'tz': 'TZ_',
+    'fill': 'FILL_',
+}
+# degrees, minutes and seconds are derived from the decimal coordinates
+GEO_LOCATION_COLUMNS = {
+    'land_owner': 'LAND_OWNER',
+    'geology': 'GEOLOGY',
+    'soil_type': 'SOIL_TYPE',
+    'phytoregion': 'PHYTOREGION',
+    'phytoregion_full': 'PHYTOREGION_FULL',
+    'locality': 'SUB_CNT3',
+    'geog_area': 'GEOG_AREA',
+    'directions': 'LOCALITY',
+    'latitude_decimal': 'LATITUDE_DECIMAL',
+    'longitude_decimal': 'LONGITUDE_DECIMAL',
+    'georef_source': 'GEOREF_SOURCE',
+    'gps_datum': 'GPS_DATUM',
+    'altitude': 'ALTITUDE',
+    'altitude_unit': 'ALTITUDE_UNIT',
+    'altitude_in_m': 'ALTITUDE_IN_M',
+    'fo_name': 'ADMU_NAME',
+    'district_name': 'PARENT_NAM',
+    'state': 'ADMIN_ST',
+    'county': 'SUB_CNT2',
+}
+VISIT_COLUMNS = {
+    'date': 'COLL_DT',
+    'associated_taxa_full': 'ASSOCIATED_TAXA_FULL',
+    'mod': 'USER2',   # modifying factors of collection site (grazed, etc.)
+    'mod2': 'USER1',  # additional modifying factors of collection site (roadside, etc.)
+    'slope': 'SLOPE',
+    'aspect': 'ASPECT',
+    'habitat': 'HABITAT',
+    'population_size': 'POPULATION_SIZE',
+}
+# The export only carries seed zones for Achnatherum hymenoides
+ZONE_COLUMNS = {
+    'ptz': 'Pot_STZ',
+    'us_l4_code': 'US_L4CODE',
+    'us_l4_name': 'US_L4NAME',
+    'us_l3_code': 'US_L3CODE',
+    'us_l3_name': 'US_L3NAME',
+    'achy_sz_gridcode': 'ACHY_SZ_GRIDCODE',
+    'achy_sz_zone': 'ACHY_SZ_ZONE',
+    'cp_buff': 'CPBuff',
+    'cp_strict': 'CPStrict',
+    'avail_buff': 'AVAIL_BUFF',
+    'avail_strict': 'AVAIL_STRICT',
+    'usgs_zone': 'USGS_ZONE',
+}
+# Grams available at each location. Exports without these columns, such
+# as the current one, are imported without availability.
+AVAILABILITY_COLUMNS = {
+    'grin_avail': 'GRIN_AVAIL',
+    'bend_avail': 'BEND_AVAIL',
+    'cbg_avail': 'CBG_AVAIL',
+    'meeker_avail': 'MEEKER_AVAIL',
+    'misc_avail': 'MISC_AVAIL',
+    'ephraim_avail': 'EPHRAIM_AVAIL',
+    'nau_avail': 'NAU_AVAIL',
+}
+
+
+# The tables of the export and the columns each contributes, in order
+EXPORT_TABLES = (
+    (Accession, ACCESSION_COLUMNS),
+    (GeoLocation, GEO_LOCATION_COLUMNS),
+    (Visit, VISIT_COLUMNS),
+    (Zone, ZONE_COLUMNS),
+    (Testing, TEST_COLUMNS),
+    (Availability, AVAILABILITY_COLUMNS),
+)
+
+
+def export_columns():
+    """
+    :return: A list of the columns of the export, each labeled with its
+    export column name. A name shared by two tables, such as COLL_DT, is
+    taken from the first.
+    """
+    columns = [Species.name_full.label(SPECIES_COLUMN)]
+    names = {SPECIES_COLUMN}
+    for model, column_map in EXPORT_TABLES:
+        for column, name in column_map.items():
+            if name not in names:
+                columns.append(model.__table__.c[column].label(name))
+                names.add(name)
+    return columns
+
+
+def export_query():
+    """
+    :return: The select of every export row, one per accession, in
+    accession order, which is the order SQLite scans the accession table
+    in, so no sort is needed before the first row is returned.
+    """
+    # The visit made when the accession was collected
+    visit_id = select(Visit.id).where(Visit.accession_id == Accession.id).order_by(
+        Visit.id).limit(1).correlate(Accession).scalar_subquery()
+    # The test read from the original export, else the latest one
+    test_id = select(Testing.id).where(Testing.accession_id == Accession.id).order_by(
+        Testing.imported.desc(), Testing.test_date.desc(), Testing.id.desc()).limit(1).correlate(
+        Accession).scalar_subquery()
+    return select(*export_columns()).select_from(Accession).outerjoin(
+        Species, Accession.species_id == Species.id).outerjoin(
+        GeoLocation, Accession.geo_location_id == GeoLocation.id).outerjoin(
+        Zone, Zone.geo_location_id == GeoLocation.id).outerjoin(
+        Visit, Visit.id == visit_id).outerjoin(
+        Testing, Testing.id == test_id).outerjoin(
+        Availability, Availability.accession_id == Accession.id).order_by(Accession.id)
+
+
+def iter_batches(batch_size=BATCH_SIZE):
+    """
+    :return: A generator of lists of export rows, each a tuple in the
+    order of export_columns(). Booleans are written as 1 and 0, as in the
+    original export.
+    """
+    columns = export_columns()
+    booleans = [i for i, column in enumerate(columns) if isinstance(column.type, Boolean)]
+    result = db.session.execute(export_query().execution_options(yield_per=batch_size))
+    for partition in result.partitions():
+        rows = []
+        for row in partition:
+            row = list(row)
+            for i in booleans:
+                if row[i] is not None:
+                    row[i] = int(row[i])
+            rows.append(row)
+        yield rows
+
+
+def iter_csv(batch_size=BATCH_SIZE):
+    """
+    :return: A generator of the export as chunks of CSV text, starting
+    with the header row before the query runs.
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+
+    def flush():
+        text = buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+        return text
+
+    writer.writerow([column.name for column in export_columns()])
+    yield flush()
+    for rows in iter_batches(batch_size):
+        writer.writerows(rows)
+        yield flush()
+
+
+def write_xlsx(file, batch_size=BATCH_SIZE):
+    """
+    Writes the export as an XLSX workbook to file, a path or a binary file
+    object.
+    """
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet()
+    sheet.append([column.name for column in export_columns()])
+    for rows in iter_batches(batch_size):
+        for row in rows:
+            sheet.append(row)
+    workbook.save(file)
+
+
+def iter_xlsx(batch_size=BATCH_SIZE):
+    """
+    :return: A generator of the export as blocks of an XLSX file, which is
+    written to a temporary file first.
+    """
+    with tempfile.TemporaryFile() as file:
+        write_xlsx(file, batch_size)
+        file.seek(0)
+        for block in iter(lambda: file.read(BLOCK_SIZE), b''):
+            yield block
+
+
+def export(format, batch_size=BATCH_SIZE):
+    """
+    :param format: One of FORMATS.
+    :return: A generator of the export as str chunks for CSV or bytes for
+    XLSX.
+    """
+    if format == 'csv':
+        return iter_csv(batch_size)
+    return iter_xlsx(batch_size)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Export the accessions, with their location, zone, visit, test '
+                                                 'and availability data, as one wide spreadsheet.')
+    parser.add_argument('output', help='File to write, or - for CSV on standard output.')
+    parser.add_argument('--format', choices=FORMATS,
+                        help='Defaults to the extension of output, or csv for standard output.')
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE,
+                        help='Rows fetched from the database at a time (default: %(default)s).')
+    args = parser.parse_args(argv)
+
+    format = args.format
+    if format is None:
+        extension = os.path.splitext(args.output)[1].lstrip('.').lower()
+        format = extension if extension in FORMATS else 'csv'
+    if args.output == '-' and format != 'csv':
+        parser.error('Only CSV can be written to standard output')
+
+    with create_app().app_context():
+        if format == 'xlsx':
+            write_xlsx(args.output, args.batch_size)
+        elif args.output == '-':
+            for text in iter_csv(args.batch_size):
+                sys.stdout.write(text)
+        else:
+            with open(args.output, 'w', newline='') as file:
+                for text in iter_csv(args.batch_size):
+                    file.write(text)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,7 +2,8 @@ from flask_wtf import FlaskForm
 from wtforms import BooleanField, DateField, FloatField, IntegerField, SelectField, StringField, TextAreaField
 from wtforms import validators
 
-from models import Shipment
+from fragments import CachedSelect
+from models import db, Accession, Entity, Shipment, Species
 
 COMPANIES = [('FedEx', 'FedEx'), ('UPS', 'UPS'), ('USPS', 'USPS')]
 DURATION_CHOICES = [
@@ -37,6 +38,44 @@ PHYTOREGION_CODES = [
     ('81E', 'Sonoran Basin and Range (Omernik)'),
     ('9N', 'Utah-Wyoming Rocky Mountains (TNC)')]
 
+# Select fields with these attributes search the matching api.py endpoint
+# as the user types, so their choices only need to hold the selected row
+TYPEAHEAD_SPECIES = {'data-typeahead': 'species'}
+TYPEAHEAD_ACCESSIONS = {'data-typeahead': 'accessions'}
+
+
+class LookupSelectField(SelectField):
+    """
+    A SelectField whose value is the primary key of a row of model.
+
+    A submitted id is validated with a single primary key existence check
+    rather than by scanning choices. choices then only have to hold what
+    should be rendered, e.g. just the selected row of a typeahead, and
+    can be left unset when the form is only validated. A blank
+    submission leaves the data as None, so an optional field may be left
+    empty. The options of a list from choices.get_choices are rendered
+    once per data version.
+    """
+    widget = CachedSelect()
+
+    def __init__(self, label=None, validators=None, model=None, **kwargs):
+        kwargs.setdefault('coerce', int)
+        kwargs.setdefault('choices', [])
+        super(LookupSelectField, self).__init__(label, validators, **kwargs)
+        self.model = model
+
+    def process_formdata(self, valuelist):
+        if valuelist and valuelist[0] == '':
+            self.data = None
+        else:
+            super(LookupSelectField, self).process_formdata(valuelist)
+
+    def pre_validate(self, form):
+        if self.data is None:
+            return
+        if not db.session.query(db.session.query(self.model).filter(self.model.id == self.data).exists()).scalar():
+            raise validators.ValidationError(self.gettext('Not a valid choice.'))
+
 
 def shipment_exists(field):
     if Shipment.select().where(Shipment.tracking_num == field.data).exists():
@@ -44,10 +83,11 @@ def shipment_exists(field):
 
 
 class AvailabilityForm(FlaskForm):
-    accession = SelectField(
+    accession = LookupSelectField(
         'Accession',
         validators=[validators.input_required()],
-        coerce=int
+        model=Accession,
+        render_kw=TYPEAHEAD_ACCESSIONS
     )
     grin_avail = FloatField(
         'GRIN Availability in Grams'
@@ -64,9 +104,9 @@ class AvailabilityForm(FlaskForm):
     misc_avail = FloatField(
         'Miscellaneous Availability in Grams'
     )
-    misc_inst_id = SelectField(
+    misc_inst_id = LookupSelectField(
         'Miscellaneous Institute',
-        coerce=int
+        model=Entity
     )
     ephraim_avail = FloatField(
         'Ephraim Availability in Grams'
@@ -77,8 +117,10 @@ class AvailabilityForm(FlaskForm):
 
 
 class AccessionForm(FlaskForm):
-    species = SelectField(
+    species = LookupSelectField(
         'Species',
+        model=Species,
+        render_kw=TYPEAHEAD_SPECIES
     )
     plant_habit = SelectField(
         'Plant Habit',
@@ -267,11 +309,15 @@ class InstitutionForm(FlaskForm):
 
 
 class ReleaseForm(FlaskForm):
-    species = SelectField(
-        'Species'
+    species = LookupSelectField(
+        'Species',
+        model=Species,
+        render_kw=TYPEAHEAD_SPECIES
     )
-    accession = SelectField(
-        'Accession'
+    accession = LookupSelectField(
+        'Accession',
+        model=Accession,
+        render_kw=TYPEAHEAD_ACCESSIONS
     )
     loc_desc = TextAreaField(
         'GeoLocation Description'
@@ -384,9 +430,9 @@ class ShipmentForm(FlaskForm):
         'Amount calculated by...',
         validators=[validators.InputRequired()],
         choices=[('ct', 'Counting'), ('wt', 'Weighed')])
-    origin_institute_id = SelectField('Origin', coerce=int)
-    destination_institute_id = SelectField('Destination', coerce=int)
-    accession = SelectField('Accession', coerce=int)
+    origin_institute_id = LookupSelectField('Origin', model=Entity)
+    destination_institute_id = LookupSelectField('Destination', model=Entity)
+    accession = LookupSelectField('Accession', model=Accession, render_kw=TYPEAHEAD_ACCESSIONS)
 
 
 class SpeciesForm(FlaskForm):
@@ -432,28 +478,31 @@ class SpeciesForm(FlaskForm):
 
 
 class SynonymsForm(FlaskForm):
-    species = SelectField(
+    species = LookupSelectField(
         'Species',
         validators=[validators.input_required()],
-        coerce=int
+        model=Species,
+        render_kw=TYPEAHEAD_SPECIES
     )
-    synonym = SelectField(
+    synonym = LookupSelectField(
         'Synonym',
         validators=[validators.input_required()],
-        coerce=int
+        model=Species,
+        render_kw=TYPEAHEAD_SPECIES
     )
 
 
 class TestingForm(FlaskForm):
-    accession = SelectField(
+    accession = LookupSelectField(
         'Accession',
         validators=[validators.input_required()],
-        coerce=int
+        model=Accession,
+        render_kw=TYPEAHEAD_ACCESSIONS
     )
-    entity = SelectField(
+    entity = LookupSelectField(
         'Entity',
         validators=[validators.input_required()],
-        coerce=int
+        model=Entity
     )
     amt_rcvd_lbs = FloatField(
         'Amount Received (Lbs)'
@@ -492,10 +541,11 @@ class TestingForm(FlaskForm):
 
 
 class UseForm(FlaskForm):
-    accession = SelectField(
+    accession = LookupSelectField(
         'Accession',
         validators=[validators.input_required()],
-        coerce=int
+        model=Accession,
+        render_kw=TYPEAHEAD_ACCESSIONS
     )
     amount_gr = FloatField(
         'Amount in Grams'
@@ -0,0 +1,79 @@
+"""
+CPNPP Database
+
+A per-process cache of rendered HTML fragments, such as the <option>s of
+the select fields listing every entity, that would otherwise be rendered
+again for every request.
+
+Each fragment is cached under a name along with a version, such as the
+data version of the table it lists. A fragment is rendered again when it
+is asked for with a different version, which replaces the old one, so
+stale fragments are never served and never pile up.
+"""
+from collections import OrderedDict
+
+from markupsafe import Markup
+from wtforms.widgets import Select
+
+# Most fragments kept at once, least recently used first out
+MAX_FRAGMENTS = 256
+
+# Name to a (version, html) tuple, in order of use
+_cache = OrderedDict()
+
+
+def get_fragment(name, version, render):
+    """
+    :param name: Identifies the fragment.
+    :param version: Any value that changes whenever the fragment would
+    render differently.
+    :param render: Called with no arguments to render the fragment when
+    it is not cached at this version.
+    :return: The fragment's HTML as Markup.
+    """
+    cached = _cache.get(name)
+    if cached is not None and cached[0] == version:
+        _cache.move_to_end(name)
+        return cached[1]
+    html = Markup(render())
+    _cache[name] = (version, html)
+    _cache.move_to_end(name)
+    while len(_cache) > MAX_FRAGMENTS:
+        _cache.popitem(last=False)
+    return html
+
+
+def clear_cache():
+    _cache.clear()
+
+
+class CachedSelect(Select):
+    """
+    A Select widget that caches the rendered <option>s of fields whose
+    choices are a versioned list, such as those from choices.get_choices.
+    The selected option, if any, is marked on a copy of the cached HTML.
+    Other choices are rendered as usual.
+    """
+    def __call__(self, field, **kwargs):
+        choices = field.choices
+        key = getattr(choices, 'cache_key', None)
+        if key is None or self.multiple:
+            return super(CachedSelect, self).__call__(field, **kwargs)
+
+        # The <select> tag itself, with the attributes of this call
+        field.choices = []
+        try:
+            html = super(CachedSelect, self).__call__(field, **kwargs)
+        finally:
+            field.choices = choices
+
+        name, version = key
+        options = get_fragment(name, version, lambda: ''.join(
+            self.render_option(value, label, False) for value, label in choices))
+        if field.data is not None:
+            for value, label in choices:
+                if value == field.data:
+                    options = options.replace(self.render_option(value, label, False),
+                                              self.render_option(value, label, True), 1)
+                    break
+        return html.replace(Markup('</select>'), options + Markup('</select>'))
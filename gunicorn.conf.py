@@ -0,0 +1,28 @@
+"""
+CPNPP Database
+
+Settings for serving wsgi:app with gunicorn, e.g.
+
+    PROMETHEUS_MULTIPROC_DIR=/tmp/cpnpp_metrics gunicorn -c gunicorn.conf.py wsgi:app
+
+PROMETHEUS_MULTIPROC_DIR must be an empty directory shared by the
+workers, so that /metrics reports all of them.
+"""
+import multiprocessing
+
+bind = '127.0.0.1:8000'
+workers = multiprocessing.cpu_count() * 2 + 1
+
+
+def on_starting(server):
+    # Upgrade an older database once, before any worker queries it
+    from app import create_app
+    from models import migrate
+    with create_app().app_context():
+        migrate()
+
+
+def child_exit(server, worker):
+    # Imported on first use so that reading these settings stays cheap
+    import metrics
+    metrics.mark_process_dead(worker.pid)
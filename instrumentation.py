@@ -0,0 +1,127 @@
+"""
+CPNPP Database
+
+Per-request SQL instrumentation, switched on with SQL_INSTRUMENTATION =
+True in settings.cfg.
+
+While it is on, every statement a request executes is timed with
+SQLAlchemy engine events. When the request finishes, the query count,
+total database time, slowest statements and repeated statements are
+added to the response headers and logged as one JSON line. A statement
+repeated with different parameters, such as a relationship loaded once
+per row of a list, is the sign of an N+1 query. Statements run while a
+streamed response is sent, such as the accession export, come after the
+headers and are not counted.
+
+    X-SQL-Queries     Number of statements executed
+    X-SQL-Time        Total database time in milliseconds
+    X-SQL-Repeated    Number of distinct statements executed at least
+                      SQL_REPEAT_THRESHOLD times
+    Server-Timing     The database time, for the browser's dev tools
+"""
+from collections import Counter
+import json
+import logging
+import time
+
+from flask import current_app, g, has_request_context, request
+from flask.logging import default_handler
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger(__name__)
+
+# Executions of the same statement that make it a likely N+1 query
+REPEAT_THRESHOLD = 3
+
+# Number of slowest statements logged per request
+SLOWEST = 3
+
+
+class QueryStats(object):
+    """
+    The statements executed during one request.
+    """
+    def __init__(self):
+        self.count = 0
+        self.total_time = 0.0
+        self.timings = []
+        self.executions = Counter()
+
+    def add(self, statement, duration):
+        self.count += 1
+        self.total_time += duration
+        self.timings.append((duration, statement))
+        self.executions[statement] += 1
+
+    def slowest(self, n=SLOWEST):
+        """
+        :return: A list of (seconds, statement) tuples for the n slowest
+        statements, slowest first.
+        """
+        return sorted(self.timings, key=lambda timing: timing[0], reverse=True)[:n]
+
+    def repeated(self, threshold=REPEAT_THRESHOLD):
+        """
+        :return: A list of (count, statement) tuples for the statements
+        executed at least threshold times, most repeated first.
+        """
+        return [(count, statement) for statement, count in self.executions.most_common() if count >= threshold]
+
+
+def init_app(app):
+    """
+    Registers the request hooks on app and the statement timing on every
+    engine. Both do nothing unless the app's SQL_INSTRUMENTATION setting
+    is true when a request starts. The log lines go to the same stream as
+    Flask's own unless the instrumentation logger is configured otherwise.
+    """
+    if not logger.handlers:
+        logger.addHandler(default_handler)
+        logger.setLevel(logging.INFO)
+    app.before_request(start_request)
+    app.after_request(finish_request)
+    if not event.contains(Engine, 'before_cursor_execute', _before_cursor_execute):
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+
+
+def start_request():
+    if current_app.config.get('SQL_INSTRUMENTATION'):
+        g.sql_stats = QueryStats()
+
+
+def finish_request(response):
+    stats = g.pop('sql_stats', None)
+    if stats is None:
+        return response
+
+    repeated = stats.repeated(current_app.config.get('SQL_REPEAT_THRESHOLD', REPEAT_THRESHOLD))
+    milliseconds = stats.total_time * 1000
+    response.headers['X-SQL-Queries'] = str(stats.count)
+    response.headers['X-SQL-Time'] = '{:.2f}'.format(milliseconds)
+    response.headers['X-SQL-Repeated'] = str(len(repeated))
+    response.headers.add('Server-Timing', 'db;dur={:.2f};desc="{} queries"'.format(milliseconds, stats.count))
+
+    logger.info(json.dumps({
+        'method': request.method,
+        'path': request.path,
+        'status': response.status_code,
+        'queries': stats.count,
+        'db_ms': round(milliseconds, 2),
+        'slowest': [{'ms': round(duration * 1000, 2), 'statement': statement}
+                    for duration, statement in stats.slowest()],
+        'repeated': [{'count': count, 'statement': statement} for count, statement in repeated],
+    }))
+    return response
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context() and 'sql_stats' in g:
+        context._sql_started = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = getattr(context, '_sql_started', None)
+    if started is not None and has_request_context() and 'sql_stats' in g:
+        g.sql_stats.add(statement, time.perf_counter() - started)
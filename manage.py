@@ -0,0 +1,126 @@
+"""
+CPNPP Database
+
+Command line for running and maintaining the app, e.g.
+
+    python manage.py init-db
+    python manage.py recompute-availability
+    python manage.py update-pls
+    python manage.py import --resume
+    python manage.py export accessions.xlsx
+    python manage.py run --port 8000
+
+Each command imports only the modules it uses. import, export,
+bench-import and update-pls are the command lines of populate_db.py,
+exports.py, bench_import.py and pls.py, so their options are the same;
+see e.g. python manage.py import --help.
+"""
+import argparse
+import importlib
+import statistics
+import subprocess
+import sys
+
+# Commands that are another script's command line, and that script
+SCRIPTS = {
+    'import': 'populate_db',
+    'export': 'exports',
+    'bench-import': 'bench_import',
+    'update-pls': 'pls',
+}
+
+# Imports wsgi in a new interpreter and prints how long it took and which
+# of the slow to import modules it loaded
+STARTUP_SCRIPT = '''
+import sys, time
+started = time.perf_counter()
+import wsgi
+print(time.perf_counter() - started, ' '.join(name for name in {} if name in sys.modules))
+'''
+
+# Modules a worker should not import until an endpoint needs them
+LAZY_MODULES = ('pandas', 'numpy', 'openpyxl', 'pyarrow')
+
+
+def run(args):
+    from app import create_app
+    from models import migrate
+    app = create_app()
+    with app.app_context():
+        migrate()
+    app.run(host=args.host, port=args.port, debug=args.debug)
+
+
+def init_db(args):
+    from app import create_app
+    from models import migrate
+    with create_app().app_context():
+        migrate()
+    print('Created any missing tables, columns and indexes.')
+
+
+def recompute_availability(args):
+    from app import create_app
+    from models import db, recompute_availability
+    with create_app().app_context():
+        updated = recompute_availability()
+        db.session.commit()
+    print('Recomputed the totals of {} availability rows.'.format(updated))
+
+
+def startup_time(args):
+    """
+    Prints the time taken to import wsgi in fresh interpreters, which is
+    what a worker does when it starts.
+    """
+    timings = []
+    loaded = set()
+    for _ in range(args.runs):
+        output = subprocess.run([sys.executable, '-c', STARTUP_SCRIPT.format(LAZY_MODULES)], check=True,
+                                capture_output=True, text=True).stdout.split()
+        timings.append(float(output[0]))
+        loaded.update(output[1:])
+    print('Startup over {} runs: min {:.3f}s, median {:.3f}s, max {:.3f}s'.format(
+        args.runs, min(timings), statistics.median(timings), max(timings)))
+    if loaded:
+        print('[!] Imported at startup: {}'.format(', '.join(sorted(loaded))))
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if argv and argv[0] in SCRIPTS:
+        importlib.import_module(SCRIPTS[argv[0]]).main(argv[1:])
+        return
+
+    parser = argparse.ArgumentParser(description='Run and maintain the CPNPP database app.')
+    commands = parser.add_subparsers(dest='command', metavar='command', required=True)
+
+    command = commands.add_parser('run', help='Run the development server.')
+    command.add_argument('--host', default='127.0.0.1')
+    command.add_argument('--port', type=int, default=5000)
+    command.add_argument('--debug', action='store_true')
+    command.set_defaults(func=run)
+
+    command = commands.add_parser('init-db', help='Create any missing tables, columns and indexes.')
+    command.set_defaults(func=init_db)
+
+    command = commands.add_parser('recompute-availability',
+                                  help='Recompute the availability totals from the per-site amounts.')
+    command.set_defaults(func=recompute_availability)
+
+    command = commands.add_parser('startup-time', help='Measure how long a worker takes to start.')
+    command.add_argument('--runs', type=int, default=5, help='Interpreters to start (default: %(default)s).')
+    command.set_defaults(func=startup_time)
+
+    for name, help in (('import', 'Populate the database from the workbooks.'),
+                       ('export', 'Write the accession export.'),
+                       ('bench-import', 'Benchmark the accession import paths.'),
+                       ('update-pls', 'Compute the pure live seed available from the latest tests.')):
+        commands.add_parser(name, help=help)
+
+    args = parser.parse_args(argv)
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
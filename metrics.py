@@ -0,0 +1,168 @@
+"""
+CPNPP Database
+
+Prometheus metrics, served at /metrics in the text exposition format.
+
+    cpnpp_http_requests_total               Requests by method, route and
+                                            status
+    cpnpp_http_request_duration_seconds     Latency histogram by method and
+                                            route
+    cpnpp_http_request_exceptions_total     Unhandled exceptions by route and
+                                            exception type
+    cpnpp_db_pool_checkout_seconds          Time spent waiting for a
+                                            connection from the pool
+    cpnpp_db_pool_checked_out               Connections currently checked out
+    cpnpp_import_rows_total                 Rows processed by each
+                                            populate_db.py stage
+    cpnpp_app_startup_seconds               Time taken by each worker to
+                                            import and create the app
+
+Routes are labeled by their URL rule, e.g. /api/rows/<resource>, so the
+number of series stays bounded. A streamed response is timed until its
+headers are sent.
+
+Metrics are only collected when prometheus_client is installed, and
+the app logs a warning at startup when it is not. To
+aggregate them across worker processes, and with populate_db.py runs,
+point the PROMETHEUS_MULTIPROC_DIR environment variable of every process
+at the same empty directory, and call mark_process_dead from the server's
+hook for exiting workers, e.g. gunicorn's child_exit.
+"""
+import os
+import time
+
+from flask import Response, g, got_request_exception, request
+from sqlalchemy import event
+from sqlalchemy.pool import Pool
+
+from models import db
+
+try:
+    import prometheus_client
+    from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram, multiprocess
+except ImportError:  # Metrics are not collected without prometheus_client
+    prometheus_client = None
+
+# Buckets of the startup histogram, in seconds
+STARTUP_BUCKETS = (.1, .25, .5, .75, 1.0, 1.5, 2.5, 5.0, 10.0)
+
+# Buckets of the pool checkout histogram, in seconds. Waits are usually
+# far shorter than requests.
+CHECKOUT_BUCKETS = (.0001, .0005, .001, .005, .01, .05, .1, .5, 1.0, 5.0, 30.0)
+
+if prometheus_client is not None:
+    REQUESTS = Counter('cpnpp_http_requests_total', 'HTTP requests.', ['method', 'route', 'status'])
+    REQUEST_DURATION = Histogram('cpnpp_http_request_duration_seconds', 'HTTP request latency.', ['method', 'route'])
+    REQUEST_EXCEPTIONS = Counter('cpnpp_http_request_exceptions_total', 'Unhandled exceptions raised by requests.',
+                                 ['route', 'exception'])
+    POOL_CHECKOUT = Histogram('cpnpp_db_pool_checkout_seconds', 'Time waiting for a pooled database connection.',
+                              buckets=CHECKOUT_BUCKETS)
+    POOL_CHECKED_OUT = Gauge('cpnpp_db_pool_checked_out', 'Database connections checked out of the pool.',
+                             multiprocess_mode='livesum')
+    IMPORT_ROWS = Counter('cpnpp_import_rows_total', 'Rows processed by populate_db.py.', ['stage'])
+    STARTUP = Histogram('cpnpp_app_startup_seconds', 'Time to import and create the app in a worker.',
+                        buckets=STARTUP_BUCKETS)
+
+
+def init_app(app):
+    """
+    Registers the request hooks and the /metrics endpoint on app, if
+    prometheus_client is installed, and warns that metrics are disabled
+    otherwise.
+    """
+    if prometheus_client is None:
+        app.logger.warning('prometheus_client is not installed, so no metrics are collected and /metrics is '
+                           'not served. Install it with: pip install prometheus_client')
+        return
+    app.before_request(start_request)
+    app.after_request(finish_request)
+    got_request_exception.connect(count_exception, app)
+    app.add_url_rule('/metrics', 'metrics', metrics_view)
+    if not event.contains(Pool, 'checkout', _checkout):
+        event.listen(Pool, 'checkout', _checkout)
+        event.listen(Pool, 'checkin', _checkin)
+
+
+def route():
+    return request.url_rule.rule if request.url_rule is not None else '<unmatched>'
+
+
+def start_request():
+    g.metrics_started = time.perf_counter()
+    time_checkouts(db.engine.pool)
+
+
+def finish_request(response):
+    started = g.pop('metrics_started', None)
+    if started is not None:
+        REQUEST_DURATION.labels(request.method, route()).observe(time.perf_counter() - started)
+    REQUESTS.labels(request.method, route(), str(response.status_code)).inc()
+    return response
+
+
+def count_exception(sender, exception, **extra):
+    REQUEST_EXCEPTIONS.labels(route(), type(exception).__name__).inc()
+
+
+def metrics_view():
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = prometheus_client.REGISTRY
+    return Response(prometheus_client.generate_latest(registry), content_type=CONTENT_TYPE_LATEST)
+
+
+def record_import(stage, rows):
+    """
+    Counts rows processed by an import stage, for its throughput.
+    """
+    if prometheus_client is not None:
+        IMPORT_ROWS.labels(stage).inc(rows)
+
+
+def record_startup(seconds):
+    """
+    Records how long a worker took to import and create the app.
+    """
+    if prometheus_client is not None:
+        STARTUP.observe(seconds)
+
+
+def mark_process_dead(pid):
+    """
+    Drops the live gauges of an exited worker process, in multiprocess
+    mode.
+    """
+    if prometheus_client is not None and 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        multiprocess.mark_process_dead(pid)
+
+
+def time_checkouts(pool):
+    """
+    Times every connection pool.connect() hands out, including any wait
+    for a connection to be returned to a full pool. The pool events only
+    fire once a connection has been checked out, so the method itself is
+    wrapped, once per pool.
+    """
+    if getattr(pool, '_checkout_timed', False):
+        return
+    connect = pool.connect
+
+    def timed_connect():
+        started = time.perf_counter()
+        try:
+            return connect()
+        finally:
+            POOL_CHECKOUT.observe(time.perf_counter() - started)
+
+    pool.connect = timed_connect
+    pool._checkout_timed = True
+
+
+def _checkout(dbapi_connection, connection_record, connection_proxy):
+    POOL_CHECKED_OUT.inc()
+
+
+def _checkin(dbapi_connection, connection_record):
+    POOL_CHECKED_OUT.dec()
@@ -7,22 +7,174 @@ Author:   Avery Uslaner
 
 This file holds the models and query logic for the database tables.
 """
+import datetime
+
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import defaultload, joinedload, object_session, selectinload
+from sqlalchemy.orm.attributes import get_history
+from sqlalchemy.schema import CreateIndex
 
 
 db = SQLAlchemy()
 
+# How Accession.load fetches the related rows of each profile, by
+# relationship path. Rows there is one of per accession are joined into
+# the accessions' query; collections are loaded with one more query per
+# relationship, for every accession at once.
+ACCESSION_PROFILES = {
+    'summary': {
+        'species': joinedload,
+        'geo_location': joinedload,
+    },
+    'full': {
+        'species': joinedload,
+        'geo_location': joinedload,
+        'geo_location.zone': joinedload,
+        'availability': joinedload,
+        'tests': selectinload,
+        'releases': selectinload,
+        'amounts_used': selectinload,
+    },
+    'shipping': {
+        'species': joinedload,
+        'availability': joinedload,
+        'tests': selectinload,
+        'amounts_used': selectinload,
+    },
+}
+
 
 def add_column(table_name, column):
-    column_name = column.compile(dialect=db.engine.dialect)
+    # Columns of a mapped table compile to a table qualified name
+    column_name = db.engine.dialect.identifier_preparer.quote(column.name)
     column_type = column.type.compile(db.engine.dialect)
-    db.session.execute('ALTER TABLE %s ADD COLUMN %s %s' % (table_name, column_name, column_type))
+    db.session.execute(db.text('ALTER TABLE %s ADD COLUMN %s %s' % (table_name, column_name, column_type)))
+
+
+def add_columns():
+    """
+    Adds the columns defined on the models that are missing from their
+    tables, which create_all only creates along with new tables. Such
+    columns have to be nullable. The caller commits.
+
+    :return: Dict of the name of each table that was altered to the
+    names of the columns added to it.
+    """
+    inspector = inspect(db.engine)
+    added = {}
+    for table in db.metadata.sorted_tables:
+        existing = set(column['name'] for column in inspector.get_columns(table.name))
+        for column in table.columns:
+            if column.name not in existing:
+                add_column(table.name, column)
+                added.setdefault(table.name, []).append(column.name)
+    return added
+
+
+def migrate():
+    """
+    Brings the database up to date with the models: creates the missing
+    tables, then the missing columns of the existing ones, then the
+    missing indexes. Run by init-db and by everything that starts the
+    app or an import, so an older database is upgraded before it is
+    queried.
+    """
+    db.create_all()
+    added = add_columns()
+    if 'imported' in added.get(Testing.__tablename__, ()):
+        # The import creates each accession's first test along with it
+        earliest = db.session.query(db.func.min(Testing.id)).group_by(Testing.accession_id)
+        db.session.query(Testing).filter(Testing.id.in_(earliest.scalar_subquery())).update(
+            {Testing.imported: True}, synchronize_session=False)
+    db.session.commit()
+    add_indexes()
+
+
+def add_indexes():
+    """
+    Creates any index defined on the models that is missing from the
+    database. create_all only adds indexes along with new tables.
+
+    SQLite can't reflect expression indexes, such as the lower() ones, so
+    there every index is created with IF NOT EXISTS rather than checked
+    for first.
+    """
+    sqlite = db.engine.dialect.name == 'sqlite'
+    with db.engine.begin() as connection:
+        for table in db.metadata.sorted_tables:
+            for index in table.indexes:
+                if sqlite:
+                    connection.execute(CreateIndex(index, if_not_exists=True))
+                else:
+                    index.create(connection, checkfirst=True)
+
+
+def recompute_availability():
+    """
+    Sets the totals of every availability row from its per-site amounts
+    with a single UPDATE, e.g. for rows written before the totals were
+    kept up to date, or by a write that bypasses the Availability flush
+    events. est_pls_avail is then recomputed for the accessions whose
+    lb_avail changed, in the same transaction. The caller commits.
+
+    :return: The number of rows updated.
+    """
+    table = Availability.__table__
+    gr_avail = sum(db.func.coalesce(table.c[name], 0) for name in AVAILABILITY_SITES)
+    sum_gr_no_grin = sum(db.func.coalesce(table.c[name], 0) for name in AVAILABILITY_SITES if name != 'grin_avail')
+    lb_avail = compute_gr_to_lb(gr_avail)
+    changed = [accession_id for accession_id, in db.session.execute(db.select(table.c.accession_id).where(
+        table.c.accession_id.isnot(None), db.or_(table.c.lb_avail.is_(None), table.c.lb_avail != lb_avail)))]
+    updated = db.session.execute(table.update().values(
+        gr_avail=gr_avail,
+        avail_any=gr_avail > 0,
+        lb_avail=lb_avail,
+        sum_gr_no_grin=sum_gr_no_grin,
+        avail_no_grin=sum_gr_no_grin > 0,
+        sum_lb_no_grin=compute_gr_to_lb(sum_gr_no_grin),
+    )).rowcount
+    if changed:
+        # The UPDATE bypasses the events that mark est_pls_avail stale.
+        # Imported here, as pls needs pandas
+        import pls
+        pls.update_est_pls_avail(changed)
+    return updated
 
 
 def compute_gr_to_lb(grams):
     return grams * 0.00220462
 
 
+def compute_ft_to_m(feet):
+    return feet * 0.3048
+
+
+def convert_dd_dms(dd):
+    degrees = int(dd)
+    minute_dec = (dd - degrees) * 60
+    minutes = int(minute_dec)
+    seconds = (minute_dec - minutes) * 60
+
+    return degrees, minutes, seconds
+
+
+def convert_dd_dms_columns(dd):
+    """
+    convert_dd_dms for a whole Series of decimal degrees at once. Missing
+    coordinates stay missing.
+    """
+    import numpy as np
+
+    dd = dd.astype(float)
+    degrees = np.trunc(dd)
+    minute_dec = (dd - degrees) * 60
+    minutes = np.trunc(minute_dec)
+    seconds = (minute_dec - minutes) * 60
+
+    return degrees.astype('Int64'), minutes.astype('Int64'), seconds
+
+
 seed_use_accessions = db.Table('project_accessions',
                                db.Column('seed_use_id', db.Integer, db.ForeignKey('seed_use.id')),
                                db.Column('accession_id', db.Integer, db.ForeignKey('accession.id'))
@@ -69,9 +221,13 @@ class Accession(db.Model):
     description = db.Column(db.Text)
     notes = db.Column(db.Text)
     increase = db.Column(db.Boolean)  # Slated for increase?
+    import_hash = db.Column(db.String(40))  # Hash of the export row this was imported from
 
-    species_id = db.Column(db.Integer, db.ForeignKey('species.id'))
-    geo_location_id = db.Column(db.Integer, db.ForeignKey('geo_location.id'))
+    # Case insensitive prefix searches, as in the typeahead API
+    __table_args__ = (db.Index('ix_accession_acc_num_lower', db.func.lower(acc_num)),)
+
+    species_id = db.Column(db.Integer, db.ForeignKey('species.id'), index=True)
+    geo_location_id = db.Column(db.Integer, db.ForeignKey('geo_location.id'), index=True)
 
     amounts_used = db.relationship('AmountUsed', backref='accession')
     geo_location = db.relationship('GeoLocation', backref=db.backref('accession', uselist=False), uselist=False)
@@ -98,9 +254,13 @@ class Accession(db.Model):
         self.description = description
         self.notes = notes
         self.increase = increase
-        self.species = species
         self.geo_location = geo_location
 
+        # Left unset rather than None so that a species_id assigned directly,
+        # as the importer does, is not cleared when the accession is flushed
+        if species is not None:
+            self.species = species
+
         # It is unlikely that the following will be known at the time of an Accession creation
         if projects:
             self.projects = projects
@@ -114,6 +274,46 @@ class Accession(db.Model):
     def __repr__(self):
         return "<Accession(acc_num={})>".format(self.acc_num)
 
+    @classmethod
+    def load_options(cls, profile):
+        """
+        :param profile: One of the keys of ACCESSION_PROFILES.
+        :return: The loader options of the profile, for any query of
+        accessions.
+        """
+        options = []
+        for path, loader in ACCESSION_PROFILES[profile].items():
+            names = path.split('.')
+            # The leading relationships of a path are loaded as their own
+            # entry in the profile says
+            option, model = None, cls
+            for name in names[:-1]:
+                attribute = getattr(model, name)
+                option = defaultload(attribute) if option is None else option.defaultload(attribute)
+                model = attribute.property.mapper.class_
+            attribute = getattr(model, names[-1])
+            options.append(loader(attribute) if option is None else getattr(option, loader.__name__)(attribute))
+        return options
+
+    @classmethod
+    def load(cls, ids, profile='summary'):
+        """
+        :param ids: The ids of the accessions to load.
+        :param profile: One of the keys of ACCESSION_PROFILES, naming the
+        relationships to load along with the accessions.
+        :return: A list of the accessions, in the order of ids, skipping
+        any that don't exist.
+
+        The number of queries depends on the profile, not the number of
+        accessions: one, plus one for each collection the profile loads.
+        """
+        ids = list(ids)
+        if not ids:
+            return []
+        accessions = {accession.id: accession
+                      for accession in cls.query.options(*cls.load_options(profile)).filter(cls.id.in_(ids))}
+        return [accessions[id] for id in ids if id in accessions]
+
 
 class Address(db.Model):
     """
@@ -170,10 +370,10 @@ class AmountUsed(db.Model):
     amount_gr = db.Column(db.Float)
     amount_lb = db.Column(db.Float)
 
-    accession_id = db.Column(db.Integer, db.ForeignKey('accession.id'))
+    accession_id = db.Column(db.Integer, db.ForeignKey('accession.id'), index=True)
     seed_use_id = db.Column(db.Integer, db.ForeignKey('seed_use.id'))
     species_id = db.Column(db.Integer, db.ForeignKey('species.id'))
-    shipment_id = db.Column(db.Integer, db.ForeignKey('shipment.id'))
+    shipment_id = db.Column(db.Integer, db.ForeignKey('shipment.id'), index=True)
 
     def __init__(self, amount_gr, species, accession=None):
         self.amount_gr = amount_gr
@@ -189,6 +389,11 @@ class AmountUsed(db.Model):
             self.species, self.accession, self.amount_gr, self.amount_lb)
 
 
+# The Availability columns of the grams available at each site
+AVAILABILITY_SITES = ('grin_avail', 'bend_avail', 'cbg_avail', 'meeker_avail', 'misc_avail', 'ephraim_avail',
+                      'nau_avail')
+
+
 class Availability(db.Model):
     """
     The Availability table has a One-to-One relationship with the
@@ -196,6 +401,12 @@ class Availability(db.Model):
 
     The Availability table has a Many-to-One relationship with the
     Entity table.
+
+    The totals, gr_avail, avail_any, lb_avail, sum_gr_no_grin,
+    avail_no_grin and sum_lb_no_grin, are computed from the per-site
+    amounts whenever a row is inserted or updated through the session,
+    so they can be filtered on, e.g. by gr_avail. Missing amounts count
+    as zero.
     """
     __tablename__ = 'availability'
 
@@ -208,14 +419,14 @@ class Availability(db.Model):
     ephraim_avail = db.Column(db.Float)
     nau_avail = db.Column(db.Float)
     avail_any = db.Column(db.Boolean)
-    gr_avail = db.Column(db.Float)
+    gr_avail = db.Column(db.Float, index=True)
     lb_avail = db.Column(db.Float)
     est_pls_avail = db.Column(db.Float)
     avail_no_grin = db.Column(db.Boolean)
     sum_gr_no_grin = db.Column(db.Float)
     sum_lb_no_grin = db.Column(db.Float)
 
-    accession_id = db.Column(db.Integer, db.ForeignKey('accession.id'))
+    accession_id = db.Column(db.Integer, db.ForeignKey('accession.id'), index=True)
     misc_avail_id = db.Column(db.Integer, db.ForeignKey('entity.id'))
 
     accession = db.relationship('Accession', backref=db.backref('availability', uselist=False), uselist=False)
@@ -235,26 +446,9 @@ class Availability(db.Model):
         self.accession = accession
         self.misc_avail_ent = misc_avail_ent
 
-        self.gr_avail = self.compute_gr_avail()
-
-        if self.check_avail_any():
-            self.avail_any = 1
-        else:
-            self.avail_any = 0
-
-        self.lb_avail = compute_gr_to_lb(self.gr_avail)
-
-        # TODO
-        # Implement method to compute est_pls_avail
-
-        self.sum_gr_no_grin = self.compute_gr_no_grin()
-
-        if self.check_avail_no_grin():
-            self.avail_no_grin = 1
-        else:
-            self.avail_no_grin = 0
-
-        self.sum_lb_no_grin = compute_gr_to_lb(self.sum_gr_no_grin)
+        # est_pls_avail depends on the accession's tests, so it is set by
+        # pls.update_est_pls_avail when this is committed
+        self.update_totals()
 
     def __repr__(self):
         return ("<Availability(accession={}, avail_any={}, est_pls_avail={}, avail_no_grin={}, "
@@ -262,6 +456,17 @@ class Availability(db.Model):
             self.accession, self.avail_any, self.est_pls_avail, self.avail_no_grin,
             self.grin_avail, self.bend_avail, self.cbg_avail, self.meeker_avail))
 
+    def update_totals(self):
+        """
+        Sets the totals from the per-site amounts.
+        """
+        self.gr_avail = self.compute_gr_avail()
+        self.avail_any = self.check_avail_any()
+        self.lb_avail = compute_gr_to_lb(self.gr_avail)
+        self.sum_gr_no_grin = self.compute_gr_no_grin()
+        self.avail_no_grin = self.check_avail_no_grin()
+        self.sum_lb_no_grin = compute_gr_to_lb(self.sum_gr_no_grin)
+
     def check_avail_any(self):
         if self.gr_avail > 0:
             return True
@@ -275,12 +480,16 @@ class Availability(db.Model):
             return False
 
     def compute_gr_avail(self):
-        return (self.grin_avail + self.bend_avail + self.cbg_avail + self.meeker_avail +
-                self.misc_avail + self.ephraim_avail + self.nau_avail)
+        return sum(getattr(self, name) or 0 for name in AVAILABILITY_SITES)
 
     def compute_gr_no_grin(self):
-        return (self.bend_avail + self.cbg_avail + self.meeker_avail + self.misc_avail +
-                self.ephraim_avail + self.nau_avail)
+        return sum(getattr(self, name) or 0 for name in AVAILABILITY_SITES if name != 'grin_avail')
+
+
+@event.listens_for(Availability, 'before_insert')
+@event.listens_for(Availability, 'before_update')
+def _update_availability_totals(mapper, connection, availability):
+    availability.update_totals()
 
 
 seed_use_contacts = db.Table('seed_use_contacts',
@@ -346,6 +555,22 @@ class Contact(db.Model):
             self.first_name, self.last_name)
 
 
+class DataVersion(db.Model):
+    """
+    The DataVersion table counts the writes to each table that has its
+    choice list cached by choices.py. A process's cached list is current
+    for as long as the table's version is unchanged, whichever process
+    made the last write.
+    """
+    __tablename__ = 'data_version'
+
+    table_name = db.Column(db.String(50), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return "<DataVersion(table_name={}, version={})>".format(self.table_name, self.version)
+
+
 seed_use_entity = db.Table('seed_use_entity',
                            db.Column('seed_use_id', db.Integer, db.ForeignKey('seed_use.id')),
                            db.Column('entity_id', db.Integer, db.ForeignKey('entity.id'))
@@ -388,6 +613,8 @@ class Entity(db.Model):
     # If we need to calculate things by cost, store dollars and cents separately
     cost = db.Column(db.Float)  # How much?
 
+    __table_args__ = (db.Index('ix_entity_name_lower', db.func.lower(name)),)
+
     address_id = db.Column(db.Integer, db.ForeignKey('address.id'))
 
     address = db.relationship('Address', backref='entity', uselist=False)
@@ -465,6 +692,9 @@ class GeoLocation(db.Model):
     state = db.Column(db.String(20))  # Formerly SUB_CNT1
     county = db.Column(db.String(30))  # Formerly SUB_CNT2
 
+    # Collection sites are looked up by state, or by state and county
+    __table_args__ = (db.Index('ix_geo_location_state_county', state, county),)
+
     zone = db.relationship('Zone', backref='geo_location', uselist=False)
     visits = db.relationship('Visit', backref='geo_location')
 
@@ -667,8 +897,8 @@ class Shipment(db.Model):
     shipper = db.Column(db.String(30))  # E.g. Fedex
     num_packages = db.Column(db.Integer)  # How many packages make up this shipment?
 
-    origin_entity_id = db.Column(db.Integer, db.ForeignKey('entity.id'))
-    destination_entity_id = db.Column(db.Integer, db.ForeignKey('entity.id'))
+    origin_entity_id = db.Column(db.Integer, db.ForeignKey('entity.id'), index=True)
+    destination_entity_id = db.Column(db.Integer, db.ForeignKey('entity.id'), index=True)
 
     origin_entity = db.relationship('Entity', foreign_keys=[origin_entity_id])
     destination_entity = db.relationship('Entity', foreign_keys=[destination_entity_id])
@@ -713,11 +943,66 @@ class Shipment(db.Model):
         self.amounts_sent.append(amount)
 
     def get_accessions(self):
-        accessions = []
-        for amount in self.amounts_sent:
-            accessions.append(amount.accession)
+        """
+        :return: A list of the accessions sent in this shipment, each once,
+        in the order they were added.
+        """
+        if self.id is None:
+            # Not flushed yet, so the amounts are only in memory
+            accessions = []
+            for amount in self.amounts_sent:
+                if amount.accession is not None and amount.accession not in accessions:
+                    accessions.append(amount.accession)
+            return accessions
+        return Accession.query.join(AmountUsed, AmountUsed.accession_id == Accession.id).filter(
+            AmountUsed.shipment_id == self.id).group_by(Accession.id).order_by(db.func.min(AmountUsed.id)).all()
+
+    def get_manifest(self):
+        """
+        :return: The lines of this shipment's manifest, see manifests.
+        """
+        return Shipment.manifests(Shipment.id == self.id).get(self.id, [])
 
-        return accessions
+    @classmethod
+    def manifests(cls, *criteria):
+        """
+        :param criteria: Filters of the shipments to list, e.g.
+        Shipment.id.in_(ids), or none for every shipment.
+        :return: A dict of shipment id to the lines of its manifest, for
+        each of the shipments that has any amounts sent.
+
+        A line totals the amounts of one accession and species in one
+        shipment. It has shipment_id, accession_id, acc_num, species_id,
+        name_full, amount_gr and amount_lb attributes, and lines are in
+        acc_num order. Every line comes from a single joined query.
+        """
+        query = db.session.query(
+            AmountUsed.shipment_id, AmountUsed.accession_id, Accession.acc_num, AmountUsed.species_id,
+            Species.name_full, db.func.sum(AmountUsed.amount_gr).label('amount_gr'),
+            db.func.sum(AmountUsed.amount_lb).label('amount_lb')
+        ).join(cls, cls.id == AmountUsed.shipment_id).outerjoin(
+            Accession, Accession.id == AmountUsed.accession_id).outerjoin(
+            Species, Species.id == AmountUsed.species_id).filter(*criteria).group_by(
+            AmountUsed.shipment_id, AmountUsed.accession_id, Accession.acc_num, AmountUsed.species_id,
+            Species.name_full).order_by(AmountUsed.shipment_id, Accession.acc_num, Species.name_full)
+
+        manifests = {}
+        for line in query:
+            manifests.setdefault(line.shipment_id, []).append(line)
+        return manifests
+
+    @classmethod
+    def manifests_between(cls, start, end):
+        """
+        :param start: The first ship date, a datetime.date.
+        :param end: The last ship date, a datetime.date.
+        :return: The manifests of the shipments shipped from start to end
+        inclusive, as returned by manifests, e.g. to reconcile a season's
+        shipments.
+        """
+        after_end = datetime.datetime.combine(end + datetime.timedelta(days=1), datetime.time())
+        return cls.manifests(cls.ship_date >= datetime.datetime.combine(start, datetime.time()),
+                             cls.ship_date < after_end)
 
 
 seed_use_species = db.Table('seed_use_species',
@@ -754,8 +1039,8 @@ class Species(db.Model):
     symbol = db.Column(db.String(10), unique=True)
     name_full = db.Column(db.String(100), unique=True)
     common = db.Column(db.String(50))
-    family = db.Column(db.String(30))
-    genus = db.Column(db.String(30))
+    family = db.Column(db.String(30), index=True)
+    genus = db.Column(db.String(30), index=True)
     species = db.Column(db.String(30))
     var_ssp1 = db.Column(db.String(30))
     var_ssp2 = db.Column(db.String(30))
@@ -766,7 +1051,10 @@ class Species(db.Model):
     poll_val = db.Column(db.Boolean)
     research_val = db.Column(db.Boolean)
 
-    parent_id = db.Column(db.Integer, db.ForeignKey('species.id'))
+    parent_id = db.Column(db.Integer, db.ForeignKey('species.id'), index=True)
+
+    # Case insensitive prefix searches, as in the typeahead API
+    __table_args__ = (db.Index('ix_species_name_full_lower', db.func.lower(name_full)),)
 
     accessions = db.relationship('Accession', backref='species', lazy='dynamic')
     amounts_used = db.relationship('AmountUsed', backref='species')
@@ -840,8 +1128,9 @@ class Testing(db.Model):
     purity = db.Column(db.Integer)
     tz = db.Column(db.Integer)
     fill = db.Column(db.Integer)
+    imported = db.Column(db.Boolean, default=False)  # Whether this is the test read from the accession export
 
-    accession_id = db.Column(db.Integer, db.ForeignKey('accession.id'))
+    accession_id = db.Column(db.Integer, db.ForeignKey('accession.id'), index=True)
     entity_id = db.Column(db.Integer, db.ForeignKey('entity.id'))
 
     def __init__(
@@ -867,6 +1156,55 @@ class Testing(db.Model):
                     self.est_pls_lb, self.est_pls_collected, self.purity, self.tz))
 
 
+# The columns Availability.est_pls_avail is computed from. Writing one of
+# them through the session recomputes the accession's est_pls_avail when
+# the session commits. Writes that bypass the session events, like the
+# bulk imports, call pls.update_est_pls_avail themselves.
+EST_PLS_INPUTS = {
+    Availability: ('accession_id', 'lb_avail'),
+    Testing: ('accession_id', 'test_date', 'est_pls_lb', 'est_seed_lb', 'purity', 'tz'),
+}
+
+
+def _stale_est_pls(session):
+    return session.info.setdefault('stale_est_pls', set())
+
+
+@event.listens_for(Availability, 'after_insert')
+@event.listens_for(Testing, 'after_insert')
+@event.listens_for(Testing, 'after_delete')
+def _mark_est_pls_stale(mapper, connection, target):
+    _stale_est_pls(object_session(target)).add(target.accession_id)
+
+
+@event.listens_for(Availability, 'after_update')
+@event.listens_for(Testing, 'after_update')
+def _mark_changed_est_pls_stale(mapper, connection, target):
+    if any(get_history(target, name).has_changes() for name in EST_PLS_INPUTS[mapper.class_]):
+        stale = _stale_est_pls(object_session(target))
+        stale.add(target.accession_id)
+        # A test moved to another accession changes the old one's too
+        stale.update(get_history(target, 'accession_id').deleted)
+
+
+@event.listens_for(db.session, 'before_commit')
+def _update_stale_est_pls(session):
+    # Flushed first, so that the writes being committed have marked their
+    # accessions. Commit flushes next anyway, so this costs nothing more.
+    session.flush()
+    stale = session.info.pop('stale_est_pls', set())
+    stale.discard(None)
+    if stale:
+        # Imported here, as pls needs pandas
+        import pls
+        pls.update_est_pls_avail(stale, session)
+
+
+@event.listens_for(db.session, 'after_soft_rollback')
+def _discard_stale_est_pls(session, previous_transaction):
+    session.info.pop('stale_est_pls', None)
+
+
 class Visit(db.Model):
     """
     The Visit table has a Many-to-One relationship with the Accession 
@@ -890,7 +1228,7 @@ class Visit(db.Model):
     habitat = db.Column(db.String(100))
     population_size = db.Column(db.Integer)
 
-    accession_id = db.Column(db.Integer, db.ForeignKey('accession.id'))
+    accession_id = db.Column(db.Integer, db.ForeignKey('accession.id'), index=True)
     geo_location_id = db.Column(db.Integer, db.ForeignKey('geo_location.id'))
     species_id = db.Column(db.Integer, db.ForeignKey('species.id'))
 
@@ -907,7 +1245,10 @@ class Visit(db.Model):
         self.population_size = population_size
         self.accession = accession
         self.geo_location = geo_location
-        self.species = species
+
+        # See Accession.__init__
+        if species is not None:
+            self.species = species
 
     def __repr__(self):
         return "<Visit(date={}, species={}, accession={}, population_size={})>".format(
@@ -926,7 +1267,7 @@ class Zone(db.Model):
 
     id = db.Column(db.Integer, primary_key=True)
     ptz = db.Column(db.String(30))
-    us_l4_code = db.Column(db.String(10))
+    us_l4_code = db.Column(db.String(10), index=True)
     us_l4_name = db.Column(db.String(30))
     us_l3_code = db.Column(db.String(10))
     us_l3_name = db.Column(db.String(30))
@@ -954,7 +1295,7 @@ class Zone(db.Model):
     avail_strict = db.Column(db.Boolean)
     usgs_zone = db.Column(db.Integer)
 
-    geo_location_id = db.Column(db.Integer, db.ForeignKey('geo_location.id'))
+    geo_location_id = db.Column(db.Integer, db.ForeignKey('geo_location.id'), index=True)
     release_id = db.Column(db.Integer, db.ForeignKey('release.id'))
 
     def __init__(
@@ -0,0 +1,118 @@
+"""
+CPNPP Database
+
+Computes Availability.est_pls_avail, the estimated pure live seed (PLS)
+available of each accession: the pounds available times the PLS per
+pound found by the accession's most recent test.
+
+A test's PLS per pound is its est_pls_lb. Tests without one fall back to
+est_seed_lb scaled by purity and TZ viability. Accessions without a test,
+or whose latest test has neither, have no est_pls_avail. A test's fill,
+the share of seeds that are filled, is not used: TZ viability is scored
+over the whole sample, empty seeds included, so scaling by fill as well
+would count the empty seeds twice.
+
+Only the accessions whose inputs changed are recomputed. Writing one of
+the models.EST_PLS_INPUTS columns through the session, e.g. a test from
+the testing form or per-site amounts that change lb_avail, marks the
+accession, and the marked accessions are recomputed when the session
+commits. The imports, which bypass the session events, recompute the
+accessions they wrote. Within those, only the rows whose value changed
+are written. After writes that bypass both, such as SQL run by hand,
+run it for every accession with
+
+    python pls.py
+
+or for some with --accession.
+"""
+import argparse
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import bindparam
+
+from app import create_app
+from models import db, Availability, Testing
+
+# The columns of the latest test used to compute PLS per pound
+TEST_FIELDS = ('est_pls_lb', 'est_seed_lb', 'purity', 'tz')
+
+
+def load_inputs(accession_ids=None, session=None):
+    """
+    :param accession_ids: The accessions to load, or None for all of them.
+    :param session: The session to query. Defaults to db.session.
+    :return: A DataFrame with a row for each availability row, with its
+    id, accession_id, lb_avail and current est_pls_avail, and the
+    TEST_FIELDS of its accession's latest test, missing if it has none.
+    """
+    session = session or db.session
+    availability = session.query(Availability.id, Availability.accession_id, Availability.lb_avail,
+                                    Availability.est_pls_avail).filter(Availability.accession_id.isnot(None))
+    tests = session.query(Testing.accession_id, Testing.test_date, Testing.id,
+                             *[getattr(Testing, name) for name in TEST_FIELDS]).join(
+        Availability, Availability.accession_id == Testing.accession_id)
+    if accession_ids is not None:
+        accession_ids = list(accession_ids)
+        availability = availability.filter(Availability.accession_id.in_(accession_ids))
+        tests = tests.filter(Testing.accession_id.in_(accession_ids))
+
+    frame = pd.DataFrame.from_records(availability.all(),
+                                      columns=['id', 'accession_id', 'lb_avail', 'est_pls_avail'])
+    tests = pd.DataFrame.from_records(tests.all(),
+                                      columns=['accession_id', 'test_date', 'test_id'] + list(TEST_FIELDS))
+    # Undated tests count as the oldest, and tests on the same date by
+    # the order they were entered
+    latest = tests.sort_values(['accession_id', 'test_date', 'test_id'], na_position='first').drop_duplicates(
+        'accession_id', keep='last')
+    return frame.merge(latest[['accession_id'] + list(TEST_FIELDS)], on='accession_id', how='left')
+
+
+def compute_est_pls_avail(frame):
+    """
+    :param frame: A DataFrame as returned by load_inputs.
+    :return: A float Series of est_pls_avail for each row, NaN where it
+    can't be computed.
+    """
+    inputs = frame[['lb_avail'] + list(TEST_FIELDS)].astype(float)
+    pls_per_lb = inputs['est_pls_lb'].fillna(inputs['est_seed_lb'] * inputs['purity'] / 100 * inputs['tz'] / 100)
+    return inputs['lb_avail'] * pls_per_lb
+
+
+def update_est_pls_avail(accession_ids=None, session=None):
+    """
+    Sets est_pls_avail of the availability rows of the given accessions,
+    or of every accession, with one executemany UPDATE of the rows whose
+    value changed, in session or db.session. The caller commits.
+
+    :return: A tuple of the numbers of rows updated and left unchanged.
+    """
+    session = session or db.session
+    frame = load_inputs(accession_ids, session)
+    new = compute_est_pls_avail(frame)
+    old = frame['est_pls_avail'].astype(float)
+    changed = ~(new.eq(old) | (new.isnull() & old.isnull()))
+    if changed.any():
+        params = [{'b_id': int(row_id), 'est_pls_avail': None if np.isnan(value) else float(value)}
+                  for row_id, value in zip(frame['id'][changed], new[changed])]
+        table = Availability.__table__
+        session.execute(table.update().where(table.c.id == bindparam('b_id')).values(
+            est_pls_avail=bindparam('est_pls_avail')), params)
+    return int(changed.sum()), int((~changed).sum())
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Compute the estimated pure live seed available of accessions '
+                                                 'from their latest test.')
+    parser.add_argument('--accession', type=int, action='append', dest='accession_ids', metavar='ID',
+                        help='Only update this accession. May be repeated. Defaults to every accession.')
+    args = parser.parse_args(argv)
+
+    with create_app().app_context():
+        updated, unchanged = update_est_pls_avail(args.accession_ids)
+        db.session.commit()
+    print('Updated est_pls_avail of {} availability rows, {} were unchanged.'.format(updated, unchanged))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,273 +1,978 @@
+import argparse
+from collections import namedtuple
+import datetime
+import hashlib
+import itertools
+import json
+import multiprocessing
+import os
+import sys
+import time
+
 import pandas as pd
+from sqlalchemy import bindparam, func
 from sqlalchemy.exc import IntegrityError
 
-from app import app
-from models import db, Availability, Species, Accession, GeoLocation, GeoLocationDescription, Testing, Zone
-
-df = pd.read_excel('complete_plants_checklist_usda.xlsx')
-db_df = pd.read_excel('DB_export_updated123016_noGRINavail_with_SWSP_data.xlsx')
-
-
-def parse_excel(df):
-    for index, row in df.iterrows():
-        zone, desc, loc = get_zone_desc_loc(row)
-        species, acc = get_species_acc(row)
-
-        if add_acc_to_db(zone, desc, loc, species, acc):
-            test = get_test(row, acc)
-            add_test_to_db(test)
-
-
-def add_synonyms(df):
-    for index, row in df.iterrows():  # Check if row has synonyms
-        check_synonym(row)
-
-
-def add_species(df):
-    for index, row in df.iterrows():
-        get_plant(row)
-
-
-# TODO
-"""
-Adding those singular model objects to the database could be refactored to be a little more DRY compliant.
-"""
+from app import create_app
+from exports import (ACCESSION_COLUMNS, AVAILABILITY_COLUMNS, GEO_LOCATION_COLUMNS, TEST_COLUMNS, VISIT_COLUMNS,
+                     ZONE_COLUMNS)
+from metrics import record_import
+from models import (compute_gr_to_lb, convert_dd_dms, convert_dd_dms_columns, db, migrate, Availability, Species,
+                    Accession, GeoLocation, Testing, Visit, Zone)
+from pls import update_est_pls_avail
+from workbooks import iter_chunks, iter_rows, row_count
+
+CHECKLIST_FILE = 'complete_plants_checklist_usda.xlsx'
+DB_EXPORT_FILE = 'DB_export_updated123016_noGRINavail_with_SWSP_data.xlsx'
+
+# Where each stage records how far it got, for --resume
+JOURNAL_FILE = '.import_journal.json'
+
+# The stages of an import, in the order they run, and the workbook each
+# one reads
+STAGES = ('species', 'synonyms', 'accessions')
+STAGE_FILES = {'species': CHECKLIST_FILE, 'synonyms': CHECKLIST_FILE, 'accessions': DB_EXPORT_FILE}
+
+# Number of accession rows committed together by parse_excel. A batch
+# size of 1 commits every accession in its own transaction.
+BATCH_SIZE = 500
+
+# Number of processes transforming export rows in parse_excel
+WORKERS = max(1, multiprocessing.cpu_count() - 1)
+
+# The records built from a single row of the accession export, keyed by
+# column name, plus the species name to resolve when they are written
+AccessionRecord = namedtuple('AccessionRecord', ['species_name', 'zone', 'geo_location', 'visit', 'accession',
+                                                 'test'])
+
+# The outcome of add_synonyms. unresolved holds (synonym, accepted)
+# symbol pairs missing from the database and conflicts maps synonyms to
+# every accepted symbol they are listed under.
+SynonymReport = namedtuple('SynonymReport', ['linked', 'unresolved', 'conflicts'])
+
+# The outcome of parse_excel. rejected holds the acc_nums that were not
+# written, either because they already exist or are repeated.
+ImportReport = namedtuple('ImportReport', ['inserted', 'updated', 'unchanged', 'rejected'])
+
+
+class SpeciesIndex(object):
+    """
+    An in-memory map of species symbols and names to Species ids.
+
+    Building the index costs a single query, after which resolving a
+    species during an import is a dictionary lookup rather than a round
+    trip to the database. Species inserted during the import must be
+    registered with add so that later rows can resolve them.
+    """
+    def __init__(self):
+        self.by_symbol = {}
+        self.by_name = {}
+        self.by_normalized_name = {}
+
+    @classmethod
+    def load(cls):
+        index = cls()
+        for species_id, symbol, name_full in db.session.query(Species.id, Species.symbol, Species.name_full):
+            index.add(species_id, symbol, name_full)
+        return index
+
+    def add(self, species_id, symbol, name_full):
+        if symbol is not None:
+            self.by_symbol[symbol] = species_id
+        if name_full is not None:
+            self.by_name[name_full] = species_id
+            self.by_normalized_name.setdefault(normalize_name(name_full), species_id)
+
+    def get_by_symbol(self, symbol):
+        return self.by_symbol.get(symbol)
+
+    def get_by_name(self, name):
+        """
+        :param name: A species name, with or without its author.
+        :return: The id of the species, or None if it is not known.
+
+        Falls back to matching the name without its author, case or
+        extra whitespace when there is no exact match.
+        """
+        if not isinstance(name, str):
+            return None
+        species_id = self.by_name.get(name)
+        if species_id is None:
+            species_id = self.by_normalized_name.get(normalize_name(name))
+        return species_id
+
+
+def normalize_name(name):
+    """
+    :param name: A species name such as 'Zygodon viridissimus (Dicks.)
+    Brid. var. dentatus (Breidl.) Limpr.'
+    :return: The lower case genus, species and ssp./var. of the name,
+    e.g. 'zygodon viridissimus var. dentatus'.
+    """
+    tokens = ['ssp.' if token == 'subsp.' else token for token in name.split()]
+    normalized = tokens[:2]
+    # ssp. takes precedence over var., as in get_plants
+    for rank in ('ssp.', 'var.'):
+        if rank in tokens[2:]:
+            index = tokens.index(rank, 2)
+            normalized += tokens[index:index + 2]
+            break
+    return ' '.join(normalized).lower()
+
+
+class Journal(object):
+    """
+    A JSON file recording how many rows of its workbook each stage of
+    an import has committed, so that an interrupted import can resume
+    after the last committed batch rather than start over.
+
+    The file is rewritten after every checkpoint by writing a temporary
+    file and renaming it over the old one, so a crash leaves either the
+    previous or the new checkpoint, never a partial file.
+    """
+    def __init__(self, path=JOURNAL_FILE):
+        self.path = path
+        try:
+            with open(path) as f:
+                self.stages = json.load(f)
+        except (IOError, ValueError):
+            self.stages = {}
+
+    def reset(self):
+        self.stages = {}
+        self.save()
+
+    def start(self, stage, source):
+        """
+        :param stage: Name of the stage.
+        :param source: Path of the workbook the stage reads.
+        :return: The row offset to resume the stage from.
+
+        A stage whose workbook was modified since it was journaled
+        starts over from the first row.
+        """
+        stat = os.stat(source)
+        entry = self.stages.get(stage)
+        if entry is not None and (entry['source'] != source or entry['mtime'] != stat.st_mtime):
+            print('[!] {} changed since the last {} import, starting it over.'.format(source, stage))
+            entry = None
+        if entry is None:
+            entry = {'source': source, 'mtime': stat.st_mtime, 'offset': 0, 'done': False}
+            self.stages[stage] = entry
+            self.save()
+        return entry['offset']
+
+    def offset(self, stage):
+        return self.stages.get(stage, {}).get('offset', 0)
+
+    def is_done(self, stage):
+        return self.stages.get(stage, {}).get('done', False)
+
+    def checkpoint(self, stage, offset):
+        self.stages[stage]['offset'] = offset
+        self.save()
+
+    def finish(self, stage):
+        self.stages[stage]['done'] = True
+        self.save()
+
+    def save(self):
+        tmp_file = self.path + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(self.stages, f, indent=2, sort_keys=True)
+        os.replace(tmp_file, self.path)
+
+
+class Progress(object):
+    """
+    Prints how many rows a stage has processed, its rate in rows/sec and
+    an estimate of the time remaining, at most once every interval
+    seconds. Every update is also counted in the import metrics.
+    """
+    def __init__(self, stage, total=None, done=0, interval=2.0):
+        self.stage = stage
+        self.total = total
+        self.done = done
+        self.interval = interval
+        self.resumed_at = done
+        self.started = self.last_report = time.time()
+
+    def update(self, rows):
+        self.done += rows
+        record_import(self.stage, rows)
+        now = time.time()
+        if now - self.last_report >= self.interval:
+            self.last_report = now
+            print(self.status(now))
+
+    def finish(self):
+        now = time.time()
+        print('{} in {}.'.format(self.status(now), datetime.timedelta(seconds=int(now - self.started))))
+
+    def rate(self, now):
+        elapsed = now - self.started
+        return (self.done - self.resumed_at) / elapsed if elapsed > 0 else 0.0
+
+    def status(self, now):
+        rate = self.rate(now)
+        status = '[{}] {} rows'.format(self.stage, self.done)
+        if self.total:
+            status += ' of {} ({:.0%})'.format(self.total, min(1.0, self.done / self.total))
+        status += ', {:.0f} rows/sec'.format(rate)
+        if self.total and rate and self.done < self.total:
+            status += ', ETA {}'.format(datetime.timedelta(seconds=int((self.total - self.done) / rate)))
+        return status
+
+
+def parse_excel(rows, batch_size=BATCH_SIZE, index=None, workers=WORKERS, incremental=False, journal=None,
+                progress=None):
+    """
+    :param rows: An iterable of rows from the accession export, such as
+    iter_rows(DB_EXPORT_FILE).
+    :param batch_size: How many rows to group into a single transaction.
+    :param index: SpeciesIndex used to resolve species names. Loaded
+    from the database if not given.
+    :param workers: Number of processes used to transform rows.
+    :param incremental: Update accessions that are already in the
+    database instead of rejecting them.
+    :param journal: Journal to resume the 'accessions' stage from and to
+    checkpoint after every batch.
+    :param progress: Progress to report each batch to.
+    :return: An ImportReport.
+
+    Rows are turned into GeoLocation, Accession, Zone, Visit and Testing
+    records by a pool of worker processes, while this process alone
+    writes them batch_size rows per transaction. Batches are written in
+    the order of the export, so the result does not depend on the number
+    of workers.
+
+    In incremental mode every accession's import_hash is loaded up
+    front. Rows with a new acc_num are inserted, rows whose hash differs
+    from the stored one are updated in place and identical rows are not
+    written at all. A repeated acc_num within the export is rejected.
+
+    When resuming, the rows before the journaled offset are skipped. A
+    batch interrupted before its checkpoint is written again, and its
+    committed rows are then rejected as duplicates or, in incremental
+    mode, left unchanged.
+    """
+    if index is None:
+        index = SpeciesIndex.load()
+
+    offset = 0
+    if journal is not None:
+        offset = journal.offset('accessions')
+        rows = itertools.islice(rows, offset, None)
+
+    existing = None
+    seen = set()
+    if incremental:
+        existing = load_import_hashes()
+
+    report = ImportReport(inserted=0, updated=0, unchanged=0, rejected=[])
+    for batch in transform_rows(rows, batch_size, workers):
+        rows_read = len(batch)
+        if existing is not None:
+            batch, changed, unchanged, duplicates = split_batch(batch, existing, seen)
+            update_batch(changed, existing, index)
+            report = report._replace(updated=report.updated + len(changed),
+                                     unchanged=report.unchanged + unchanged,
+                                     rejected=report.rejected + duplicates)
+            for acc_num in duplicates:
+                print('[!] {} appears more than once in the export!'.format(acc_num))
+
+        rejected = add_batch_to_db(batch, index)
+        report = report._replace(inserted=report.inserted + len(batch) - len(rejected),
+                                 rejected=report.rejected + rejected)
+
+        offset += rows_read
+        if journal is not None:
+            journal.checkpoint('accessions', offset)
+        if progress is not None:
+            progress.update(rows_read)
+
+    print('Inserted {}, updated {} and left {} accessions unchanged.'.format(
+        report.inserted, report.updated, report.unchanged))
+    if report.rejected:
+        print('[!] {} accessions were not added: {}'.format(len(report.rejected), ', '.join(report.rejected)))
+    return report
+
+
+def load_import_hashes():
+    """
+    :return: Dict of every acc_num in the database to a tuple of the
+    accession's id, geo_location_id and import_hash.
+    """
+    query = db.session.query(Accession.acc_num, Accession.id, Accession.geo_location_id, Accession.import_hash)
+    return {acc_num: (acc_id, geo_location_id, import_hash) for acc_num, acc_id, geo_location_id, import_hash in query}
+
+
+def split_batch(batch, existing, seen):
+    """
+    :param batch: A list of AccessionRecords.
+    :param existing: Dict returned by load_import_hashes.
+    :param seen: Set of the acc_nums already handled in this import,
+    which is updated with the ones in the batch.
+    :return: A tuple of the records to insert, the records to update, the
+    number of unchanged records and the repeated acc_nums.
+    """
+    new = []
+    changed = []
+    unchanged = 0
+    duplicates = []
+    for record in batch:
+        acc_num = record.accession['acc_num']
+        if acc_num in seen:
+            duplicates.append(acc_num)
+            continue
+        seen.add(acc_num)
+
+        if acc_num not in existing:
+            new.append(record)
+        elif existing[acc_num][2] != record.accession['import_hash']:
+            changed.append(record)
+        else:
+            unchanged += 1
+    return new, changed, unchanged, duplicates
 
 
-def add_acc_to_db(zone, location_description, location, species, accession):
-    db.session.add(zone)
-    db.session.add(location_description)
-    db.session.add(location)
-    db.session.add(species)
-    db.session.add(accession)
-    try:
-        db.session.commit()
-        print('Successfully added {} to database!'.format(accession.acc_num))
-        return True
-    except IntegrityError:
-        db.session.rollback()
-        print('[!] {} already exists in the database!'.format(accession.acc_num))
-        return False
+def update_batch(batch, existing, index):
+    """
+    Overwrites the stored rows of each changed accession with its new
+    records, one executemany UPDATE per table, in a single transaction.
 
+    Only the imported test is overwritten, leaving tests entered since
+    alone. Zone, Visit and test rows the accession is missing, e.g.
+    because they were deleted, are inserted instead.
+    """
+    if not batch:
+        return
 
-def add_plant_to_db(plant):
-    db.session.add(plant)
+    stored = [existing[record.accession['acc_num']] for record in batch]
+    acc_ids = [acc_id for acc_id, geo_location_id, import_hash in stored]
+    geo_location_ids = [geo_location_id for acc_id, geo_location_id, import_hash in stored]
+    with_zone = set(geo_location_id for geo_location_id, in db.session.query(Zone.geo_location_id).filter(
+        Zone.geo_location_id.in_(geo_location_ids)))
+    with_visit = set(acc_id for acc_id, in db.session.query(Visit.accession_id).filter(
+        Visit.accession_id.in_(acc_ids)))
+    with_test = set(acc_id for acc_id, in db.session.query(Testing.accession_id).filter(
+        Testing.accession_id.in_(acc_ids), Testing.imported.is_(True)))
+
+    accessions = []
+    locations = []
+    zones, new_zones = [], []
+    visits, new_visits = [], []
+    tests, new_tests = [], []
+    for record, (acc_id, geo_location_id, import_hash) in zip(batch, stored):
+        species_id = index.get_by_name(record.species_name)
+        accessions.append(dict(record.accession, species_id=species_id, b_id=acc_id))
+        locations.append(dict(record.geo_location, b_id=geo_location_id))
+        if geo_location_id in with_zone:
+            zones.append(dict(record.zone, b_geo_location_id=geo_location_id))
+        else:
+            new_zones.append(dict(record.zone, geo_location_id=geo_location_id))
+        if acc_id in with_visit:
+            visits.append(dict(record.visit, species_id=species_id, b_accession_id=acc_id))
+        else:
+            new_visits.append(dict(record.visit, geo_location_id=geo_location_id, accession_id=acc_id,
+                                   species_id=species_id))
+        if acc_id in with_test:
+            tests.append(dict(record.test, b_accession_id=acc_id))
+        else:
+            new_tests.append(dict(record.test, accession_id=acc_id, imported=True))
+
+    for model, column, params in ((Accession, 'id', accessions), (GeoLocation, 'id', locations),
+                                  (Zone, 'geo_location_id', zones), (Visit, 'accession_id', visits),
+                                  (Testing, 'accession_id', tests)):
+        if not params:
+            continue
+        table = model.__table__
+        statement = table.update().where(table.c[column] == bindparam('b_' + column))
+        if model is Testing:
+            statement = statement.where(table.c.imported.is_(True))
+        db.session.execute(statement, params)
+    for model, params in ((Zone, new_zones), (Visit, new_visits), (Testing, new_tests)):
+        if params:
+            db.session.bulk_insert_mappings(model, params)
+    # The executemany updates bypass the session events
+    update_est_pls_avail(acc_ids)
+    db.session.commit()
+
+    for record in batch:
+        print('Updated {} in database.'.format(record.accession['acc_num']))
+
+
+def bulk_import(chunks, index=None, journal=None, progress=None):
+    """
+    :param chunks: An iterable of accession export DataFrames, such as
+    iter_chunks(DB_EXPORT_FILE).
+    :param index: SpeciesIndex used to resolve species names. Loaded
+    from the database if not given.
+    :param journal: Journal to resume the 'accessions' stage from and to
+    checkpoint after every chunk.
+    :param progress: Progress to report each chunk to.
+    :return: An ImportReport.
+
+    A faster alternative to parse_excel for loading a whole export. Each
+    chunk is transformed column-wise into one DataFrame per table, and
+    each table is written with a single Core executemany, one transaction
+    per chunk. No ORM objects are created.
+
+    Ids are allocated up front from the highest id in each table, which
+    relies on nothing else writing to these tables during the import.
+    Acc_nums that are already in the database or repeated in the export
+    are rejected before anything is written. The availability table, and
+    its est_pls_avail, is only written if the export has the
+    AVAILABILITY_COLUMNS.
+
+    Accessions are written without an import_hash, so the first
+    incremental parse_excel after a bulk import updates every row once.
+    """
+    if index is None:
+        index = SpeciesIndex.load()
+
+    offset = 0
+    if journal is not None:
+        offset = journal.offset('accessions')
+    if offset:
+        chunks = skip_rows(chunks, offset)
+
+    next_ids = {model: (db.session.query(func.max(model.id)).scalar() or 0) + 1
+                for model in (Accession, GeoLocation, Zone, Visit, Testing, Availability)}
+    seen = set(acc_num for acc_num, in db.session.query(Accession.acc_num))
+
+    report = ImportReport(inserted=0, updated=0, unchanged=0, rejected=[])
+    for chunk in chunks:
+        rows_read = len(chunk)
+        duplicate = pd.Series([acc_num in seen for acc_num in chunk['ACC_NUM']], index=chunk.index)
+        duplicate |= chunk['ACC_NUM'].duplicated()
+        rejected = list(chunk['ACC_NUM'][duplicate])
+        for acc_num in rejected:
+            print('[!] {} already exists in the database!'.format(acc_num))
+        chunk = chunk[~duplicate].reset_index(drop=True)
+        seen.update(chunk['ACC_NUM'])
+
+        if not chunk.empty:
+            frames = get_frames(chunk, index, next_ids)
+            try:
+                for model, frame in frames:
+                    insert_frame(model.__table__, frame)
+                availability = dict(frames).get(Availability)
+                if availability is not None:
+                    update_est_pls_avail(availability['accession_id'].tolist())
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                raise
+            for model, frame in frames:
+                next_ids[model] += len(frame)
+
+        report = report._replace(inserted=report.inserted + len(chunk),
+                                 rejected=report.rejected + rejected)
+        offset += rows_read
+        if journal is not None:
+            journal.checkpoint('accessions', offset)
+        if progress is not None:
+            progress.update(rows_read)
+
+    print('Inserted {} accessions.'.format(report.inserted))
+    if report.rejected:
+        print('[!] {} accessions were not added: {}'.format(len(report.rejected), ', '.join(report.rejected)))
+    return report
+
+
+def insert_frame(table, frame):
+    """
+    Inserts every row of frame, keyed by table's column names, with a
+    single executemany of plain tuples on the DBAPI cursor.
+
+    Instead of SQLAlchemy processing each row's parameters, values are
+    converted a column at a time with the column type's bind processor,
+    e.g. datetimes to the strings SQLite stores.
+    """
+    connection = db.session.connection()
+    dialect = connection.dialect
+    compiled = table.insert().values({name: bindparam(name) for name in frame.columns}).compile(dialect=dialect)
+    names = list(compiled.positiontup) if compiled.positional else list(frame.columns)
+
+    columns = []
+    for name in names:
+        values = frame[name]
+        missing = values.isnull().to_numpy()
+        values = values.astype(object).tolist()
+        if missing.any():
+            values = [None if is_missing else value for value, is_missing in zip(values, missing)]
+        processor = table.c[name].type.dialect_impl(dialect).bind_processor(dialect)
+        if processor is not None:
+            values = [value if value is None else processor(value) for value in values]
+        columns.append(values)
+
+    if compiled.positional:
+        params = list(zip(*columns))
+    else:
+        params = [dict(zip(names, row)) for row in zip(*columns)]
+    connection.exec_driver_sql(str(compiled), params)
+
+
+def add_synonyms(chunks, index=None, progress=None):
+    """
+    :param chunks: An iterable of checklist DataFrames, such as
+    iter_chunks(CHECKLIST_FILE).
+    :param index: SpeciesIndex used to resolve symbols. Loaded from the
+    database if not given.
+    :param progress: Progress to report each chunk read to.
+    :return: A SynonymReport of what was and was not linked.
+
+    Collects every (synonym, accepted name) pair in the checklist, then
+    sets Species.parent_id for all of them with a single executemany
+    UPDATE. Synonyms listed under more than one accepted name are
+    reported as conflicts and left unlinked.
+    """
+    if index is None:
+        index = SpeciesIndex.load()
+
+    frames = [pd.DataFrame(columns=['Synonym Symbol', 'Symbol'])]
+    for chunk in chunks:
+        frames.append(chunk.loc[chunk['Synonym Symbol'].notnull(), ['Synonym Symbol', 'Symbol']])
+        if progress is not None:
+            progress.update(len(chunk))
+    pairs = pd.concat(frames, ignore_index=True).drop_duplicates()
+    pairs = pairs[pairs['Synonym Symbol'] != pairs['Symbol']]
+
+    accepted_count = pairs.groupby('Synonym Symbol')['Symbol'].transform('size')
+    conflicts = pairs[accepted_count > 1]
+    pairs = pairs[accepted_count == 1]
+
+    pairs = pairs.assign(synonym_id=pairs['Synonym Symbol'].map(index.by_symbol),
+                         accepted_id=pairs['Symbol'].map(index.by_symbol))
+    resolved = pairs['synonym_id'].notnull() & pairs['accepted_id'].notnull()
+    links = [{'synonym_id': int(synonym_id), 'accepted_id': int(accepted_id)}
+             for synonym_id, accepted_id in zip(pairs['synonym_id'][resolved], pairs['accepted_id'][resolved])]
+
+    if links:
+        species = Species.__table__
+        db.session.execute(
+            species.update().where(species.c.id == bindparam('synonym_id')).values(parent_id=bindparam('accepted_id')),
+            links)
+    db.session.commit()
+
+    report = SynonymReport(
+        linked=len(links),
+        unresolved=list(zip(pairs['Synonym Symbol'][~resolved], pairs['Symbol'][~resolved])),
+        conflicts={synonym: sorted(group['Symbol']) for synonym, group in conflicts.groupby('Synonym Symbol')})
+    print('Linked {} synonyms to their accepted names.'.format(report.linked))
+    if report.unresolved:
+        print('[!] {} synonyms could not be linked because a symbol is not in the database.'.format(
+            len(report.unresolved)))
+    for synonym, accepted in sorted(report.conflicts.items()):
+        print('[!] {} is listed as a synonym of {}'.format(synonym, ', '.join(accepted)))
+    return report
+
+
+def add_species(chunks, index=None, journal=None, progress=None):
+    """
+    :param chunks: An iterable of checklist DataFrames, such as
+    iter_chunks(CHECKLIST_FILE).
+    :param index: SpeciesIndex to check for existing species and to
+    register the new ones with. Loaded from the database if not given.
+    :param journal: Journal to resume the 'species' stage from and to
+    checkpoint after every chunk.
+    :param progress: Progress to report each chunk to.
+
+    Parses every chunk with get_plants and bulk inserts the result, one
+    transaction per chunk. Symbols and names that are already in the
+    database, or earlier in the checklist, are skipped.
+    """
+    if index is None:
+        index = SpeciesIndex.load()
+
+    offset = 0
+    family_by_symbol = {}
+    if journal is not None:
+        offset = journal.offset('species')
+    if offset:
+        chunks = skip_rows(chunks, offset)
+        # Synonyms in the rest of the checklist may inherit the family of
+        # an accepted name in the skipped rows, which is in the database
+        family_by_symbol.update(
+            db.session.query(Species.symbol, Species.family).filter(Species.family.isnot(None)))
+
+    added = 0
+    for chunk in chunks:
+        plants = get_plants(chunk, family_by_symbol)
+        plants = plants.drop_duplicates('symbol').drop_duplicates('name_full')
+        plants = plants[plants['symbol'].map(index.by_symbol).isnull() &
+                        plants['name_full'].map(index.by_name).isnull()]
+        if not plants.empty:
+            # Only this import writes to the table, so the new rows are
+            # the ones past the current highest id
+            last_id = db.session.query(func.max(Species.id)).scalar() or 0
+            db.session.execute(Species.__table__.insert(), get_records(plants))
+            for species_id, symbol, name_full in db.session.query(
+                    Species.id, Species.symbol, Species.name_full).filter(Species.id > last_id):
+                index.add(species_id, symbol, name_full)
+            db.session.commit()
+            added += len(plants)
+
+        offset += len(chunk)
+        if journal is not None:
+            journal.checkpoint('species', offset)
+        if progress is not None:
+            progress.update(len(chunk))
+
+    print('Successfully added {} species to database!'.format(added))
+
+
+def skip_rows(chunks, offset):
+    """
+    :param chunks: An iterable of DataFrames.
+    :param offset: Number of leading rows to drop.
+    :return: A generator of the chunks without their first offset rows.
+    """
+    for chunk in chunks:
+        if offset >= len(chunk):
+            offset -= len(chunk)
+            continue
+        yield chunk.iloc[offset:]
+        offset = 0
+
+
+def add_batch_to_db(batch, index):
+    """
+    :param batch: A list of AccessionRecord tuples as returned by
+    get_acc_records.
+    :param index: SpeciesIndex used to resolve species names.
+    :return: The acc_nums of the rows that were rejected.
+
+    Adds the whole batch in one transaction. If the transaction fails
+    the batch is split in half and each half is retried, narrowing the
+    failure down to the offending rows without giving up the rest of
+    the batch.
+    """
     try:
+        write_batch(batch, index)
         db.session.commit()
+        for record in batch:
+            print('Successfully added {} to database!'.format(record.accession['acc_num']))
+        return []
     except IntegrityError:
         db.session.rollback()
-        print('{} already exists in the database!'.format(plant.name_full))
 
+    if len(batch) == 1:
+        acc_num = batch[0].accession['acc_num']
+        print('[!] {} already exists in the database!'.format(acc_num))
+        return [acc_num]
+
+    middle = len(batch) // 2
+    return add_batch_to_db(batch[:middle], index) + add_batch_to_db(batch[middle:], index)
+
+
+def write_batch(batch, index):
+    """
+    Inserts the records of a batch table by table, filling in each
+    foreign key from the ids generated for the table it refers to. The
+    records are copied first so that a failed batch can be retried.
+    """
+    locations = [dict(record.geo_location) for record in batch]
+    db.session.bulk_insert_mappings(GeoLocation, locations, return_defaults=True)
+
+    species_ids = [index.get_by_name(record.species_name) for record in batch]
+    accessions = [dict(record.accession, geo_location_id=location['id'], species_id=species_id)
+                  for record, location, species_id in zip(batch, locations, species_ids)]
+    db.session.bulk_insert_mappings(Accession, accessions, return_defaults=True)
+
+    db.session.bulk_insert_mappings(Zone, [
+        dict(record.zone, geo_location_id=location['id']) for record, location in zip(batch, locations)])
+    db.session.bulk_insert_mappings(Visit, [
+        dict(record.visit, geo_location_id=location['id'], accession_id=accession['id'], species_id=species_id)
+        for record, location, accession, species_id in zip(batch, locations, accessions, species_ids)])
+    db.session.bulk_insert_mappings(Testing, [
+        dict(record.test, accession_id=accession['id'], imported=True) for record, accession in zip(batch, accessions)])
+
+
+def transform_rows(rows, batch_size, workers):
+    """
+    :param rows: An iterable of rows from the accession export.
+    :param batch_size: Number of rows in each batch.
+    :param workers: Number of worker processes. With one worker the rows
+    are transformed in this process.
+    :return: A generator of lists of AccessionRecords, one per batch, in
+    the same order as the rows.
+
+    The next batch is transformed by the pool while the caller writes
+    the current one, and at most two batches are held at a time.
+    """
+    rows = iter(rows)
+    batches = iter(lambda: list(itertools.islice(rows, batch_size)), [])
+    if workers <= 1:
+        for batch in batches:
+            yield [get_acc_records(row) for row in batch]
+        return
 
-def add_test_to_db(test):
-    db.session.add(test)
+    pool = multiprocessing.Pool(workers)
     try:
-        db.session.commit()
-    except IntegrityError:
-        db.session.rollback()
-        print('Test #{} already exists in the database!'.format(test.id))
-
-
-def convert_dd_dms(dd):
-    degrees = int(dd)
-    minute_dec = (dd - degrees) * 60
-    minutes = int(minute_dec)
-    seconds = (minute_dec - minutes) * 60
-
-    return degrees, minutes, seconds
-
-
-def get_species_acc(series):
-    data_source = series['DATA_SOURCE']
-    plant_habit = series['Habit_rev']
-    coll_date = series['COLL_DT']  # Sqlite expects YYYY-MM-DD format
-    acc_num = series['ACC_NUM']
-    acc_num1 = series['ACC_NUM_1']
-    acc_num2 = series['ACC_NUM_2']
-    acc_num3 = series['ACC_NUM_3']
-    collected_with = series['COLLECTED_WITH']
-    collection_misc = series['COLLECTION_MISC']
-    seed_source = series['SEED_SOURCE']
-    description = series['DESCRIPTION']
-    notes = series['notes']
-    increase = None  # Slated for increase?
-
-    species = get_species(series['NAME'])
-    location = get_zone_desc_loc(series)
-
-    acc = Accession(data_source=data_source, plant_habit=plant_habit, coll_date=coll_date, acc_num=acc_num,
-                    acc_num1=acc_num1, acc_num2=acc_num2, acc_num3=acc_num3, collected_with=collected_with,
-                    collection_misc=collection_misc, seed_source=seed_source, description=description, notes=notes,
-                    increase=increase, species=species, location=location)
-
-    return species, acc
-
-
-def get_test(series, accession):
-    amt_rcvd_lbs = series['AMOUNT_RECVD__LBS_']
-    clean_wt_lbs = series['CLEAN_WEIGHT__LBS_']
-    est_seed_lb = series['SEED_LB']  # Estimated seeds per pound
-    est_pls_lb = series['EST_PLS_LB']  # Estimated Pure Live Seed per pound
-    est_pls_collected = series['EST_PLS_COLLECTED']
-    test_type = series['TEST_TYPE']
-    test_date = series['TEST_DATE']
-    purity = series['PURITY_']
-    tz = series['TZ_']
-    fill = series['FILL_']
-
-    test = Testing(amt_rcvd_lbs=amt_rcvd_lbs, clean_wt_lbs=clean_wt_lbs, est_seed_lb=est_seed_lb, est_pls_lb=est_pls_lb,
-                   est_pls_collected=est_pls_collected, test_type=test_type, test_date=test_date, purity=purity, tz=tz,
-                   fill=fill, accession=accession)
-    return test
-
-
-def get_zone_desc_loc(series):
-    phytoregion = series['PHYTOREGION']
-    phytoregion_full = series['PHYTOREGION_FULL']
-    locality = series['SUB_CNT3']
-    geog_area = series['GEOG_AREA']
-    directions = series['LOCALITY']
-    latitude_decimal = series['LATITUDE_DECIMAL']
-    longitude_decimal = series['LONGITUDE_DECIMAL']
-    degrees_n, minutes_n, seconds_n = convert_dd_dms(latitude_decimal)
-    degrees_w, minutes_w, seconds_w = convert_dd_dms(longitude_decimal)
-    georef_source = series['GEOREF_SOURCE']
-    gps_datum = series['GPS_DATUM']
-    altitude = series['ALTITUDE']
-    altitude_unit = series['ALTITUDE_UNIT']
-    altitude_in_m = series['ALTITUDE_IN_M']
-    fo_name = series['ADMU_NAME']
-    district_name = series['PARENT_NAM']
-    state = series['ADMIN_ST']
-    county = series['SUB_CNT2']
-
-    zone = get_zone(series)
-    location_description = get_location_desc(series)
-
-    loc = GeoLocation(phytoregion=phytoregion, phytoregion_full=phytoregion_full, locality=locality, geog_area=geog_area,
-                      directions=directions, latitude_decimal=latitude_decimal, longitude_decimal=longitude_decimal,
-                      degrees_n=degrees_n, minutes_n=minutes_n, seconds_n=seconds_n, degrees_w=degrees_w,
-                      minutes_w=minutes_w, seconds_w=seconds_w, georef_source=georef_source, gps_datum=gps_datum,
-                      altitude=altitude, altitude_unit=altitude_unit, altitude_in_m=altitude_in_m, fo_name=fo_name,
-                      district_name=district_name, state=state, county=county, zone=zone,
-                      location_description=location_description)
-
-    return zone, location_description, loc
-
-
-def get_location_desc(series):
-    land_owner = series['LAND_OWNER']
-    associated_taxa_full = series['ASSOCIATED_TAXA_FULL']
-    mod = series['USER2']   # modifying factors of collection site (grazed, etc.)
-    mod2 = series['USER1']  # additional modifying factors of collection site (roadside, etc.)
-    geomorphology = series['GEOMORPHOLOGY']
-    slope = series['SLOPE']
-    aspect = series['ASPECT']
-    habitat = series['HABITAT']
-    geology = series['GEOLOGY']
-    soil_type = series['SOIL_TYPE']
-    population_size = series['POPULATION_SIZE']
-    occupancy = series['OCCUPANCY']  # Number of plants collected from
-
-    loc_desc = GeoLocationDescription(associated_taxa_full=associated_taxa_full, mod=mod, mod2=mod2,
-                                      geomorphology=geomorphology, slope=slope, aspect=aspect, habitat=habitat,
-                                      population_size=population_size, occupancy=occupancy)
-    return loc_desc
-
-
-def get_species(name):
-    return db.session.query(Species).filter_by(name_full=name).first()
+        pending = None
+        for batch in batches:
+            result = pool.map_async(get_acc_records, batch, chunksize=max(1, len(batch) // (workers * 4)))
+            if pending is not None:
+                yield pending.get()
+            pending = result
+        if pending is not None:
+            yield pending.get()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def get_records(df):
+    """
+    :param df: DataFrame keyed by column names.
+    :return: A list of dicts suitable for an executemany insert, with
+    missing values as None rather than NaN.
+    """
+    columns = list(df.columns)
+    values = df.astype(object).where(df.notnull(), None)
+    return [dict(zip(columns, row)) for row in values.itertuples(index=False, name=None)]
+
+
+def get_frames(chunk, index, next_ids):
+    """
+    :param chunk: DataFrame of accession export rows, none of which are
+    in the database yet, with a default index.
+    :param index: SpeciesIndex used to resolve species names.
+    :param next_ids: Dict of model to the first id to assign in its table.
+    :return: A list of (model, DataFrame) pairs in insert order, each
+    frame keyed by the model's column names with ids and foreign keys
+    filled in.
+    """
+    def columns(column_map):
+        return pd.DataFrame({column: chunk[source] for column, source in column_map.items()})
+
+    def ids(model):
+        return pd.RangeIndex(next_ids[model], next_ids[model] + len(chunk)).to_series(index=chunk.index)
+
+    names = chunk['NAME']
+    species_ids = names.map(index.by_name)
+    unmatched = species_ids.isnull() & names.notnull()
+    species_ids[unmatched] = names[unmatched].map(index.get_by_name).astype(float)
+    species_ids = species_ids.astype('Int64')
+
+    location_ids = ids(GeoLocation)
+    accession_ids = ids(Accession)
+
+    locations = columns(GEO_LOCATION_COLUMNS)
+    locations['degrees_n'], locations['minutes_n'], locations['seconds_n'] = convert_dd_dms_columns(
+        locations['latitude_decimal'])
+    locations['degrees_w'], locations['minutes_w'], locations['seconds_w'] = convert_dd_dms_columns(
+        locations['longitude_decimal'])
+    accessions = columns(ACCESSION_COLUMNS).assign(increase=None)
+    zones = columns(ZONE_COLUMNS)
+    visits = columns(VISIT_COLUMNS)
+    tests = columns(TEST_COLUMNS)
+
+    frames = [
+        (GeoLocation, locations.assign(id=location_ids)),
+        (Accession, accessions.assign(id=accession_ids, geo_location_id=location_ids, species_id=species_ids)),
+        (Zone, zones.assign(id=ids(Zone), geo_location_id=location_ids)),
+        (Visit, visits.assign(id=ids(Visit), geo_location_id=location_ids, accession_id=accession_ids,
+                              species_id=species_ids)),
+        (Testing, tests.assign(id=ids(Testing), accession_id=accession_ids, imported=True)),
+    ]
+    if set(AVAILABILITY_COLUMNS.values()).issubset(chunk.columns):
+        frames.append((Availability, get_availability(columns(AVAILABILITY_COLUMNS)).assign(
+            id=ids(Availability), accession_id=accession_ids)))
+    return frames
+
+
+def get_availability(availability):
+    """
+    :param availability: DataFrame of the grams available at each
+    location, keyed by the Availability column names.
+    :return: The frame with the totals that Availability.update_totals
+    computes added column-wise. Missing amounts count as zero.
+    """
+    amounts = availability.astype(float).fillna(0)
+    gr_avail = amounts.sum(axis=1)
+    sum_gr_no_grin = gr_avail - amounts['grin_avail']
+    return availability.assign(
+        gr_avail=gr_avail,
+        avail_any=gr_avail > 0,
+        lb_avail=compute_gr_to_lb(gr_avail),
+        sum_gr_no_grin=sum_gr_no_grin,
+        avail_no_grin=sum_gr_no_grin > 0,
+        sum_lb_no_grin=compute_gr_to_lb(sum_gr_no_grin),
+    )
+
+
+def get_acc_records(series):
+    """
+    :param series: A row of the accession export.
+    :return: An AccessionRecord of insert-ready dicts for the row.
+
+    This only depends on the row itself so that it can run in a worker
+    process. Foreign keys are filled in later by write_batch.
+    """
+    record = AccessionRecord(species_name=series['NAME'], zone=get_zone(series),
+                             geo_location=get_geo_location(series), visit=get_visit(series),
+                             accession=get_accession(series), test=get_test(series))
+    record.accession['import_hash'] = record_hash(record)
+    return record
+
+
+def record_hash(record):
+    """
+    :param record: An AccessionRecord.
+    :return: SHA-1 hex digest of the record's values, used to tell
+    whether an accession changed in the export since it was imported.
+    """
+    values = json.dumps(record._asdict(), sort_keys=True, default=str)
+    return hashlib.sha1(values.encode('utf-8')).hexdigest()
+
+
+def get_accession(series):
+    record = {column: series[source] for column, source in ACCESSION_COLUMNS.items()}
+    record['increase'] = None  # Slated for increase?
+    return record
+
+
+def get_test(series):
+    return {column: series[source] for column, source in TEST_COLUMNS.items()}
+
+
+def get_geo_location(series):
+    record = {column: series[source] for column, source in GEO_LOCATION_COLUMNS.items()}
+    record['degrees_n'], record['minutes_n'], record['seconds_n'] = convert_dd_dms(record['latitude_decimal'])
+    record['degrees_w'], record['minutes_w'], record['seconds_w'] = convert_dd_dms(record['longitude_decimal'])
+    return record
+
+
+def get_visit(series):
+    return {column: series[source] for column, source in VISIT_COLUMNS.items()}
 
 
 def get_zone(series):
-    ptz = series['Pot_STZ']
-    us_l4_code = series['US_L4CODE']
-    us_l4_name = series['US_L4NAME']
-    us_l3_code = series['US_L3CODE']
-    us_l3_name = series['US_L3NAME']
-    achy_sz_gridcode = series['ACHY_SZ_GRIDCODE']
-    achy_sz_zone = series['ACHY_SZ_ZONE']
-    cp_buff = series['CPBuff']
-    cp_strict = series['CPStrict']
-    avail_buff = series['AVAIL_BUFF']
-    avail_strict = series['AVAIL_STRICT']
-    usgs_zone = series['USGS_ZONE']
-
-    zone = Zone(ptz=ptz, us_l4_code=us_l4_code, us_l4_name=us_l4_name, us_l3_code=us_l3_code, us_l3_name=us_l3_name,
-                achy_sz_gridcode=achy_sz_gridcode, achy_sz_zone=achy_sz_zone, cp_buff=cp_buff, cp_strict=cp_strict,
-                avail_buff=avail_buff, avail_strict=avail_strict, usgs_zone=usgs_zone)
-    return zone
-
-
-def get_plant(series):
-    if pd.isnull(series['Synonym Symbol']):
-        symbol = series['Symbol']
-    else:
-        symbol = series['Synonym Symbol']
-
-    if not isinstance(series['Scientific Name with Author'], str):
-        return  # Skip row if the name is not a string type
-
-    name = series['Scientific Name with Author'].split(' ')
-    if len(name) < 2 or name[1][-1] == '.':
-        return  # Skip rows with blank names and those that just describe the genus
-
-    common = None
-    if not pd.isnull(series['Common Name']):
-        common = series['Common Name']
-
-    var_ssp1 = None
-    var_ssp2 = None
-    if 'var.' in name:
-        index = name.index('var.') + 1
-        var_ssp1 = 'var.'
-        if index != len(name):  # avoid index out of bounds errors for when var. or spp. at end of string
-            var_ssp2 = name[index]
-    if 'ssp.' in name:
-        index = name.index('ssp.') + 1
-        var_ssp1 = 'ssp.'
-        if index != len(name):
-            var_ssp2 = name[index]
-
-    if var_ssp1 and var_ssp2:
-        name_full = name[0] + ' ' + name[1] + ' ' + var_ssp1 + ' ' + var_ssp2
-    else:
-        name_full = name[0] + ' ' + name[1]
-
-    if pd.isnull(series['Family']):
-        last = Species.query.filter_by(symbol=series['Symbol']).first()
-        if last is not None:
-            family = last.family
+    return {column: series[source] for column, source in ZONE_COLUMNS.items()}
+
+
+def get_plants(chunk, family_by_symbol):
+    """
+    :param chunk: DataFrame of rows from the USDA plants checklist.
+    :param family_by_symbol: Dict of accepted symbol to family, carried
+    between chunks and updated with the accepted names in this chunk.
+    :return: DataFrame with one row per valid species, keyed by the
+    Species column names.
+
+    Names are split into genus, species and var./ssp. with column-wise
+    string operations. Synonyms without a family inherit the family of
+    their accepted name from earlier in the checklist.
+    """
+    names = chunk['Scientific Name with Author'].astype(object)
+    tokens = names.str.split(' ')
+    genus = tokens.str[0]
+    species = tokens.str[1]
+    # Skip rows with blank names and those that just describe the genus
+    valid = species.notnull() & (species.str.len() > 0) & ~species.str.endswith('.', na=False)
+
+    # ssp. takes precedence over var. when a name has both
+    var = names.str.extract(r'(?:^| )(var\.)(?= |$)(?: ([^ ]*))?')
+    ssp = names.str.extract(r'(?:^| )(ssp\.)(?= |$)(?: ([^ ]*))?')
+    var_ssp1 = ssp[0].fillna(var[0])
+    var_ssp2 = ssp[1].fillna(var[1])
+    var_ssp2 = var_ssp2.mask(var_ssp2 == '')
+
+    name_full = genus + ' ' + species
+    has_var_ssp = var_ssp1.notnull() & var_ssp2.notnull()
+    name_full[has_var_ssp] += ' ' + var_ssp1[has_var_ssp] + ' ' + var_ssp2[has_var_ssp]
+
+    accepted = chunk['Synonym Symbol'].isnull()
+    has_family = valid & accepted & chunk['Family'].notnull()
+    family_by_symbol.update(zip(chunk['Symbol'][has_family], chunk['Family'][has_family]))
+    family = chunk['Family'].astype(object).fillna(chunk['Symbol'].map(family_by_symbol))
+
+    plants = pd.DataFrame({
+        'symbol': chunk['Synonym Symbol'].astype(object).fillna(chunk['Symbol']),
+        'name_full': name_full,
+        'common': chunk['Common Name'],
+        'family': family,
+        'genus': genus,
+        'species': species,
+        'var_ssp1': var_ssp1,
+        'var_ssp2': var_ssp2,
+        'plant_type': None,
+        'plant_duration': None,
+        'priority_species': False,
+        'gsg_val': False,
+        'poll_val': False,
+        'research_val': False,
+    })
+    return plants[valid & family.notnull()]
+
+
+def run_import(stages=STAGES, resume=False, batch_size=BATCH_SIZE, workers=WORKERS, incremental=False,
+               bulk=False, journal_file=JOURNAL_FILE):
+    """
+    Runs the given stages in order, journaling each one's progress. With
+    resume, completed stages are skipped and the others continue after
+    their last committed batch. bulk loads accessions with bulk_import
+    rather than parse_excel.
+    """
+    journal = Journal(journal_file)
+    if not resume:
+        journal.reset()
+
+    index = SpeciesIndex.load()
+    for stage in STAGES:
+        if stage not in stages:
+            continue
+        source = STAGE_FILES[stage]
+        offset = journal.start(stage, source)
+        if journal.is_done(stage):
+            print('[{}] Already completed, skipping.'.format(stage))
+            continue
+
+        progress = Progress(stage, row_count(source), offset)
+        if stage == 'species':
+            add_species(iter_chunks(source), index, journal, progress)
+        elif stage == 'synonyms':
+            add_synonyms(iter_chunks(source), index, progress)
         else:
-            return
-    else:
-        family = series['Family']
-
-    plant = Species(symbol=symbol, name_full=name_full, common=common, family=family,
-                           genus=name[0], species=name[1], var_ssp1=var_ssp1, var_ssp2=var_ssp2,
-                           plant_type=None, plant_duration=None, priority_species=0, gsg_val=0,
-                           poll_val=0, research_val=0)
-    add_plant_to_db(plant)
+            if bulk:
+                bulk_import(iter_chunks(source), index, journal, progress)
+            else:
+                parse_excel(iter_rows(source), batch_size, index, workers, incremental, journal, progress)
+        progress.finish()
+        journal.finish(stage)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Populate the database from the USDA plants checklist and the '
+                                                 'accession export.')
+    parser.add_argument('stages', nargs='*', choices=STAGES, default=list(STAGES),
+                        help='Stages to run, in order. Defaults to all of them.')
+    parser.add_argument('--resume', action='store_true',
+                        help='Skip completed stages and continue the others after their last committed batch.')
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE,
+                        help='Accession rows per transaction (default: %(default)s).')
+    parser.add_argument('--workers', type=int, default=WORKERS,
+                        help='Processes transforming accession rows (default: %(default)s).')
+    parser.add_argument('--incremental', action='store_true',
+                        help='Update accessions that changed in the export instead of rejecting them.')
+    parser.add_argument('--bulk', action='store_true',
+                        help='Load accessions with Core executemany inserts instead of the ORM. Faster, but every '
+                             'accession must be new.')
+    args = parser.parse_args(argv)
+    if args.bulk and args.incremental:
+        parser.error('--bulk cannot be combined with --incremental')
+
+    with create_app().app_context():
+        migrate()
+
+        try:
+            run_import(args.stages, args.resume, args.batch_size, args.workers, args.incremental, args.bulk)
+        except KeyboardInterrupt:
+            print('[!] Interrupted. Run again with --resume to continue after the last committed batch.')
+            sys.exit(1)
 
 
-def check_synonym(series):
-    if pd.isnull(series['Synonym Symbol']):
-        return
-    else:
-        plant = Species.query.filter_by(symbol=series['Symbol']).first()
-        current = Species.query.filter_by(symbol=series['Synonym Symbol']).first()
-        if plant is not None and current is not None:
-            plant.add_synonym(current)
-            try:
-                db.session.commit()
-            except IntegrityError:
-                db.session.rollback()
-                print('Failed to add {} as synonym of {}'.format(current.name_full, plant.name_full))
-
 if __name__ == '__main__':
-    db.init_app(app)
-    db.create_all()
-
-    # Already added to local database
-    #add_species(df)
-    #add_synonyms(df)
+    main()
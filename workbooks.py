@@ -0,0 +1,316 @@
+"""
+CPNPP Database
+
+Streaming access to the Excel workbooks used to populate the database.
+
+Workbooks are opened in openpyxl's read-only mode, which reads the
+underlying sheet XML lazily, so only the rows currently being processed
+are held in memory no matter how large the workbook is.
+
+Parsing xlsx is slow, so the first pass over a workbook writes its rows
+to a columnar Arrow IPC (Feather) file in CACHE_DIR, and every read,
+the first included, is served from that file. Later reads memory map it
+instead of parsing the workbook again, for as long as the workbook's
+mtime and content hash still match the cache. Reading the rows back from
+the cache on the first pass too means a workbook's chunks have the same
+dtypes whether or not it was already cached.
+"""
+import datetime
+import hashlib
+import json
+import numbers
+import os
+
+from openpyxl import load_workbook
+import pandas as pd
+
+try:
+    import pyarrow as pa
+except ImportError:  # Caching is skipped without pyarrow
+    pa = None
+
+# Number of rows per DataFrame yielded by iter_chunks
+CHUNK_SIZE = 1000
+
+# Where the columnar copies of the workbooks are kept
+CACHE_DIR = '.workbook_cache'
+
+
+def iter_rows(path, sheet=None, use_cache=True):
+    """
+    :param path: Path to the .xlsx workbook.
+    :param sheet: Name of the worksheet to read. Defaults to the first
+    worksheet in the workbook.
+    :param use_cache: Read from and populate the columnar cache.
+    :return: A generator of dicts mapping the header row to each row's
+    values. Empty cells are None and completely empty rows are skipped.
+    """
+    if not use_cache or pa is None:
+        for row in _read_workbook(path, sheet):
+            yield row
+        return
+
+    for chunk in iter_chunks(path, sheet=sheet):
+        chunk = chunk.astype(object).where(chunk.notnull(), None)
+        for row in chunk.to_dict('records'):
+            yield row
+
+
+def iter_chunks(path, chunk_size=CHUNK_SIZE, sheet=None, use_cache=True):
+    """
+    :param path: Path to the .xlsx workbook.
+    :param chunk_size: Maximum number of rows in each chunk.
+    :param sheet: Name of the worksheet to read.
+    :param use_cache: Read from and populate the columnar cache.
+    :return: A generator of DataFrames of at most chunk_size rows.
+    """
+    if not use_cache or pa is None:
+        for chunk in _chunk_workbook(path, chunk_size, sheet):
+            yield chunk
+        return
+
+    cache_file = fresh_cache_file(path, sheet) or _write_cache(path, sheet, _chunk_workbook(path, chunk_size, sheet))
+    if cache_file:
+        for chunk in _read_cache(cache_file, chunk_size):
+            yield chunk
+    else:
+        for chunk in _chunk_workbook(path, chunk_size, sheet):
+            yield chunk
+
+
+def fresh_cache_file(path, sheet=None):
+    """
+    :param path: Path to the .xlsx workbook.
+    :param sheet: Name of the worksheet.
+    :return: The path of the cached copy of the worksheet, or None if
+    there is no cache or the workbook has changed since it was written.
+
+    The cache is trusted as-is while the workbook's size and mtime are
+    unchanged. Otherwise the workbook is hashed, and the cache is still
+    used if the hash matches, e.g. after the file was copied or touched.
+    """
+    meta = _read_meta(path, sheet)
+    if meta is None or not os.path.exists(meta['cache_file']):
+        return None
+
+    stat = os.stat(path)
+    if meta['mtime'] == stat.st_mtime and meta['size'] == stat.st_size:
+        return meta['cache_file']
+
+    if meta['sha1'] == _file_hash(path):
+        meta.update(mtime=stat.st_mtime, size=stat.st_size)
+        _write_meta(path, sheet, meta)
+        return meta['cache_file']
+
+    return None
+
+
+def row_count(path, sheet=None):
+    """
+    :param path: Path to the .xlsx workbook.
+    :param sheet: Name of the worksheet.
+    :return: The number of rows below the header, or None if the
+    workbook does not record its dimensions.
+
+    Exact when the worksheet is cached. Otherwise it is read from the
+    sheet's dimensions, which also count blank rows.
+    """
+    cache_file = fresh_cache_file(path, sheet) if pa is not None else None
+    if cache_file:
+        reader = pa.ipc.open_file(pa.memory_map(cache_file))
+        return sum(reader.get_batch(i).num_rows for i in range(reader.num_record_batches))
+
+    workbook = load_workbook(path, read_only=True, data_only=True)
+    try:
+        worksheet = workbook[sheet] if sheet else workbook.worksheets[0]
+        if worksheet.max_row is None:
+            return None
+        return max(0, worksheet.max_row - 1)
+    finally:
+        workbook.close()
+
+
+def _read_workbook(path, sheet=None):
+    workbook = load_workbook(path, read_only=True, data_only=True)
+    try:
+        worksheet = workbook[sheet] if sheet else workbook.worksheets[0]
+        rows = worksheet.iter_rows(values_only=True)
+        header = next(rows, None)
+        if header is None:
+            return
+
+        for values in rows:
+            if all(value is None for value in values):
+                continue
+            yield dict(zip(header, values))
+    finally:
+        # Read-only workbooks keep the file handle open until closed
+        workbook.close()
+
+
+def _chunk_workbook(path, chunk_size, sheet=None):
+    chunk = []
+    for row in _read_workbook(path, sheet):
+        chunk.append(row)
+        if len(chunk) >= chunk_size:
+            yield _normalize(pd.DataFrame.from_records(chunk))
+            chunk = []
+    if chunk:
+        yield _normalize(pd.DataFrame.from_records(chunk))
+
+
+def _normalize(df):
+    """
+    Give every column of a raw workbook chunk a single dtype so that it
+    can be stored in a columnar file. Whole number columns become Int64,
+    other numbers float64, dates datetime64 and anything else strings.
+    """
+    for column in df.columns:
+        values = df[column].dropna()
+        if values.empty or df[column].dtype != object:
+            continue
+        if all(isinstance(value, bool) for value in values):
+            df[column] = df[column].astype('boolean')
+        elif all(isinstance(value, numbers.Integral) for value in values):
+            df[column] = df[column].astype('Int64')
+        elif all(isinstance(value, numbers.Number) for value in values):
+            df[column] = df[column].astype(float)
+        elif all(isinstance(value, (datetime.date, datetime.datetime)) for value in values):
+            df[column] = pd.to_datetime(df[column])
+        else:
+            df[column] = df[column].map(lambda value: value if value is None else str(value))
+    return df
+
+
+def _read_cache(cache_file, chunk_size):
+    reader = pa.ipc.open_file(pa.memory_map(cache_file))
+    for i in range(reader.num_record_batches):
+        batch = reader.get_batch(i)
+        for offset in range(0, batch.num_rows, chunk_size):
+            yield _to_pandas(batch.slice(offset, chunk_size))
+
+
+def _to_pandas(batch):
+    # Keep the nullable dtypes given by _normalize, rather than turning
+    # integer columns with missing values into floats
+    return batch.to_pandas(types_mapper={pa.int64(): pd.Int64Dtype(), pa.bool_(): pd.BooleanDtype()}.get)
+
+
+def _write_cache(path, sheet, chunks):
+    """
+    Write every chunk to a new cache file, widening a column's type when
+    a later chunk needs it, e.g. whole numbers followed by 7100.5 become
+    floats and a column that was empty so far takes the later type.
+
+    :return: The path of the cache file, or None if the chunks could not
+    be stored, in which case the workbook is read without the cache.
+    """
+    if not os.path.isdir(CACHE_DIR):
+        os.makedirs(CACHE_DIR)
+
+    sha1 = _file_hash(path)
+    stat = os.stat(path)
+    cache_file = os.path.join(CACHE_DIR, '{}.{}.arrow'.format(sha1, _key(sheet or '')))
+    tmp_files = [cache_file + '.tmp', cache_file + '.tmp2']
+    tmp_file = tmp_files[0]
+    writer = None
+    schema = None
+    try:
+        for chunk in chunks:
+            table = pa.Table.from_pandas(chunk, preserve_index=False)
+            if schema is None:
+                schema = table.schema
+                writer = pa.ipc.new_file(tmp_file, schema)
+            wider = _widen(schema, table.schema)
+            if not wider.equals(schema):
+                writer.close()
+                writer = None
+                new_file = tmp_files[tmp_file == tmp_files[0]]
+                writer = _rewrite(tmp_file, new_file, wider)
+                tmp_file, schema = new_file, wider
+            writer.write_table(table.cast(schema))
+
+        if writer is None:  # Nothing below the header
+            writer = pa.ipc.new_file(tmp_file, pa.schema([]))
+        writer.close()
+        writer = None
+        os.replace(tmp_file, cache_file)
+        _write_meta(path, sheet, {'sha1': sha1, 'mtime': stat.st_mtime, 'size': stat.st_size,
+                                  'cache_file': cache_file})
+        return cache_file
+    except (pa.ArrowException, ValueError) as e:
+        print('[!] Not caching {}: {}'.format(path, e))
+        return None
+    finally:
+        if writer is not None:
+            writer.close()
+        for tmp_file in tmp_files:
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+
+
+def _rewrite(old_file, new_file, schema):
+    """
+    Copy the batches written so far to a new file, cast to the widened
+    schema, and delete the old one.
+
+    :return: An open writer of the new file to append the rest to.
+    """
+    writer = pa.ipc.new_file(new_file, schema)
+    with pa.memory_map(old_file) as source:
+        reader = pa.ipc.open_file(source)
+        for i in range(reader.num_record_batches):
+            writer.write_batch(reader.get_batch(i).cast(schema))
+    os.remove(old_file)
+    return writer
+
+
+def _widen(schema, other):
+    """
+    :return: The schema whose columns can hold both schemas' values.
+    Columns empty in one of them take the other's type, integers and
+    floats widen to floats and anything else mixed widens to strings.
+    """
+    fields = []
+    for field in schema:
+        other_type = other.field(field.name).type
+        if field.type.equals(other_type) or pa.types.is_null(other_type):
+            fields.append(field)
+        elif pa.types.is_null(field.type):
+            fields.append(pa.field(field.name, other_type))
+        elif all(pa.types.is_integer(t) or pa.types.is_floating(t) for t in (field.type, other_type)):
+            fields.append(pa.field(field.name, pa.float64()))
+        else:
+            fields.append(pa.field(field.name, pa.string()))
+    return pa.schema(fields)
+
+
+def _meta_file(path, sheet):
+    # Workbooks with the same name in different folders are kept apart
+    return os.path.join(CACHE_DIR, '{}.json'.format(_key(os.path.abspath(path), sheet or '')))
+
+
+def _key(*names):
+    # Sheet names may hold characters that file names can't
+    return hashlib.sha1('\0'.join(names).encode('utf-8')).hexdigest()[:16]
+
+
+def _read_meta(path, sheet):
+    try:
+        with open(_meta_file(path, sheet)) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+
+def _write_meta(path, sheet, meta):
+    with open(_meta_file(path, sheet), 'w') as f:
+        json.dump(meta, f)
+
+
+def _file_hash(path):
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
@@ -0,0 +1,23 @@
+"""
+CPNPP Database
+
+The entry point for WSGI servers, e.g.
+
+    gunicorn -c gunicorn.conf.py wsgi:app
+
+Each worker imports this module and creates its own app. The time that
+takes is recorded in the cpnpp_app_startup_seconds metric, and can be
+measured outside a server with manage.py startup-time.
+
+gunicorn.conf.py upgrades an older database before the workers start.
+With another server, run manage.py init-db first.
+"""
+import time
+
+started = time.perf_counter()
+
+from app import create_app  # noqa: E402
+import metrics  # noqa: E402
+
+app = create_app()
+metrics.record_startup(time.perf_counter() - started)